@@ -178,6 +178,31 @@ SIMPLE_JWT = {
 NN_SETTINGS = {
     "IMAGE_NAME_MAX_CHARS": 10,
     "MAX_IMAGE_BYTES": 1024,
+    # Декодировать кадры исследования по запросу вместо хранения всех кадров в памяти
+    "LAZY_DATASET": getenv("NN_LAZY_DATASET", "1") == "1",
+    # Окно обрезки считается по каждому CROP_STEP-му кадру
+    "CROP_STEP": int(getenv("NN_CROP_STEP", "1")),
+    # Кэш результатов инференса по содержимому исследования, 0 - кэш отключен
+    "RESULT_CACHE_DIR": getenv("NN_RESULT_CACHE_DIR", str(MEDIA_ROOT_PATH / "nn_cache")),
+    "RESULT_CACHE_MB": int(getenv("NN_RESULT_CACHE_MB", "1024")),
+    # Redis для публикации хода обработки исследований (канал uzi:progress:<id>)
+    "PROGRESS_REDIS_URL": getenv("NN_PROGRESS_REDIS_URL", "redis://localhost:6380"),
+    # Хранение контуров сегментов: "points" - строка SegmentationPoint на вершину,
+    # "blob" - упакованный контур в SegmentationData.points_blob
+    "CONTOUR_STORAGE": getenv("NN_CONTOUR_STORAGE", "points"),
+    # Сегментировать, классифицировать и сохранять каждый узел сразу после завершения его трека
+    "STREAM_NODULES": getenv("NN_STREAM_NODULES", "1") == "1",
+    # Потоки стадий конвейера обработки исследований (детекция с трекингом - всегда один поток)
+    # и размер очередей между стадиями
+    "PIPELINE_WORKERS": {
+        "decode": int(getenv("NN_PIPELINE_DECODE_WORKERS", "2")),
+        "segment": int(getenv("NN_PIPELINE_SEGMENT_WORKERS", "1")),
+        "classify": int(getenv("NN_PIPELINE_CLASSIFY_WORKERS", "1")),
+        "persist": int(getenv("NN_PIPELINE_PERSIST_WORKERS", "2")),
+    },
+    "PIPELINE_QUEUE_SIZE": int(getenv("NN_PIPELINE_QUEUE_SIZE", "4")),
+    # Сдвиг срока исследования в конвейере на мегапиксель его кадров, секунды
+    "AGING_SECONDS_PER_MPIX": float(getenv("NN_AGING_SECONDS_PER_MPIX", "0.5")),
     "classification": {
         "cross": BASE_MODEL_PATH / "base/classUZI/cross/resnet.zip",
         "long": BASE_MODEL_PATH / "base/classUZI/long/resnet.zip",
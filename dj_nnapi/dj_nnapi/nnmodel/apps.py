@@ -1,9 +1,6 @@
 from django.apps import AppConfig
-from typing import *
-from .nn.nnmodel import ModelABC
-from .nn.models.DetectionTrackingModel import DetectionTrackingModel
-from .nn.models.ROISegmentationModel import ROISegmentationModel
-from .nn.models.ROIClassificationModel import ROIClassificationModel
+from .nn.nnmodel import settings
+from .nn.registry import ModelRegistry, default_specs
 from os import getenv
 
 
@@ -15,8 +12,8 @@ class NNmodelConfig(AppConfig):
 
     wsgi = int(getenv("wsgi_start", "0"))
 
-    DefalutModels: Dict[str, Dict[str, ModelABC]] = {
-            "D": {"all": DetectionTrackingModel(model_type='all')},
-            "C": {"all": ROIClassificationModel(model_type='all')},
-            "S": {"all": ROISegmentationModel(model_type='all')}
-    }
+    # Модели загружаются при первом обращении: NNmodelConfig.models.get("D", "all")
+    models = ModelRegistry(
+        specs=default_specs(),
+        memory_budget=settings["registry_memory_budget"],
+    )
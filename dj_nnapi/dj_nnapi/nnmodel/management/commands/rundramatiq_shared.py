@@ -0,0 +1,147 @@
+import gc
+import multiprocessing
+import os
+import signal
+import sys
+
+import numpy as np
+import torch
+from dramatiq import cli
+from django.core.management.base import CommandError
+from django.db import connections
+from django_dramatiq.management.commands import rundramatiq
+from ultralytics import YOLO
+
+from nnmodel.apps import NNmodelConfig
+
+
+def iter_model_objects(model):
+    """
+    YOLO модели и torch модули, которые держит обёртка ModelABC
+    """
+    for value in vars(model).values():
+        for obj in value if isinstance(value, list) else [value]:
+            if isinstance(obj, (YOLO, torch.nn.Module)):
+                yield obj
+
+
+class Command(rundramatiq.Command):
+    help = (
+        "Runs dramatiq workers forked from a process with preloaded models, "
+        "so worker processes share model weights instead of loading their own copies"
+    )
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            "--large-queue",
+            default="predict_all_large",
+            help="Queue of large studies served by its own worker processes (see --large-processes)",
+        )
+        parser.add_argument(
+            "--large-processes",
+            default=0,
+            type=int,
+            help=(
+                "Worker processes that consume only --large-queue; the other workers then skip it. "
+                "0 - all workers consume all --queues"
+            ),
+        )
+        parser.add_argument(
+            "--large-threads",
+            default=1,
+            type=int,
+            help="Threads per --large-queue worker process",
+        )
+
+    def handle(self, watch_dir, skip_logging, use_polling_watcher, use_gevent, path, processes, threads, verbosity,
+               queues, pid_file, log_file, forks, worker_shutdown_timeout, large_queue, large_processes,
+               large_threads, **options):
+        if use_gevent:
+            # gevent должен пропатчить модули до их импорта, а модели уже загружены
+            raise CommandError("--use-gevent is not supported, use rundramatiq")
+        if large_processes:
+            if not queues:
+                raise CommandError("--large-processes needs an explicit --queues list")
+            queues = [queue for queue in queues if queue != large_queue]
+            if not queues:
+                # без --queues основные воркеры взяли бы и большую очередь
+                raise CommandError(f"--queues has no queue besides {large_queue}")
+
+        self._share_models()
+
+        # те же аргументы dramatiq, что собирает rundramatiq
+        common = ["--path", *path, "--worker-shutdown-timeout", str(worker_shutdown_timeout)]
+        common += ["-v"] * (verbosity - 1)
+        if log_file:
+            common += ["--log-file", log_file]
+        if skip_logging:
+            common.append("--skip-logging")
+        common += self.discover_tasks_modules()
+
+        argv = [*common, "--processes", str(processes), "--threads", str(threads)]
+        if watch_dir:
+            argv += ["--watch", watch_dir]
+            if use_polling_watcher:
+                argv.append("--watch-use-polling")
+        for function in forks:
+            argv += ["--fork-function", function]
+        if pid_file:
+            argv += ["--pid-file", pid_file]
+
+        # Воркеры должны получить копию процесса с загруженными весами, а не импортировать модели заново
+        multiprocessing.set_start_method("fork", force=True)
+
+        large_lane = None
+        if large_processes:
+            # Приоритет актора упорядочивает только уже полученные воркером сообщения, поэтому
+            # большие исследования получают свои процессы: они не занимают потоки и конвейер
+            # воркеров малых исследований, пока малые ждут в очереди
+            large_argv = [*common, "--processes", str(large_processes), "--threads", str(large_threads),
+                          "--queues", large_queue]
+            self.stdout.write(f" * Running dramatiq lane for {large_queue}: {' '.join(large_argv)}")
+            large_lane = multiprocessing.Process(target=self._run_dramatiq, args=(large_argv,), name=large_queue)
+            large_lane.start()
+        if queues:
+            argv += ["--queues", *queues]
+
+        self.stdout.write(f" * Running dramatiq in-process: {' '.join(argv)}")
+        try:
+            retcode = self._run_dramatiq(argv)
+        finally:
+            if large_lane is not None:
+                # воркеры большой очереди останавливаются вместе с основными
+                if large_lane.is_alive():
+                    os.kill(large_lane.pid, signal.SIGTERM)
+                large_lane.join()
+        sys.exit(retcode)
+
+    @staticmethod
+    def _run_dramatiq(argv):
+        return cli.main(cli.make_argument_parser().parse_args(argv))
+
+    def _share_models(self):
+        # Пул потоков OpenMP, созданный до fork, в дочерних процессах не работает (они зависают
+        # на первой параллельной операции). Прогрев идет в одном потоке, число потоков
+        # восстанавливается в каждом воркере после fork, и пул создается уже там
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        os.register_at_fork(after_in_child=lambda: torch.set_num_threads(num_threads))
+
+        NNmodelConfig.models.warmup()
+        for key, model in NNmodelConfig.models.loaded().items():
+            for obj in iter_model_objects(model):
+                if isinstance(obj, YOLO):
+                    # Первый вызов YOLO создаёт предиктор и сливает слои модели;
+                    # делаем это до fork, чтобы воркеры не меняли (и не копировали) веса
+                    obj(np.zeros(shape=(64, 64, 3), dtype=np.uint8), verbose=False)
+                    obj = obj.model
+                if next(obj.parameters(), torch.empty(0)).device.type == "cpu":
+                    obj.share_memory()
+            self.stdout.write(f" * Model {key} is shared")
+
+        # Соединения с БД нельзя разделять между процессами
+        connections.close_all()
+        # Объекты, созданные до fork, не трогает сборщик мусора, иначе он копирует их страницы при обходе
+        gc.collect()
+        gc.freeze()
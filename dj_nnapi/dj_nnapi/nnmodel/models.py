@@ -46,6 +46,9 @@ class SegmentationData(models.Model):
         UZISegmentGroupInfo, models.CASCADE, related_name="data"
     )
 
+    # Упакованный контур сегмента (см. contours.py), None - точки хранятся в SegmentationPoint
+    points_blob = models.BinaryField(null=True, blank=True, editable=False)
+
     class Meta:
         verbose_name = "Сегмент"
         verbose_name_plural = "Сегменты"
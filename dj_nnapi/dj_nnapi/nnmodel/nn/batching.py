@@ -0,0 +1,233 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List, Sequence
+
+from nnmodel.nn.nnmodel import settings
+
+# элемент очереди, после которого рабочий поток батчера завершается
+_STOP = object()
+
+
+class BatcherClosedError(RuntimeError):
+    """
+    Элементы поданы в закрытый батчер
+    """
+
+
+class DynamicBatcher:
+    """
+    Объединяет элементы, поступающие из разных потоков (задач dramatiq), в общие батчи.
+
+    Рабочий поток ждёт первый элемент, затем добирает батч до max_batch_size элементов,
+    но не дольше max_wait секунд, и вызывает fn один раз на весь батч.
+    Результаты возвращаются вызывающим через Future.
+    Поток держит ссылку на fn (обычно метод модели), поэтому батчер, который больше
+    не нужен, закрывается close(): иначе модель не может быть собрана сборщиком мусора.
+    """
+
+    def __init__(self,
+                 fn: Callable[[List[Any]], Sequence[Any]],
+                 max_batch_size: int,
+                 max_wait: float,
+                 name: str = 'batcher') -> None:
+        """
+        Args:
+            fn (Callable): Обработка батча: список элементов -> список результатов той же длины
+            max_batch_size (int): Максимальный размер батча
+            max_wait (float): Максимальное время ожидания добора батча, секунды
+            name (str): Имя рабочего потока
+        """
+
+        self.fn = fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def close(self, timeout: float = None) -> None:
+        """
+        Останавливает рабочий поток и освобождает fn. Уже поставленные элементы обрабатываются,
+        новые элементы не принимаются (submit бросает BatcherClosedError).
+
+        Args:
+            timeout (float): Сколько ждать завершения рабочего потока, None - без ограничения
+        """
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is None:
+                self.fn = None
+                return
+            self._queue.put((_STOP, None))
+        thread.join(timeout)
+
+    def submit(self, items: Sequence[Any]) -> List[Future]:
+        """
+        Ставит элементы в очередь.
+
+        Args:
+            items (Sequence): Элементы для обработки
+
+        Returns:
+            List[Future]: Future с результатом для каждого элемента
+        """
+
+        futures = []
+        with self._lock:
+            if self._closed:
+                raise BatcherClosedError(f'{self.name} is closed')
+            self._ensure_started()
+            for item in items:
+                future = Future()
+                self._queue.put((item, future))
+                futures.append(future)
+        return futures
+
+    def map(self, items: Sequence[Any]) -> List[Any]:
+        """
+        Обрабатывает элементы в общих батчах и дожидается результатов.
+
+        Args:
+            items (Sequence): Элементы для обработки
+
+        Returns:
+            List: Результаты в порядке элементов
+        """
+
+        return [future.result() for future in self.submit(items)]
+
+    def _collect(self) -> tuple[list, bool]:
+        """
+        Returns:
+            tuple: (батч, получен ли сигнал остановки)
+        """
+
+        entry = self._queue.get()
+        if entry[0] is _STOP:
+            return [], True
+        batch = [entry]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry[0] is _STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self) -> None:
+        while True:
+            batch, stop = self._collect()
+            if batch:
+                self._process(batch)
+            if stop:
+                self.fn = None
+                return
+
+    def _process(self, batch: list) -> None:
+        futures = [future for _, future in batch]
+        try:
+            results = self.fn([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f'{self.name}: {len(results)} results for batch of {len(batch)}')
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+
+class BatchingMixin:
+    """
+    Дает моделям метод _batched - обработку элементов через общий для всех потоков DynamicBatcher.
+    Для каждого ключа создается свой батчер, ключ должен включать все параметры, от которых зависит fn.
+    """
+
+    _batchers_lock = threading.Lock()
+
+    def _batched(self, key: Hashable, fn: Callable[[List[Any]], Sequence[Any]], items: Sequence[Any]) -> List[Any]:
+        """
+        Args:
+            key (Hashable): Ключ батчера
+            fn (Callable): Обработка батча, используется при создании батчера для ключа
+            items (Sequence): Элементы для обработки
+
+        Returns:
+            List: Результаты в порядке элементов
+        """
+
+        return [future.result() for future in self._batched_submit(key, fn, items)]
+
+    def _batched_submit(self,
+                        key: Hashable,
+                        fn: Callable[[List[Any]], Sequence[Any]],
+                        items: Sequence[Any]) -> List[Future]:
+        """
+        То же, что _batched, но не дожидается результатов: позволяет одновременно
+        отправить элементы в батчеры разных моделей.
+
+        Returns:
+            List[Future]: Future с результатом для каждого элемента
+        """
+
+        batching_settings = settings['batching']
+        if not batching_settings['enabled'] or not items:
+            return self._run_unbatched(fn, items)
+
+        batchers = self.__dict__.get('_batchers')
+        if batchers is None or key not in batchers:
+            with self._batchers_lock:
+                if self.__dict__.get('_batchers_closed'):
+                    return self._run_unbatched(fn, items)
+                batchers = self.__dict__.setdefault('_batchers', {})
+                if key not in batchers:
+                    batchers[key] = DynamicBatcher(
+                        fn=fn,
+                        max_batch_size=batching_settings['max_batch_size'],
+                        max_wait=batching_settings['max_wait'],
+                        name=f'{type(self).__name__}-{key}',
+                    )
+        try:
+            return batchers[key].submit(items)
+        except BatcherClosedError:
+            # батчеры закрыты между получением батчера и подачей элементов
+            return self._run_unbatched(fn, items)
+
+    @staticmethod
+    def _run_unbatched(fn: Callable[[List[Any]], Sequence[Any]], items: Sequence[Any]) -> List[Future]:
+        futures = []
+        for result in fn(list(items)):
+            future = Future()
+            future.set_result(result)
+            futures.append(future)
+        return futures
+
+    def close_batchers(self) -> None:
+        """
+        Закрывает все батчеры модели: их рабочие потоки перестают держать ссылку на модель.
+        Вызывается при выгрузке модели из реестра. Задачи, которые еще используют модель,
+        дальше обрабатывают элементы без батчера, новые батчеры не создаются.
+        """
+
+        with self._batchers_lock:
+            self.__dict__['_batchers_closed'] = True
+            batchers = self.__dict__.pop('_batchers', {})
+        for batcher in batchers.values():
+            batcher.close()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Any, Optional
+
+from nnmodel.nn.nnmodel import settings
+from nnmodel.nn.registry import weight_paths
+
+_weights_digests = {}  # {путь: ((размер, mtime), sha256)}
+_weights_lock = threading.Lock()
+
+
+def file_digest(path: str) -> str:
+    """
+    sha256 файла (весов, конфигурации трекера). Результат запоминается, пока не изменились размер и время изменения файла.
+    """
+
+    stat = os.stat(path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    with _weights_lock:
+        cached = _weights_digests.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    with _weights_lock:
+        _weights_digests[path] = (version, h.hexdigest())
+    return h.hexdigest()
+
+
+def models_digest() -> str:
+    """
+    Дайджест весов всех моделей из settings: смена любых весов меняет ключи кэша.
+    """
+
+    h = hashlib.sha256()
+    for model_type in ('detection', 'segmentation', 'classification'):
+        for path in weight_paths(settings[model_type]):
+            h.update(str(path).encode())
+            h.update(file_digest(path).encode() if os.path.exists(path) else b'missing')
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Кэш результатов инференса на диске, адресуемый содержимым.
+
+    Ключ - sha256 от дайджеста кадров исследования, весов моделей и параметров инференса.
+    Каждая запись - отдельный pickle файл, время изменения файла обновляется при чтении;
+    при превышении max_bytes удаляются записи, которые дольше всего не читались.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        """
+        Args:
+            directory (Path): Каталог кэша
+            max_bytes (int): Максимальный суммарный размер записей
+        """
+
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def key(self, content_digest: str, params: dict) -> str:
+        """
+        Args:
+            content_digest (str): Дайджест хранимых кадров исследования
+            params (dict): Параметры инференса
+
+        Returns:
+            str: Ключ записи
+        """
+
+        h = hashlib.sha256()
+        h.update(content_digest.encode())
+        h.update(models_digest().encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f'{key}.pkl'
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f'Broken result cache entry {path}: {e}')
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self._shrink()
+
+    def _shrink(self) -> None:
+        with self._lock:
+            entries = []
+            for path in self.directory.glob('*/*.pkl'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
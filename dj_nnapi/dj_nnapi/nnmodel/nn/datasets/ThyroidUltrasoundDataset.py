@@ -1,8 +1,9 @@
 from PIL import Image
-import copy
 import numpy as np
 from torch.utils.data import Dataset
 
+from ..loaders.frame_reader import FrameReaderABC, open_frame_reader
+
 
 class ThyroidUltrasoundDataset(Dataset):
     """
@@ -10,112 +11,177 @@ class ThyroidUltrasoundDataset(Dataset):
 
     Загружает изображения (в т.ч. многокадровые), обрезает нерелевантные области и
     предоставляет доступ к обработанным изображениям через PyTorch Dataset интерфейс.
+
+    В ленивом режиме (lazy=True) кадры не хранятся в памяти: окно обрезки считается
+    первым проходом по кадрам в оттенках серого, а RGB кадры декодируются и обрезаются
+    при обращении к ним, поэтому потребление памяти не зависит от числа кадров.
     """
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, lazy: bool = False, crop_step: int = 1, reader: FrameReaderABC = None) -> None:
+        """
+        Args:
+            path (str): Путь к изображению
+            lazy (bool): Не хранить кадры в памяти
+            crop_step (int): Окно обрезки считается по каждому crop_step-му кадру
+            reader (FrameReaderABC): Уже открытый open_frame_reader(path), иначе открывается заново
+        """
+
         print('Image processing started...')
         self.path = path
+        self.lazy = lazy
         self.initial_width = None
         self.initial_height = None
-        self.images = []  # list of PIL images
         self.crop_coordinates = {}
-        self.cropped_images = []  # list of RGB numpy arrays
+        self.cropped_images = []  # list of RGB numpy arrays (только в обычном режиме)
         self.cropped_width = None
         self.cropped_height = None
-
-        x_cut_min_list = []
-        x_cut_max_list = []
-        y_cut_min_list = []
-        y_cut_max_list = []
-
-        image = Image.open(self.path)
-        self.initial_width, self.initial_height = image.size
-        print(image.size)
-        i = 0
-        while True:
-            try:
-                image.seek(i)
-                current_image = copy.deepcopy(image)
-                self.images.append(current_image)
-                x_cut_min, x_cut_max, y_cut_min, y_cut_max = self.irrelevant_region_coords(current_image)
-                x_cut_min_list.append(x_cut_min)
-                x_cut_max_list.append(x_cut_max)
-                y_cut_min_list.append(y_cut_min)
-                y_cut_max_list.append(y_cut_max)
-                i += 1
-            except EOFError:
-                break
-
-        self.crop_coordinates['x_cut_min'] = min(x_cut_min_list)
-        self.crop_coordinates['x_cut_max'] = max(x_cut_max_list)
-        self.crop_coordinates['y_cut_min'] = min(y_cut_min_list)
-        self.crop_coordinates['y_cut_max'] = max(y_cut_max_list)
+        self._content_digest = None
+
+        self._reader = reader if reader is not None else open_frame_reader(self.path)
+        self.initial_width, self.initial_height = self._reader.size
+        print(self._reader.size)
+        crop_step = max(1, crop_step)
+
+        frames = []
+        # окно обрезки могло быть посчитано при загрузке исследования
+        precomputed_crop = self._reader.crop_window(crop_step)
+        if self.lazy and precomputed_crop is not None:
+            x_cut_min, x_cut_max, y_cut_min, y_cut_max = precomputed_crop
+        elif self.lazy:
+            # Первый проход: для окна обрезки достаточно сумм по строкам и столбцам кадров
+            row_sums = []
+            col_sums = []
+            for i in range(0, len(self._reader), crop_step):
+                grey_img = self._reader.read_grey(i)
+                row_sums.append(grey_img.sum(axis=1, dtype=np.uint32))
+                col_sums.append(grey_img.sum(axis=0, dtype=np.uint32))
+            x_cut_min, x_cut_max, y_cut_min, y_cut_max = self.crop_window_from_sums(
+                np.stack(row_sums), np.stack(col_sums))
+        else:
+            grey_stack = None
+            if precomputed_crop is None:
+                grey_stack = np.empty(shape=(len(range(0, len(self._reader), crop_step)), self.initial_height,
+                                             self.initial_width), dtype=np.uint8)
+            for i in range(len(self._reader)):
+                frames.append(self._reader.read(i))
+                if i % crop_step == 0 and precomputed_crop is None:
+                    grey_stack[i // crop_step] = self._reader.read_grey(i)
+            if precomputed_crop is not None:
+                x_cut_min, x_cut_max, y_cut_min, y_cut_max = precomputed_crop
+            else:
+                x_cut_min, x_cut_max, y_cut_min, y_cut_max = self.crop_window(grey_stack)
+            del grey_stack
+
+        self.crop_coordinates['x_cut_min'] = x_cut_min
+        self.crop_coordinates['x_cut_max'] = x_cut_max
+        self.crop_coordinates['y_cut_min'] = y_cut_min
+        self.crop_coordinates['y_cut_max'] = y_cut_max
         print(
             f'Final crop coordinates: {self.crop_coordinates["x_cut_min"]} {self.crop_coordinates["x_cut_max"]} {self.crop_coordinates["y_cut_min"]} {self.crop_coordinates["y_cut_max"]}')
 
-        for img in self.images:
-            rgb_img = img.convert('RGB')
-            img_array = np.array(rgb_img)
-            img_array = img_array[
-                        self.crop_coordinates['x_cut_min']:self.crop_coordinates['x_cut_max'],
-                        self.crop_coordinates['y_cut_min']:self.crop_coordinates['y_cut_max']
-                        ]
-            self.cropped_images.append(img_array.astype(np.uint8))
+        for img_array in frames:
+            self.cropped_images.append(self._crop(img_array))
+        del frames
 
-        self.cropped_width = self.cropped_images[0].shape[1]
-        self.cropped_height = self.cropped_images[0].shape[0]
+        self.cropped_width = self.crop_coordinates['y_cut_max'] - self.crop_coordinates['y_cut_min']
+        self.cropped_height = self.crop_coordinates['x_cut_max'] - self.crop_coordinates['x_cut_min']
 
         print(f'Original image processed!')
 
     def __len__(self) -> int:
-        return len(self.cropped_images)
+        return len(self._reader)
 
     def __getitem__(self, idx: int) -> np.ndarray:
+        if self.lazy:
+            return self._crop(self._reader.read(idx))
         current_image = self.cropped_images[idx]
         return current_image
 
+    def content_digest(self) -> str:
+        """
+        sha256 хранимых байтов кадров исходного изображения (файла, покадрового хранилища
+        или декодированных кадров). Кадры для этого не декодируются, в т.ч. в ленивом режиме.
+
+        Returns:
+            str: Дайджест в шестнадцатеричном виде
+        """
+
+        if self._content_digest is None:
+            self._content_digest = self._reader.content_digest()
+        return self._content_digest
+
+    def _crop(self, img_array: np.ndarray) -> np.ndarray:
+        img_array = img_array[
+                    self.crop_coordinates['x_cut_min']:self.crop_coordinates['x_cut_max'],
+                    self.crop_coordinates['y_cut_min']:self.crop_coordinates['y_cut_max']
+                    ]
+        return img_array.astype(np.uint8)
+
     @staticmethod
-    def irrelevant_region_coords(img: Image.Image) -> tuple[int, int, int, int]:
+    def crop_window_from_sums(row_sums: np.ndarray, col_sums: np.ndarray) -> tuple[int, int, int, int]:
         """
-        Определяет координаты для обрезки нерелевантных областей изображения.
+        Определяет общее для всех кадров окно обрезки по суммам яркости строк и столбцов.
+
+        Для каждого кадра ищутся тёмные (средняя яркость <= 5) строки и столбцы у краёв,
+        после чего границы объединяются по всем кадрам. Все вычисления векторизованы по кадрам.
 
         Args:
-            img (Image.Image): Входное PIL изображение
+            row_sums (np.ndarray): Суммы яркости по строкам кадров, форма (N, H)
+            col_sums (np.ndarray): Суммы яркости по столбцам кадров, форма (N, W)
 
         Returns:
             tuple[int, int, int, int]: Кортеж с координатами обрезки
                                      (min_row, max_row, min_col, max_col)
         """
 
-        grey_img = img.convert(mode='L')
-        grey_img_array = np.array(grey_img)
-        or_shape = grey_img_array.shape
-        value_x = np.mean(grey_img, 1)
-        value_y = np.mean(grey_img, 0)
-        x_hold_range = list((len(value_x) * np.array([0.8 / 3, 2.2 / 3])).astype(np.int_))
-        y_hold_range = list((len(value_y) * np.array([0.8 / 3, 1.8 / 3])).astype(np.int_))
         value_thresold = 5
-        x_cut = np.argwhere((value_x <= value_thresold) == True)
-        x_cut_min = list(x_cut[x_cut <= x_hold_range[0]])
-        if x_cut_min:
-            x_cut_min = max(x_cut_min)
-        else:
-            x_cut_min = 0
-        x_cut_max = list(x_cut[x_cut >= x_hold_range[1]])
-        if x_cut_max:
-            x_cut_max = min(x_cut_max)
-        else:
-            x_cut_max = or_shape[0]
-        y_cut = np.argwhere((value_y <= value_thresold) == True)
-        y_cut_min = list(y_cut[y_cut <= y_hold_range[0]])
-        if y_cut_min:
-            y_cut_min = max(y_cut_min)
-        else:
-            y_cut_min = 0
-        y_cut_max = list(y_cut[y_cut >= y_hold_range[1]])
-        if y_cut_max:
-            y_cut_max = min(y_cut_max)
-        else:
-            y_cut_max = or_shape[1]
+        height = row_sums.shape[1]
+        width = col_sums.shape[1]
+        x_hold_range = list((height * np.array([0.8 / 3, 2.2 / 3])).astype(np.int_))
+        y_hold_range = list((width * np.array([0.8 / 3, 1.8 / 3])).astype(np.int_))
+
+        # средняя яркость <= порога  <=>  сумма <= порог * длина, без перехода к float
+        x_dark = row_sums <= value_thresold * width
+        y_dark = col_sums <= value_thresold * height
+        x_idx = np.arange(height)
+        y_idx = np.arange(width)
+
+        x_cut_min = np.where(x_dark & (x_idx <= x_hold_range[0]), x_idx, 0).max(axis=1).min()
+        x_cut_max = np.where(x_dark & (x_idx >= x_hold_range[1]), x_idx, height).min(axis=1).max()
+        y_cut_min = np.where(y_dark & (y_idx <= y_hold_range[0]), y_idx, 0).max(axis=1).min()
+        y_cut_max = np.where(y_dark & (y_idx >= y_hold_range[1]), y_idx, width).min(axis=1).max()
+
+        return int(x_cut_min), int(x_cut_max), int(y_cut_min), int(y_cut_max)
+
+    @classmethod
+    def crop_window(cls, frames: np.ndarray, step: int = 1) -> tuple[int, int, int, int]:
+        """
+        Определяет окно обрезки нерелевантных областей для стека кадров.
+
+        Args:
+            frames (np.ndarray): Кадры в оттенках серого, uint8 массив формы (N, H, W)
+            step (int): Учитывать только каждый step-й кадр
+
+        Returns:
+            tuple[int, int, int, int]: Кортеж с координатами обрезки
+                                     (min_row, max_row, min_col, max_col)
+        """
+
+        frames = frames[::max(1, step)]
+        return cls.crop_window_from_sums(frames.sum(axis=2, dtype=np.uint32), frames.sum(axis=1, dtype=np.uint32))
+
+    @classmethod
+    def irrelevant_region_coords(cls, img: Image.Image | np.ndarray) -> tuple[int, int, int, int]:
+        """
+        Определяет координаты для обрезки нерелевантных областей изображения.
+
+        Args:
+            img (Image.Image | np.ndarray): Входное PIL изображение или кадр в оттенках серого
+
+        Returns:
+            tuple[int, int, int, int]: Кортеж с координатами обрезки
+                                     (min_row, max_row, min_col, max_col)
+        """
 
-        return x_cut_min, x_cut_max, y_cut_min, y_cut_max  # Actually return min_row, max_row, min_col, max_col
+        grey_img = img.convert(mode='L') if isinstance(img, Image.Image) else img
+        return cls.crop_window(np.array(grey_img, dtype=np.uint8)[None])
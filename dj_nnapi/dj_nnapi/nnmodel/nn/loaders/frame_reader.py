@@ -0,0 +1,326 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+import hashlib
+import json
+import threading
+
+import numpy as np
+from PIL import Image
+
+from ..nnmodel import settings
+from .frame_store import DATA_NAME, INDEX_NAME, FrameStore, open_frame_store
+
+
+def _files_digest(*paths) -> str:
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FrameReaderABC(ABC):
+    """
+    Покадровый доступ к (многокадровому) изображению.
+    Кадры декодируются по запросу, в памяти одновременно держится только читаемый кадр.
+    """
+
+    @property
+    @abstractmethod
+    def size(self) -> tuple[int, int]:
+        """Размер кадра (ширина, высота)"""
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def read(self, idx: int) -> np.ndarray:
+        """Кадр idx в виде RGB uint8 массива (H, W, 3)"""
+        ...
+
+    @abstractmethod
+    def read_grey(self, idx: int) -> np.ndarray:
+        """Кадр idx в оттенках серого, uint8 массив (H, W)"""
+        ...
+
+    @abstractmethod
+    def content_digest(self) -> str:
+        """sha256 хранимых байтов кадров: меняется вместе с кадрами, кадры при этом не декодируются"""
+        ...
+
+    def crop_window(self, crop_step: int) -> Optional[tuple[int, int, int, int]]:
+        """Окно обрезки, заранее посчитанное по каждому crop_step-му кадру, или None"""
+        return None
+
+
+class PilFrameReader(FrameReaderABC):
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._image = Image.open(path)
+        self._len = getattr(self._image, "n_frames", 1)
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self._image.size
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _convert(self, idx: int, mode: str) -> np.ndarray:
+        if not 0 <= idx < self._len:
+            raise IndexError(idx)
+        with self._lock:
+            self._image.seek(idx)
+            return np.array(self._image.convert(mode))
+
+    def read(self, idx: int) -> np.ndarray:
+        return self._convert(idx, "RGB")
+
+    def read_grey(self, idx: int) -> np.ndarray:
+        return self._convert(idx, "L")
+
+    def content_digest(self) -> str:
+        return _files_digest(self._path)
+
+
+class FrameStoreReader(FrameReaderABC):
+    """
+    Чтение из покадрового хранилища: распаковывается только запрошенный кадр.
+    Преобразование в RGB и оттенки серого - то же, что у PilFrameReader (PIL convert)
+    """
+
+    def __init__(self, store: FrameStore) -> None:
+        self._store = store
+        height, width = self._store.shape[:2]
+        self._size = (width, height)
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def read(self, idx: int) -> np.ndarray:
+        frame = self._store[idx]
+        if frame.dtype == np.uint8 and frame.ndim == 3 and frame.shape[2] == 3:
+            return frame
+        return np.array(Image.fromarray(frame).convert("RGB"))
+
+    def read_grey(self, idx: int) -> np.ndarray:
+        return np.array(Image.fromarray(self._store[idx]).convert("L"))
+
+    def content_digest(self) -> str:
+        return _files_digest(self._store.directory / INDEX_NAME, self._store.directory / DATA_NAME)
+
+
+class NpyFrameReader(FrameReaderABC):
+    """
+    Декодированные при загрузке RGB кадры (main.npy), отображенные в память,
+    и посчитанное тогда же окно обрезки (main.crop.json), которые пишет medweb
+    (medml.decoded_cache). read возвращает кадр без копирования.
+    Метаданные другого формата или версии - ValueError.
+    """
+
+    FRAMES_SUFFIX = ".npy"
+    META_SUFFIX = ".crop.json"
+    FORMAT = "uzi-decoded-frames"
+    VERSION = 1
+
+    def __init__(self, frames_path: Path, meta_path: Path) -> None:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (meta.get("format"), meta.get("version")) != (self.FORMAT, self.VERSION):
+            raise ValueError(f"Unsupported decoded frames {meta_path}: {meta.get('format')}/{meta.get('version')}")
+        self._crop_step = meta["crop_step"]
+        self._crop = tuple(meta["crop"]) if meta["crop"] is not None else None
+        self._frames_path = frames_path
+        self._frames = np.load(frames_path, mmap_mode="r")
+
+    @classmethod
+    def paths(cls, path: str) -> tuple[Path, Path]:
+        path = Path(path)
+        return path.with_suffix(cls.FRAMES_SUFFIX), path.with_suffix(cls.META_SUFFIX)
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        # метаданные пишутся последними: есть метаданные - кадры записаны целиком
+        return all(p.exists() for p in cls.paths(path))
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self._frames.shape[2], self._frames.shape[1]
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def read(self, idx: int) -> np.ndarray:
+        # обычный ndarray поверх отображенной памяти, а не np.memmap
+        return np.asarray(self._frames[idx])
+
+    def read_grey(self, idx: int) -> np.ndarray:
+        return np.array(Image.fromarray(self.read(idx)).convert("L"))
+
+    def content_digest(self) -> str:
+        return _files_digest(self._frames_path)
+
+    def crop_window(self, crop_step: int) -> Optional[tuple[int, int, int, int]]:
+        return self._crop if crop_step == self._crop_step else None
+
+
+class DicomFrameReader(FrameReaderABC):
+    """
+    Покадровое чтение (многокадрового) DICOM без конвертации в TIFF.
+
+    Набор данных разбирается один раз при открытии. Несжатые кадры остаются в файле
+    (defer_size): декодер pydicom читает из открытого файла только запрошенный кадр.
+    Сжатые фрагменты читаются в память при открытии, кадр находится по Basic/Extended
+    Offset Table. Для сжатых синтаксисов передачи следующие кадры распаковываются заранее
+    в общем пуле потоков: шаг упреждения равен шагу между последними запрошенными кадрами,
+    поэтому работает и для прохода с crop_step. Преобразование в RGB и оттенки серого -
+    как у FrameStoreReader.
+
+    medweb пишет в main.tiff pixel_array без LUT модальности и VOI, поэтому читаются
+    только 8-битные беззнаковые кадры без этих LUT, для которых значения пикселей и есть
+    яркость. Для остальных конструктор бросает ValueError, open_frame_reader читает main.tiff.
+    """
+
+    PHOTOMETRIC = ("MONOCHROME2", "RGB", "YBR_FULL", "YBR_FULL_422", "YBR_ICT", "YBR_RCT")
+    LUT_KEYWORDS = ("ModalityLUTSequence", "VOILUTSequence", "WindowCenter", "WindowWidth")
+    DEFER_SIZE = 1024
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, path: Path, prefetch: int = None) -> None:
+        import pydicom
+        from pydicom.pixels import as_pixel_options, get_decoder
+
+        self._path = str(path)
+        ds = pydicom.dcmread(self._path, defer_size=self.DEFER_SIZE)
+        transfer_syntax = ds.file_meta.TransferSyntaxUID
+        pixel_data = ds.get_item("PixelData", keep_deferred=True)
+        unsupported = self._unsupported(ds)
+        if pixel_data is None or transfer_syntax.is_deflated or unsupported:
+            raise ValueError(f"Unsupported DICOM pixel data {self._path}: "
+                             f"{unsupported or transfer_syntax.name}")
+
+        try:
+            self._decoder = get_decoder(transfer_syntax)
+        except NotImplementedError as e:
+            raise ValueError(f"Unsupported DICOM pixel data {self._path}: {e}") from e
+        self._options = as_pixel_options(ds, transfer_syntax_uid=transfer_syntax, pixel_keyword="PixelData")
+        if pixel_data.VR is not None:
+            self._options["pixel_vr"] = pixel_data.VR
+        self._size = (int(ds.Columns), int(ds.Rows))
+        self._len = int(self._options["number_of_frames"])
+        if transfer_syntax.is_encapsulated:
+            self._source = ds.PixelData
+            self._file = None
+        else:
+            self._source = pixel_data.value_tell
+            self._file = open(self._path, "rb")
+        self._file_lock = threading.Lock()
+
+        workers = settings["dicom_decode_workers"]
+        compressed = transfer_syntax.is_compressed
+        self._prefetch = (2 * workers if prefetch is None else prefetch) if compressed and workers > 1 else 0
+        self._pending: dict[int, Future] = {}
+        self._last_idx = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _unsupported(cls, ds) -> Optional[str]:
+        """Почему кадры нельзя читать напрямую, или None"""
+        if int(ds.BitsAllocated) != 8 or int(ds.get("PixelRepresentation", 0)) != 0:
+            return f"{ds.BitsAllocated}-bit, PixelRepresentation {ds.get('PixelRepresentation', 0)}"
+        if ds.PhotometricInterpretation not in cls.PHOTOMETRIC:
+            return ds.PhotometricInterpretation
+        luts = [keyword for keyword in cls.LUT_KEYWORDS if keyword in ds]
+        if float(ds.get("RescaleSlope", 1)) != 1 or float(ds.get("RescaleIntercept", 0)) != 0:
+            luts.append("Rescale")
+        return ", ".join(luts) or None
+
+    @classmethod
+    def _get_pool(cls) -> ThreadPoolExecutor:
+        if cls._pool is None:
+            with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = ThreadPoolExecutor(max_workers=settings["dicom_decode_workers"],
+                                                   thread_name_prefix="dicom-decode")
+        return cls._pool
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self._size
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _decode(self, idx: int) -> np.ndarray:
+        if self._file is None:
+            frame, _ = self._decoder.as_array(self._source, index=idx, **self._options)
+        else:
+            with self._file_lock:
+                self._file.seek(self._source)
+                frame, _ = self._decoder.as_array(self._file, index=idx, **self._options)
+        if frame.dtype == np.uint8 and frame.ndim == 3 and frame.shape[2] == 3:
+            return frame
+        return np.array(Image.fromarray(frame).convert("RGB"))
+
+    def read(self, idx: int) -> np.ndarray:
+        if not 0 <= idx < self._len:
+            raise IndexError(idx)
+        if not self._prefetch:
+            return self._decode(idx)
+
+        with self._lock:
+            future = self._pending.pop(idx, None)
+            if future is None:
+                future = self._get_pool().submit(self._decode, idx)
+            step = idx - self._last_idx if self._last_idx is not None and idx > self._last_idx else 1
+            self._last_idx = idx
+            ahead = range(idx + step, min(self._len, idx + step * (self._prefetch + 1)), step)
+            # кадры вне окна упреждения больше не понадобятся при последовательном чтении
+            for stale in [i for i in self._pending if i not in ahead]:
+                self._pending.pop(stale).cancel()
+            for i in ahead:
+                if i not in self._pending:
+                    self._pending[i] = self._get_pool().submit(self._decode, i)
+        return future.result()
+
+    def read_grey(self, idx: int) -> np.ndarray:
+        return np.array(Image.fromarray(self.read(idx)).convert("L"))
+
+    def content_digest(self) -> str:
+        return _files_digest(self._path)
+
+
+def open_frame_reader(path: str) -> FrameReaderABC:
+    """
+    Декодированные при загрузке кадры или покадровое хранилище рядом с файлом,
+    если они есть, иначе сам файл
+    """
+    if NpyFrameReader.exists(path):
+        try:
+            return NpyFrameReader(*NpyFrameReader.paths(path))
+        except ValueError as e:
+            print(e)
+    store = open_frame_store(path)
+    if store is not None:
+        return FrameStoreReader(store)
+    if Path(path).suffix.lower() == ".dcm":
+        try:
+            return DicomFrameReader(Path(path))
+        except ValueError as e:
+            # medweb пишет канонический TIFF рядом: <имя файла>/main.tiff
+            tiff_path = Path(path).with_suffix("") / "main.tiff"
+            print(f"{e}, reading {tiff_path}")
+            return open_frame_reader(str(tiff_path))
+    return PilFrameReader(Path(path))
@@ -0,0 +1,94 @@
+"""
+Чтение покадрового хранилища исследования (каталог main.frames рядом с main.tiff),
+которое пишет medweb (medml.frame_store); формат должен совпадать,
+index.json начинается с {"format": "uzi-frame-store", "version": 1, ...}.
+
+Кадры сжаты zlib каждый отдельно и записаны подряд в frames.bin, index.json хранит
+форму и тип кадра и смещения сжатых кадров. frames.bin отображается в память,
+при чтении распаковывается только нужный кадр.
+"""
+import json
+import mmap
+import zlib
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+FORMAT = "uzi-frame-store"
+VERSION = 1
+INDEX_NAME = "index.json"
+DATA_NAME = "frames.bin"
+STORE_SUFFIX = ".frames"
+
+
+def frame_store_path(tiff_path) -> Path:
+    """
+    Каталог хранилища для канонического TIFF (main.tiff -> main.frames)
+    """
+    return Path(tiff_path).with_suffix(STORE_SUFFIX)
+
+
+def has_frame_store(tiff_path) -> bool:
+    return (frame_store_path(tiff_path) / INDEX_NAME).exists()
+
+
+def open_frame_store(tiff_path) -> Optional["FrameStore"]:
+    """
+    Хранилище канонического TIFF или None, если его нет или его формат (format/version
+    в index.json) не поддерживается - тогда кадры читаются из самого TIFF
+    """
+    if not has_frame_store(tiff_path):
+        return None
+    try:
+        return FrameStore(frame_store_path(tiff_path))
+    except ValueError as e:
+        print(e)
+        return None
+
+
+class FrameStore:
+    """
+    Чтение кадров хранилища по номеру
+    """
+
+    def __init__(self, directory) -> None:
+        directory = Path(directory)
+        with open(directory / INDEX_NAME) as f:
+            index = json.load(f)
+        header = (index.get("format"), index.get("version"), index.get("codec"))
+        if header != (FORMAT, VERSION, "zlib"):
+            raise ValueError(f"Unsupported frame store {directory}: {'/'.join(map(str, header))}")
+        self.directory = directory
+        self.shape = tuple(index["shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self._offsets = index["offsets"]
+        self._count = index["count"]
+        with open(directory / DATA_NAME, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._offsets[-1] else b""
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError(idx)
+        with memoryview(self._data) as data:
+            raw = zlib.decompress(data[self._offsets[idx]:self._offsets[idx + 1]])
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.shape)
+
+    def __iter__(self):
+        for idx in range(self._count):
+            yield self[idx]
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self) -> "FrameStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -6,6 +6,8 @@ from PIL import Image
 import pydicom
 from tifffile import imread
 
+from .frame_store import open_frame_store
+
 
 class ImgLoaderABC(ABC):
     @abstractmethod
@@ -15,6 +17,10 @@ class ImgLoaderABC(ABC):
 
 class TiffLoader(ImgLoaderABC):
     def load(self, base_path: Path) -> Iterable:
+        store = open_frame_store(base_path)
+        if store is not None:
+            # кадры распаковываются только при обращении к ним
+            return store
         try:
             images = []
             image = Image.open(base_path)
@@ -0,0 +1,95 @@
+from collections.abc import Sequence
+from typing import Iterator, List
+
+import cv2
+import numpy as np
+
+
+class SparseMask:
+    """
+    Маска узла, хранящая только область ROI: bool кроп и его смещение в кадре.
+    Маска размера кадра строится только по запросу (to_dense).
+    """
+
+    __slots__ = ('crop', 'y', 'x', 'height', 'width')
+
+    def __init__(self, crop: np.ndarray, y: int, x: int, height: int, width: int) -> None:
+        """
+        Args:
+            crop (np.ndarray): bool маска области ROI
+            y (int): Строка кадра, с которой начинается кроп
+            x (int): Столбец кадра, с которого начинается кроп
+            height (int): Высота кадра
+            width (int): Ширина кадра
+        """
+
+        self.crop = crop.astype(bool, copy=False)
+        self.y = y
+        self.x = x
+        self.height = height
+        self.width = width
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.height, self.width
+
+    def shifted(self, dy: int, dx: int, height: int, width: int) -> 'SparseMask':
+        """
+        Та же маска в системе координат большего кадра (например, исходного кадра до обрезки).
+        """
+
+        return SparseMask(self.crop, self.y + dy, self.x + dx, height, width)
+
+    def any(self) -> bool:
+        return bool(self.crop.any())
+
+    def paste(self, dense: np.ndarray) -> np.ndarray:
+        """
+        Записывает маску в массив размера кадра (логическое ИЛИ с его содержимым).
+        """
+
+        view = dense[self.y:self.y + self.crop.shape[0], self.x:self.x + self.crop.shape[1]]
+        view[self.crop] = 1
+        return dense
+
+    def to_dense(self, dtype=np.float32) -> np.ndarray:
+        return self.paste(np.zeros(shape=self.shape, dtype=dtype))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self.to_dense(np.float32 if dtype is None else dtype)
+
+    def find_contours(self, mode: int, method: int) -> tuple:
+        """
+        cv2.findContours по кропу в координатах кадра. Кроп дополняется нулевой рамкой,
+        поэтому контуры совпадают с контурами маски размера кадра.
+        """
+
+        padded = np.pad(self.crop, 1).astype(np.uint8) * 255
+        contours, _ = cv2.findContours(padded, mode, method, offset=(self.x - 1, self.y - 1))
+        return contours
+
+
+class FrameMasks(Sequence):
+    """
+    Итоговые маски кадров (объединение масок всех узлов кадра).
+    Маска кадра размера height × width строится при обращении к ней.
+    """
+
+    def __init__(self, rois_in_frames: List[list], height: int, width: int) -> None:
+        self.rois_in_frames = rois_in_frames
+        self.height = height
+        self.width = width
+
+    def __len__(self) -> int:
+        return len(self.rois_in_frames)
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        result_mask = np.zeros(shape=(self.height, self.width), dtype=np.float32)
+        for element in self.rois_in_frames[idx]:
+            if element[2] is not None:
+                element[2].paste(result_mask)
+        return result_mask
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for idx in range(len(self)):
+            yield self[idx]
@@ -1,17 +1,27 @@
+from typing import Callable, Iterator
+
+import numpy as np
+import yaml
 from torch.utils.data import Dataset
 from ultralytics import YOLO
 
 from nnmodel.nn.nnmodel import ModelABC, settings
+from nnmodel.nn.batching import BatchingMixin
 
-class DetectionTrackingModel(ModelABC):
+class DetectionTrackingModel(BatchingMixin, ModelABC):
     """
     Модель для детекции и трекинга узлов щитовидной железы на ультразвуковых изображениях
     """
 
+    tracker_config = 'my_tracker.yaml'
+
     def __init__(self, model_type: str) -> None:  # model_type='all'/'long'/'cross'
         super().__init__()
         self.model_type = model_type
         self.load(path=settings['detection'][self.model_type])
+        with open(self.tracker_config) as f:
+            # трек, не найденный на track_buffer кадрах подряд, трекер удаляет и больше не продолжает
+            self.track_buffer = int(yaml.safe_load(f)['track_buffer'])
 
     def load(self, path: str) -> None:
         self._model = YOLO(path)
@@ -101,12 +111,65 @@ class DetectionTrackingModel(ModelABC):
                                           save=True, project=result_dir)
             detection_results.append(current_results)
         else:
-            current_results = self._model(source=dataset[0], imgsz=image_size, conf=conf_det, iou=iou, single_cls=True,
-                                          save=None)
+            # Детекция без трекинга не хранит состояния, поэтому кадры разных задач детектируются общим батчем
+            current_results = self._batched(
+                ('detection', image_size, conf_det, iou),
+                lambda frames: self._model(source=frames, imgsz=image_size, conf=conf_det, iou=iou, single_cls=True,
+                                           save=None),
+                [dataset[0]]
+            )
             detection_results.append(current_results)
 
         return detection_results
 
+    def reset_tracker(self) -> None:
+        """
+        Сбрасывает состояние трекера (persist=True хранит его в модели между вызовами track),
+        чтобы треки исследования не продолжали треки предыдущего исследования.
+        """
+
+        predictor = getattr(self._model, 'predictor', None)
+        for tracker in getattr(predictor, 'trackers', None) or []:
+            tracker.reset()
+
+    def iter_detect_track(self,
+                          dataset: Dataset,
+                          image_size: int,
+                          batch_size: int,
+                          iou: float,
+                          save: bool,
+                          result_dir: str = None) -> Iterator[tuple[int, list, np.ndarray]]:
+        """
+        Пакетная детекция и трекинг узлов на последовательности изображений.
+
+        Кадры подаются в детектор пачками по batch_size (один прямой проход сети на пачку),
+        после чего трекер BoT-SORT обрабатывает боксы кадров пачки строго по порядку,
+        поэтому результат совпадает с покадровым вызовом track.
+
+        Args:
+            dataset (Dataset): Датасет с изображениями
+            image_size (int): Размер изображения для обработки
+            batch_size (int): Количество кадров в одном прямом проходе детектора
+            iou (float): Порог IoU для подавления немаксимумов
+            save (bool): Флаг сохранения результатов
+            result_dir (str, optional): Директория для сохранения результатов
+
+        Yields:
+            tuple[int, list, np.ndarray]: Номер кадра, результаты детекции и трекинга для него
+                                          и сам кадр, чтобы не получать его из датасета повторно
+                                          (в ленивом режиме это новое декодирование)
+        """
+
+        self.reset_tracker()
+        batch_size = max(1, batch_size)
+        save_kwargs = {'save': True, 'project': result_dir} if save else {'save': None}
+        for start in range(0, len(dataset), batch_size):
+            frames = [dataset[i] for i in range(start, min(start + batch_size, len(dataset)))]
+            chunk_results = self._model.track(source=frames, tracker=self.tracker_config, persist=True,
+                                              imgsz=image_size, iou=iou, single_cls=True, **save_kwargs)
+            for offset, (result, frame) in enumerate(zip(chunk_results, frames)):
+                yield start + offset, [result], frame
+
     def detect_track(self,
                      dataset: Dataset,
                      image_size: int,
@@ -129,20 +192,14 @@ class DetectionTrackingModel(ModelABC):
             list: Результаты детекции и трекинга
         """
 
-        tracking_results = []
-        if save:
-            for i in range(len(dataset)):
-                current_results = self._model.track(source=dataset[i], tracker='my_tracker.yaml', persist=True,
-                                                    imgsz=image_size, iou=iou, single_cls=True, save=True,
-                                                    project=result_dir)
-                tracking_results.append(current_results)
-        else:
-            for i in range(len(dataset)):
-                current_results = self._model.track(source=dataset[i], tracker='my_tracker.yaml', persist=True,
-                                                    imgsz=image_size, iou=iou, single_cls=True, save=None)
-                tracking_results.append(current_results)
-
-        return tracking_results
+        return [frame_results for _, frame_results, _ in self.iter_detect_track(
+            dataset=dataset,
+            image_size=image_size,
+            batch_size=batch_size,
+            iou=iou,
+            save=save,
+            result_dir=result_dir
+        )]
 
     def predict(self,
                 dataset: Dataset,
@@ -152,7 +209,9 @@ class DetectionTrackingModel(ModelABC):
                 iou: float,
                 roi_margin_percent: int,
                 save: bool,
-                result_dir: str = None) -> tuple:
+                result_dir: str = None,
+                on_frame: Callable[[int, int], None] = None,
+                on_nodule_final: Callable[[int, dict, list], None] = None) -> tuple:
         """
         Основной метод предсказания - выполняет детекцию и трекинг узлов.
 
@@ -165,6 +224,11 @@ class DetectionTrackingModel(ModelABC):
             roi_margin_percent (int): Процент отступа для ROI
             save (bool): Флаг сохранения результатов
             result_dir (str, optional): Директория для сохранения результатов
+            on_frame (Callable, optional): Вызывается с (число обработанных кадров, число кадров)
+                                           после каждого батча кадров
+            on_nodule_final (Callable, optional): Вызывается с (id узла, узел, ROI в кадрах), как только
+                                                  трек узла завершен: узел не встречался дольше track_buffer
+                                                  кадров (трекер его уже удалил) или кадры закончились
 
         Returns:
             tuple: Кортеж из (результаты, словарь узлов, список ROI в кадрах)
@@ -194,6 +258,7 @@ class DetectionTrackingModel(ModelABC):
             t_id = 0
             for i in range(len(detection_results)):  # Итерация по frames
                 current_rois_in_frame = []
+                frame = dataset[i]
 
                 if len(detection_results[i]) != 1:
                     print(f'Len(frame) == {len(detection_results[i])}, индекс: {i}')
@@ -208,7 +273,7 @@ class DetectionTrackingModel(ModelABC):
                             x1_new, y1_new, x2_new, y2_new = self.preprocessing(xyxy, roi_margin_percent,
                                                                                 cropped_image_width,
                                                                                 cropped_image_height)
-                            enlarged_roi = dataset[i][y1_new:y2_new, x1_new:x2_new, :]
+                            enlarged_roi = frame[y1_new:y2_new, x1_new:x2_new, :]
                             nodules[t_id] = self.make_nodule_dict(cropped_image_width, cropped_image_height)
                             nodules[t_id]["frame_numbers"].append(i)
                             nodules[t_id]["enlarged_rois"].append(enlarged_roi)
@@ -220,23 +285,27 @@ class DetectionTrackingModel(ModelABC):
                             t_id += 1
                 rois_in_frames.append(current_rois_in_frame)
 
+            if on_nodule_final is not None:
+                for t_id in nodules:
+                    on_nodule_final(t_id, nodules[t_id], rois_in_frames)
+
             print('Detection completed!')
 
             return detection_results, nodules, rois_in_frames
 
         else:
             print('Detection and tracking started...')
-            tracking_results = self.detect_track(
-                dataset=dataset,
-                image_size=image_size,
-                batch_size=batch_size,
-                iou=iou,
-                save=save,
-                result_dir=result_dir
-            )
-
-            print(f'Number of frames in tracking results: {len(tracking_results)}')
-            for i in range(len(tracking_results)):  # Итерация по frames
+            tracking_results = []
+            finalized = set()
+            for i, frame_results, frame in self.iter_detect_track(  # Итерация по frames
+                    dataset=dataset,
+                    image_size=image_size,
+                    batch_size=batch_size,
+                    iou=iou,
+                    save=save,
+                    result_dir=result_dir
+            ):
+                tracking_results.append(frame_results)
                 current_rois_in_frame = []
 
                 if len(tracking_results[i]) != 1:
@@ -255,7 +324,8 @@ class DetectionTrackingModel(ModelABC):
                                 x1_new, y1_new, x2_new, y2_new = self.preprocessing(xyxy, roi_margin_percent,
                                                                                     cropped_image_width,
                                                                                     cropped_image_height)
-                                enlarged_roi = dataset[i][y1_new:y2_new, x1_new:x2_new, :]
+                                # копия, чтобы ROI не удерживал в памяти весь кадр
+                                enlarged_roi = frame[y1_new:y2_new, x1_new:x2_new, :].copy()
                                 if t_id not in nodules:
                                     nodules[t_id] = self.make_nodule_dict(cropped_image_width, cropped_image_height)
                                 nodules[t_id]["frame_numbers"].append(i)
@@ -275,8 +345,25 @@ class DetectionTrackingModel(ModelABC):
                             else:
                                 print(f'Nodule id {t_id} is None (frame {i})')
 
+                    if getattr(dataset, 'lazy', False):
+                        # ленивый датасет декодирует кадры по запросу, результаты не должны удерживать кадры
+                        tracking_results[i][m].orig_img = None
+
                 rois_in_frames.append(current_rois_in_frame)
+                if on_frame is not None and ((i + 1) % batch_size == 0 or i + 1 == len(dataset)):
+                    on_frame(i + 1, len(dataset))
+
+                if on_nodule_final is not None:
+                    for t_id in [t_id for t_id in nodules if t_id not in finalized and
+                                 nodules[t_id]["frame_numbers"][-1] < i - self.track_buffer]:
+                        finalized.add(t_id)
+                        on_nodule_final(t_id, nodules[t_id], rois_in_frames)
 
+            if on_nodule_final is not None:
+                for t_id in [t_id for t_id in nodules if t_id not in finalized]:
+                    on_nodule_final(t_id, nodules[t_id], rois_in_frames)
+
+            print(f'Number of frames in tracking results: {len(tracking_results)}')
             print('Detection and tracking completed!')
 
             return tracking_results, nodules, rois_in_frames
@@ -1,12 +1,18 @@
 import os
 
 from ultralytics import YOLO
+from ultralytics.data.augment import classify_transforms
 from typing import Dict, List, Union, Any
+from PIL import Image
 import numpy as np
 import joblib
+import torch
 
 from nnmodel.nn.nnmodel import ModelABC, settings
-class ROIClassificationModel(ModelABC):
+from nnmodel.nn.batching import BatchingMixin
+
+
+class ROIClassificationModel(BatchingMixin, ModelABC):
     """
     Модель для классификации областей интереса (ROI) узлов щитовидной железы.
     """
@@ -53,8 +59,41 @@ class ROIClassificationModel(ModelABC):
         for p in ml_model_paths:
             self._ml_models.append(joblib.load(p))
 
-    def preprocessing(self) -> None:
-        pass
+    def preprocessing(self, roi: np.ndarray, image_size: int) -> torch.Tensor:
+        """
+        Приводит ROI к входу YOLO-классификаторов один раз для всех шести моделей.
+
+        Параметры:
+        ----------
+        roi : np.ndarray
+            Изображение ROI узла.
+        image_size : int
+            Размер входа классификаторов.
+
+        Возвращает:
+        ----------
+        torch.Tensor
+            Тензор (3, image_size, image_size) - то же, что строит ClassificationPredictor.
+        """
+
+        transforms = self.__dict__.setdefault('_transforms', {})
+        if image_size not in transforms:
+            transforms[image_size] = classify_transforms(image_size)
+        # YOLO считает numpy изображения BGR и переводит их в RGB - повторяем это преобразование
+        return transforms[image_size](Image.fromarray(np.ascontiguousarray(roi[..., ::-1])))
+
+    @staticmethod
+    def _cv_forward(model: YOLO, image_size: int, rois: List[torch.Tensor]) -> List[str]:
+        """
+        Классификация батча предобработанных ROI (в т.ч. собранного из разных задач) одной YOLO-моделью.
+
+        Возвращает:
+        ----------
+        List[str]
+            Имена предсказанных классов для каждого ROI.
+        """
+
+        return [model.names[int(r.probs.top1)] for r in model(source=torch.stack(rois), imgsz=image_size)]
 
     def predict_one_track(self, nodule: np.ndarray, image_size: int) -> str:
         """
@@ -73,42 +112,65 @@ class ROIClassificationModel(ModelABC):
             Предсказанный класс в формате 'TIRADSX' (X ∈ {1,2,3,4,5}).
         """
 
-        cv_preds = []
-        for model in self._cv_models:
-            result = model(source=nodule, imgsz=image_size)
-            if len(result) != 1:
-                print(f'Len(result) != 1 (= {len(result)})')
-            for r in result:
-                pred_class = r.probs.top1
-                cv_preds.append(self.names_numbers_dict[model.names[int(pred_class)]] - 2)
-        print(f'CV preds: {cv_preds}')
-
-        ml_preds = []
-        ml_pred1 = self._ml_models[0].predict([cv_preds]).item()
-        # print(ml_pred1)
-        ml_preds.append(ml_pred1)
+        return self.predict_batch(rois=[nodule], image_size=image_size)[0]
+
+    def predict_batch(self, rois: List[np.ndarray], image_size: int) -> List[str]:
+        """
+        Выполняет предсказание TIRADS-классов для ROI нескольких узлов за один проход:
+        каждая YOLO-модель получает весь набор ROI, каждая ML-модель вызывается один раз
+        на матрице признаков всех узлов.
+
+        Параметры:
+        ----------
+        rois : List[np.ndarray]
+            Изображения ROI узлов.
+        image_size : int
+            Размер изображения, до которого оно будет масштабировано перед подачей в YOLO.
+
+        Возвращает:
+        ----------
+        List[str]
+            Предсказанные классы в формате 'TIRADSX' в порядке rois.
+        """
+
+        tensors = [self.preprocessing(roi, image_size) for roi in rois]
+        # Все шесть моделей получают ROI сразу, у каждой свой батчер и рабочий поток
+        futures = [
+            self._batched_submit(
+                ('classification', model_idx, image_size),
+                lambda batch, model=model: self._cv_forward(model, image_size, batch),
+                tensors
+            )
+            for model_idx, model in enumerate(self._cv_models)
+        ]
+        cv_preds = np.array(
+            [[self.names_numbers_dict[future.result()] - 2 for future in model_futures] for model_futures in futures],
+            dtype=np.int64
+        ).T  # (n_nodules, 6)
+        print(f'CV preds: {cv_preds.tolist()}')
+
+        n_nodules = len(rois)
+        ml_pred1 = self._ml_models[0].predict(cv_preds)
 
         if self.model_type == 'all':
-            cv_preds_with_type10 = cv_preds + [10]
-            ml_pred2_0 = self._ml_models[1].predict([cv_preds_with_type10]).item()
-            cv_preds_with_type11 = cv_preds + [11]
-            ml_pred2_1 = self._ml_models[1].predict([cv_preds_with_type11]).item()
-            ml_pred2 = max(ml_pred2_0, ml_pred2_1)
+            # оба типа исследования (10 - cross, 11 - long) одним вызовом predict: (2 * n_nodules, 7)
+            cv_preds_with_types = np.concatenate([
+                np.column_stack([cv_preds, np.full(n_nodules, 10)]),
+                np.column_stack([cv_preds, np.full(n_nodules, 11)]),
+            ])
+            ml_pred2 = self._ml_models[1].predict(cv_preds_with_types).reshape(2, n_nodules).max(axis=0)
         else:
             if self.model_type == 'cross':
                 model_feature = 10
             elif self.model_type == 'long':
                 model_feature = 11
-            cv_preds_with_type = cv_preds + [model_feature]
-            ml_pred2 = self._ml_models[1].predict([cv_preds_with_type]).item()
-        # print(ml_pred2)
-        ml_preds.append(ml_pred2)
+            ml_pred2 = self._ml_models[1].predict(np.column_stack([cv_preds, np.full(n_nodules, model_feature)]))
 
-        print(f'ML preds: {ml_preds}')
-        ml_pred3 = self._ml_models[2].predict([ml_preds]).item()
-        # print(ml_pred3)
+        ml_preds = np.column_stack([ml_pred1, ml_pred2])  # (n_nodules, 2)
+        print(f'ML preds: {ml_preds.tolist()}')
+        ml_pred3 = self._ml_models[2].predict(ml_preds)
 
-        return self.numbers_names_dict[ml_pred3 + 2]
+        return [self.numbers_names_dict[int(pred) + 2] for pred in ml_pred3]
 
     def predict(self, nodules: Dict[str, Dict[str, Any]], image_size: int) -> Union[str, Dict[str, str]]:
         """
@@ -138,11 +200,10 @@ class ROIClassificationModel(ModelABC):
             print('TIRADS1\nClassification completed!')
             return 'TIRADS1'
         else:
-            for t_id in nodules:
-                print(f'Nodule (id = {t_id}):')
-                largest_roi_idx_in_enlarged_rois = nodules[t_id]["largest_roi_idx_in_enlarged_rois"]
-                pred_class = self.predict_one_track(
-                    nodule=nodules[t_id]["enlarged_rois"][largest_roi_idx_in_enlarged_rois], image_size=image_size)
-                nodule_class_dict[t_id] = pred_class
+            t_ids = list(nodules)
+            print(f'Nodules (ids = {t_ids})')
+            rois = [nodules[t_id]["enlarged_rois"][nodules[t_id]["largest_roi_idx_in_enlarged_rois"]] for t_id in t_ids]
+            pred_classes = self.predict_batch(rois=rois, image_size=image_size)
+            nodule_class_dict = dict(zip(t_ids, pred_classes))
             print(f'Final preds: {nodule_class_dict}\nClassification completed!')
             return nodule_class_dict
@@ -1,17 +1,18 @@
 import os
 import numpy as np
-from PIL import Image
 import torch
 from torch.utils.data import DataLoader
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 
 from nnmodel.nn.nnmodel import ModelABC, settings
+from nnmodel.nn.batching import BatchingMixin
 from ..datasets.ROIDataset import ROIDataset
+from ..masks import FrameMasks, SparseMask
 import matplotlib.pyplot as plt
 
 
-class ROISegmentationModel(ModelABC):
+class ROISegmentationModel(BatchingMixin, ModelABC):
     """
     Модель для сегментации областей интереса (ROI) узлов щитовидной железы.
     """
@@ -53,11 +54,13 @@ class ROISegmentationModel(ModelABC):
             DataLoader: Даталоадер для батчевой обработки
         """
 
-        transform = A.Compose([
-            A.Resize(image_size, image_size),
-            A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-            ToTensorV2(),
-        ])
+        transforms = self.__dict__.setdefault('_transforms', {})
+        if image_size not in transforms:
+            transforms[image_size] = A.Compose([
+                A.Resize(image_size, image_size),
+                A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+                ToTensorV2(),
+            ])
 
         dataset = ROIDataset(
             images=images,
@@ -66,18 +69,72 @@ class ROISegmentationModel(ModelABC):
             cropped_image_height=cropped_image_height,
             frame_numbers=frame_numbers,
             inds_in_rois_in_frames_list=inds_in_rois_in_frames_list,
-            transform=transform
+            transform=transforms[image_size]
         )
 
+        # Преобразование небольших ROI дешевле запуска процессов-воркеров DataLoader,
+        # поэтому ROI обрабатываются в текущем процессе
         dataloader = DataLoader(
             dataset=dataset,
             batch_size=batch_size,
             shuffle=False,
-            num_workers=4,
+            num_workers=0,
         )
 
         return dataloader
 
+    def _forward(self, images: list) -> list:
+        """
+        Прямой проход сегментационной сети по батчу ROI (в т.ч. собранному из разных задач).
+
+        Args:
+            images (list): Список тензоров ROI (C, H, W) одного размера
+
+        Returns:
+            list: Список выходов сети (1, H, W), тензоры остаются на устройстве модели
+        """
+
+        with torch.no_grad():
+            output = self._model(torch.stack(images).to(self.device))
+        return list(output)
+
+    @staticmethod
+    def _nearest_indices(src_size: int, dst_size: int) -> np.ndarray:
+        """
+        Индексы исходных пикселей при масштабировании src_size -> dst_size методом ближайшего соседа.
+        Считаются так же, как в PIL (Image.NEAREST): накоплением шага от середины первого пикселя.
+        """
+
+        steps = np.full(dst_size, src_size / dst_size)
+        steps[0] *= 0.5
+        return np.add.accumulate(steps).astype(np.int64).clip(max=src_size - 1)
+
+    def _resize_masks(self, masks: torch.Tensor, heights: list, widths: list) -> list:
+        """
+        Масштабирование батча масок до размеров их ROI одной операцией выборки по индексам на устройстве модели.
+
+        Args:
+            masks (torch.Tensor): bool маски (B, H, W)
+            heights (list): Высоты ROI
+            widths (list): Ширины ROI
+
+        Returns:
+            list: bool маски ROI в виде numpy массивов (heights[i], widths[i])
+        """
+
+        batch_size, src_height, src_width = masks.shape
+        rows = np.zeros(shape=(batch_size, max(heights)), dtype=np.int64)
+        cols = np.zeros(shape=(batch_size, max(widths)), dtype=np.int64)
+        for i in range(batch_size):
+            rows[i, :heights[i]] = self._nearest_indices(src_height, heights[i])
+            cols[i, :widths[i]] = self._nearest_indices(src_width, widths[i])
+
+        rows = torch.from_numpy(rows).to(masks.device)
+        cols = torch.from_numpy(cols).to(masks.device)
+        batch_idx = torch.arange(batch_size, device=masks.device)
+        resized = masks[batch_idx[:, None, None], rows[:, :, None], cols[:, None, :]].cpu().numpy()
+        return [resized[i, :heights[i], :widths[i]].copy() for i in range(batch_size)]
+
     def predict_one_track(self,
                           images: list,
                           coordinates: list,
@@ -89,21 +146,40 @@ class ROISegmentationModel(ModelABC):
                           batch_size: int,
                           threshold: float) -> list:  # return List[List[frame_number, ind_in_rois_in_frames_list, nodule_mask]]
         """
-        Выполнение сегментации для одного трека узла.
+        Выполнение сегментации для одного трека узла (см. predict_rois).
+        """
+
+        return self.predict_rois(images, coordinates, cropped_image_width, cropped_image_height, frame_numbers,
+                                 inds_in_rois_in_frames_list, image_size, batch_size, threshold)
+
+    def predict_rois(self,
+                     images: list,
+                     coordinates: list,
+                     cropped_image_width: int,
+                     cropped_image_height: int,
+                     frame_numbers: list,
+                     inds_in_rois_in_frames_list: list,
+                     image_size: int,
+                     batch_size: int,
+                     threshold: float) -> list:  # return List[List[frame_number, ind_in_rois_in_frames_list, nodule_mask]]
+        """
+        Выполнение сегментации набора ROI, в т.ч. ROI разных треков: батчи заполняются
+        независимо от границ треков.
 
         Args:
-            images (list): Список ROI изображений для одного узла
-            coordinates (list): Список координат ROI для одного узла
+            images (list): Список ROI изображений
+            coordinates (list): Список координат ROI
             cropped_image_width (int): Ширина обрезанного изображения
             cropped_image_height (int): Высота обрезанного изображения
-            frame_numbers (list): Номера кадров для одного узла
+            frame_numbers (list): Номера кадров ROI
             inds_in_rois_in_frames_list (list): Индексы ROI в rois_in_frames_list
             image_size (int): Размер изображения для обработки
             batch_size (int): Размер батча
             threshold (float): Порог бинаризации маски
 
         Returns:
-            list: Результаты сегментации в список списков [номер_кадра, индекс_в_rois_in_frames_list, маска_узла]
+            list: Результаты сегментации в список списков [номер_кадра, индекс_в_rois_in_frames_list, маска_узла],
+                  маска узла - SparseMask в координатах обрезанного изображения
         """
 
         dataloader = self.preprocessing(images, coordinates, cropped_image_width, cropped_image_height, frame_numbers,
@@ -120,23 +196,13 @@ class ROISegmentationModel(ModelABC):
                 initial_roi_widths = initial_roi_widths.tolist()
                 frame_numbers = frame_numbers.tolist()
                 inds_in_rois_in_frames_list = inds_in_rois_in_frames_list.tolist()
-                batch = batch.to(self.device)
-                output = self._model(batch)
-                output = output.cpu().detach().numpy()
-                output = (output < threshold)
-
-                for i in range(batch.shape[0]):
-                    current_mask = output[i][0].astype(float)
-                    current_mask = Image.fromarray(current_mask)
-                    current_mask = current_mask.resize((initial_roi_widths[i], initial_roi_heights[i]),
-                                                       resample=Image.NEAREST)
-                    current_mask = np.array(current_mask)
-                    current_mask = (current_mask > threshold).astype(float)
-                    cropped_mask = np.zeros(shape=(cropped_image_height, cropped_image_width), dtype=np.float32)
-                    cropped_mask[
-                    coords1[i]:coords3[i],
-                    coords0[i]:coords2[i]
-                    ] = current_mask
+                output = torch.stack(self._batched(('segmentation', image_size), self._forward, list(batch)))
+                masks = self._resize_masks(output[:, 0] < threshold, initial_roi_heights, initial_roi_widths)
+
+                for i, current_mask in enumerate(masks):
+                    # маска хранится только в границах ROI вместе с её положением в обрезанном кадре
+                    cropped_mask = SparseMask(current_mask, y=coords1[i], x=coords0[i],
+                                              height=cropped_image_height, width=cropped_image_width)
                     results.append([frame_numbers[i], inds_in_rois_in_frames_list[i], cropped_mask])
 
         return results
@@ -168,50 +234,49 @@ class ROISegmentationModel(ModelABC):
             result_dir (str, optional): Директория для сохранения результатов
 
         Returns:
-            tuple: Кортеж из (обновленные ROI в кадрах, список масок результатов)
+            tuple: Кортеж из (обновленные ROI в кадрах с масками SparseMask, последовательность масок кадров)
         """
 
         print('Segmentation started...')
-        all_segmentation_results = []
+        # ROI всех узлов сегментируются одним потоком батчей, маски затем раскладываются по своим кадрам
+        images, coordinates, frame_numbers, inds_in_rois_in_frames_list = [], [], [], []
+        cropped_image_width = cropped_image_height = None
         for nodule_id in nodules:
-            print(f"Nodule (id={nodule_id}) segmentation started...")
-            segmentation_results = self.predict_one_track(
-                images=nodules[nodule_id]["enlarged_rois"],
-                coordinates=nodules[nodule_id]["enlarged_xyxys"],
-                cropped_image_width=nodules[nodule_id]["cropped_image_width"],
-                cropped_image_height=nodules[nodule_id]["cropped_image_height"],
-                frame_numbers=nodules[nodule_id]["frame_numbers"],
-                inds_in_rois_in_frames_list=nodules[nodule_id]["inds_in_rois_in_frames"],
+            images += nodules[nodule_id]["enlarged_rois"]
+            coordinates += nodules[nodule_id]["enlarged_xyxys"]
+            frame_numbers += nodules[nodule_id]["frame_numbers"]
+            inds_in_rois_in_frames_list += nodules[nodule_id]["inds_in_rois_in_frames"]
+            cropped_image_width = nodules[nodule_id]["cropped_image_width"]
+            cropped_image_height = nodules[nodule_id]["cropped_image_height"]
+        print(f"{len(images)} ROIs of {len(nodules)} nodules")
+
+        segmentation_results = []
+        if images:
+            segmentation_results = self.predict_rois(
+                images=images,
+                coordinates=coordinates,
+                cropped_image_width=cropped_image_width,
+                cropped_image_height=cropped_image_height,
+                frame_numbers=frame_numbers,
+                inds_in_rois_in_frames_list=inds_in_rois_in_frames_list,
                 image_size=image_size,
                 batch_size=batch_size,
                 threshold=threshold
             )
-            print(f"Nodule (id={nodule_id}) segmentation completed")
-            all_segmentation_results.append(segmentation_results)
-
-        for all_seg_res in all_segmentation_results:
-            for seg_res in all_seg_res:
-                frame_number = seg_res[0]
-                ind_in_rois_in_frames_list = seg_res[1]
-                initial_mask = np.zeros(shape=(initial_image_height, initial_image_width), dtype=np.float32)
-                initial_mask[
-                crop_coordinates['x_cut_min']:crop_coordinates['x_cut_max'],
-                crop_coordinates['y_cut_min']:crop_coordinates['y_cut_max']
-                ] = seg_res[2]
-                rois_in_frames[frame_number][ind_in_rois_in_frames_list][2] = initial_mask
 
-        if save:
-            os.makedirs(result_dir, exist_ok=True)
+        for seg_res in segmentation_results:
+            frame_number = seg_res[0]
+            ind_in_rois_in_frames_list = seg_res[1]
+            initial_mask = seg_res[2].shifted(crop_coordinates['x_cut_min'], crop_coordinates['y_cut_min'],
+                                              initial_image_height, initial_image_width)
+            rois_in_frames[frame_number][ind_in_rois_in_frames_list][2] = initial_mask
 
-        result_masks = []
-        for i in range(len(rois_in_frames)):
-            result_mask = np.zeros(shape=(initial_image_height, initial_image_width), dtype=np.float32)
-            for element in rois_in_frames[i]:
-                result_mask += element[2]
-                result_mask = (result_mask != 0).astype(float)
-            result_masks.append(result_mask)
+        # маски кадров размера исходного изображения строятся только при обращении к ним
+        result_masks = FrameMasks(rois_in_frames, initial_image_height, initial_image_width)
 
-            if save:
+        if save:
+            os.makedirs(result_dir, exist_ok=True)
+            for i, result_mask in enumerate(result_masks):
                 result_path = os.path.join(result_dir, f'{i}.png')
                 plt.imsave(result_path, result_mask)
 
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from os import getenv
 
 settings = {
     'detection': {'all': 'media/nnModel/detectUZI/all/epoch74_P88,4_R72,8.pt'},
@@ -20,7 +21,17 @@ settings = {
                     'media/nnModel/classUZI/all/XGB_ensemble_2_ml_models_74,63.pkl',
                 ]
             }
-    }
+    },
+    # Бюджет памяти загруженных моделей (по размеру файлов весов), 0 - без ограничения
+    'registry_memory_budget': int(getenv('NN_MODEL_MEMORY_BUDGET_MB', '0')) * 1024 * 1024,
+    # Объединение кадров и ROI параллельных задач в общие батчи
+    'batching': {
+        'enabled': getenv('NN_BATCHING', '1') == '1',
+        'max_batch_size': int(getenv('NN_BATCH_MAX_SIZE', '16')),
+        'max_wait': float(getenv('NN_BATCH_MAX_WAIT_MS', '10')) / 1000,
+    },
+    # Потоки распаковки кадров сжатых DICOM (общие для всех исследований процесса)
+    'dicom_decode_workers': int(getenv('NN_DICOM_DECODE_WORKERS', '4')),
 }
 
 class ModelABC(ABC):
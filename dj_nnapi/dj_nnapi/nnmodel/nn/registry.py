@@ -0,0 +1,195 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from importlib import import_module
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from nnmodel.nn.nnmodel import ModelABC, settings
+
+ModelKey = Tuple[str, str, str]  # (тип модели, тип проекции, версия)
+
+DEFAULT_VERSION = 'base'
+
+
+def weight_paths(paths) -> List[str]:
+    """
+    Плоский список файлов весов из (вложенной) записи settings.
+    """
+    if isinstance(paths, dict):
+        return [p for value in paths.values() for p in weight_paths(value)]
+    if isinstance(paths, (list, tuple)):
+        return [p for value in paths for p in weight_paths(value)]
+    return [paths]
+
+
+@dataclass
+class ModelSpec:
+    """
+    Описание модели для ленивой загрузки.
+
+    Args:
+        cls_path (str): Путь к классу модели вида 'package.module.ClassName'
+        kwargs (dict): Аргументы конструктора
+        weights (list): Файлы весов, по их размеру оценивается занимаемая память
+    """
+
+    cls_path: str
+    kwargs: dict = field(default_factory=dict)
+    weights: List[str] = field(default_factory=list)
+
+    def build(self) -> ModelABC:
+        module_path, cls_name = self.cls_path.rsplit('.', 1)
+        return getattr(import_module(module_path), cls_name)(**self.kwargs)
+
+    @property
+    def estimated_size(self) -> int:
+        return sum(os.path.getsize(p) for p in self.weights if os.path.exists(p))
+
+
+def release_model(key: ModelKey, model: ModelABC) -> None:
+    """
+    Обработчик выгрузки: закрывает батчеры модели (BatchingMixin.close_batchers).
+    """
+
+    close_batchers = getattr(model, 'close_batchers', None)
+    if close_batchers is not None:
+        close_batchers()
+
+
+class ModelRegistry:
+    """
+    Реестр моделей с загрузкой при первом обращении.
+
+    Загруженные модели хранятся в LRU: если оценка занимаемой памяти превышает memory_budget,
+    выгружаются давно не использованные модели. Модели, которые сейчас используются задачами,
+    остаются в памяти до окончания задач, реестр лишь перестает на них ссылаться.
+    При выгрузке закрываются батчеры модели (release_model, первый обработчик on_evict):
+    их потоки держат ссылку на модель, и без этого веса не освобождаются.
+    """
+
+    def __init__(self, specs: Dict[ModelKey, ModelSpec], memory_budget: int = 0) -> None:
+        """
+        Args:
+            specs (dict): Описания моделей по ключу (тип модели, тип проекции, версия)
+            memory_budget (int): Бюджет памяти в байтах, 0 - без ограничения
+        """
+
+        self.specs = specs
+        self.memory_budget = memory_budget
+        self.on_load: List[Callable[[ModelKey, ModelABC], None]] = []
+        self.on_evict: List[Callable[[ModelKey, ModelABC], None]] = [release_model]
+        self._models: 'OrderedDict[ModelKey, Tuple[ModelABC, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[ModelKey, threading.Lock] = {key: threading.Lock() for key in specs}
+
+    def get(self, model_type: str, projection_type: str = 'all', version: str = DEFAULT_VERSION) -> ModelABC:
+        """
+        Возвращает модель, загружая её при необходимости.
+
+        Args:
+            model_type (str): Тип модели ('D' - детекция, 'S' - сегментация, 'C' - классификация)
+            projection_type (str): Тип проекции
+            version (str): Версия весов
+
+        Returns:
+            ModelABC: Загруженная модель
+        """
+
+        key = (model_type, projection_type, version)
+        if key not in self.specs:
+            raise KeyError(f'Unknown model {key}')
+
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+
+        with self._load_locks[key]:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key][0]
+
+            spec = self.specs[key]
+            print(f'Loading model {key}...')
+            model = spec.build()
+            with self._lock:
+                self._models[key] = (model, spec.estimated_size)
+                evicted = self._shrink(keep=key)
+            for hook in self.on_load:
+                hook(key, model)
+            self._run_evict_hooks(evicted)
+            print(f'Model {key} loaded')
+            return model
+
+    def warmup(self, keys: Iterable[ModelKey] = None) -> None:
+        """
+        Загружает модели заранее (по умолчанию - все известные реестру).
+        """
+
+        for key in self.specs if keys is None else keys:
+            self.get(*key)
+
+    def evict(self, key: ModelKey = None) -> None:
+        """
+        Выгружает модель по ключу (по умолчанию - все загруженные модели).
+        """
+
+        with self._lock:
+            keys = list(self._models) if key is None else [key]
+            evicted = [(k, self._models.pop(k)[0]) for k in keys if k in self._models]
+        self._run_evict_hooks(evicted)
+
+    def loaded(self) -> Dict[ModelKey, ModelABC]:
+        """
+        Загруженные модели, от давно использованных к недавно использованным.
+        """
+
+        with self._lock:
+            return {key: model for key, (model, _) in self._models.items()}
+
+    def _shrink(self, keep: ModelKey) -> list:
+        evicted = []
+        if not self.memory_budget:
+            return evicted
+        total = sum(size for _, size in self._models.values())
+        for key in list(self._models):
+            if total <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            model, size = self._models.pop(key)
+            total -= size
+            evicted.append((key, model))
+        return evicted
+
+    def _run_evict_hooks(self, evicted: list) -> None:
+        for key, model in evicted:
+            print(f'Model {key} evicted')
+            for hook in self.on_evict:
+                hook(key, model)
+
+
+def default_specs() -> Dict[ModelKey, ModelSpec]:
+    """
+    Модели из settings, версия весов - DEFAULT_VERSION.
+    """
+
+    return {
+        ('D', 'all', DEFAULT_VERSION): ModelSpec(
+            cls_path='nnmodel.nn.models.DetectionTrackingModel.DetectionTrackingModel',
+            kwargs={'model_type': 'all'},
+            weights=weight_paths(settings['detection']['all']),
+        ),
+        ('S', 'all', DEFAULT_VERSION): ModelSpec(
+            cls_path='nnmodel.nn.models.ROISegmentationModel.ROISegmentationModel',
+            kwargs={'model_type': 'all'},
+            weights=weight_paths(settings['segmentation']['all']),
+        ),
+        ('C', 'all', DEFAULT_VERSION): ModelSpec(
+            cls_path='nnmodel.nn.models.ROIClassificationModel.ROIClassificationModel',
+            kwargs={'model_type': 'all'},
+            weights=weight_paths(settings['classification']['all']),
+        ),
+    }
@@ -0,0 +1,151 @@
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+
+class Stage:
+    """
+    Стадия конвейера: fn(payload, emit) обрабатывает элемент и передает результаты
+    следующей (или более поздней, по имени) стадии через emit(payload, to=None).
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any, Callable], None], workers: int = 1) -> None:
+        """
+        Args:
+            name (str): Имя стадии
+            fn (Callable): Обработка элемента
+            workers (int): Число потоков стадии
+        """
+
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+
+
+class _Job:
+    """
+    Элемент, поданный в конвейер, со всеми порожденными им элементами.
+    Задача завершена, когда не осталось необработанных элементов.
+    """
+
+    __slots__ = ('future', 'pending', 'lock', 'deadline')
+
+    def __init__(self, deadline: float) -> None:
+        self.future = Future()
+        self.deadline = deadline
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def add(self) -> None:
+        with self.lock:
+            self.pending += 1
+
+    def release(self) -> None:
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0 and not self.future.done():
+                self.future.set_result(None)
+
+    def fail(self, error: Exception) -> None:
+        with self.lock:
+            if not self.future.done():
+                self.future.set_exception(error)
+
+
+class StagedPipeline:
+    """
+    Конвейер из стадий с ограниченными очередями между ними.
+
+    У каждой стадии свои потоки, поэтому разные задачи одновременно находятся на разных стадиях.
+    Заполненная очередь блокирует предыдущую стадию, так что быстрая стадия не накапливает
+    в памяти больше queue_size элементов перед медленной. Элементы передаются только вперед,
+    поэтому потоки стадий не могут заблокировать друг друга.
+    После ошибки оставшиеся элементы задачи пропускаются.
+
+    Очереди упорядочены по сроку задачи: время подачи + delay. Дешевая задача (малый delay)
+    обгоняет поданные раньше дорогие, но срок дорогой задачи не сдвигается, поэтому
+    со временем она обгоняет все новые задачи и не голодает (старение приоритета).
+    Элементы, порожденные задачей, наследуют ее срок.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 0, name: str = 'pipeline') -> None:
+        """
+        Args:
+            stages (list): Стадии в порядке обработки
+            queue_size (int): Размер очереди перед каждой стадией, 0 - без ограничения
+            name (str): Префикс имен потоков
+        """
+
+        self.stages = stages
+        self.name = name
+        self._index = {stage.name: i for i, stage in enumerate(stages)}
+        self._queues = [queue.PriorityQueue(maxsize=max(0, queue_size)) for _ in stages]
+        self._counter = itertools.count()
+        self._threads: Optional[list] = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        if self._threads is not None:
+            return
+        with self._lock:
+            if self._threads is None:
+                threads = []
+                for i, stage in enumerate(self.stages):
+                    for n in range(stage.workers):
+                        thread = threading.Thread(target=self._work, args=(i,),
+                                                  name=f'{self.name}-{stage.name}-{n}', daemon=True)
+                        thread.start()
+                        threads.append(thread)
+                self._threads = threads
+
+    def submit(self, payload: Any, delay: float = 0.0) -> Future:
+        """
+        Подает элемент на первую стадию.
+
+        Args:
+            payload (Any): Элемент
+            delay (float): Задержка срока задачи относительно времени подачи, секунды
+
+        Returns:
+            Future: Завершается после обработки элемента и всех порожденных им элементов
+                    либо с первой ошибкой любой стадии
+        """
+
+        self._ensure_started()
+        job = _Job(deadline=time.monotonic() + delay)
+        job.add()
+        self._put(0, job, payload)
+        return job.future
+
+    def run(self, payload: Any, delay: float = 0.0) -> None:
+        """
+        Подает элемент и дожидается окончания его обработки.
+        """
+
+        self.submit(payload, delay).result()
+
+    def _put(self, index: int, job: _Job, payload: Any) -> None:
+        # номер подачи разделяет равные сроки, элементы никогда не сравниваются между собой
+        self._queues[index].put((job.deadline, next(self._counter), job, payload))
+
+    def _emit(self, job: _Job, index: int, payload: Any, to: str = None) -> None:
+        target = index + 1 if to is None else self._index[to]
+        if not index < target < len(self.stages):
+            raise ValueError(f'{self.stages[index].name}: cannot emit to stage {to or target}')
+        job.add()
+        self._put(target, job, payload)
+
+    def _work(self, index: int) -> None:
+        stage, stage_queue = self.stages[index], self._queues[index]
+        while True:
+            _, _, job, payload = stage_queue.get()
+            if not job.future.done():
+                try:
+                    stage.fn(payload, lambda item, to=None: self._emit(job, index, item, to))
+                except Exception as e:
+                    print(f'{self.name}: stage {stage.name} failed: {e}')
+                    job.fail(e)
+            job.release()
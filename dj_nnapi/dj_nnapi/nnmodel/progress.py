@@ -0,0 +1,47 @@
+import json
+import time
+
+import redis
+from django.conf import settings
+
+PROGRESS_CHANNEL = "uzi:progress:{image_id}"
+PROGRESS_LAST_KEY = "uzi:progress:{image_id}:last"
+PROGRESS_TTL = 60 * 60
+
+_client = None
+
+
+def get_client() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.NN_SETTINGS["PROGRESS_REDIS_URL"])
+    return _client
+
+
+class ProgressReporter:
+    """
+    Публикует этапы обработки исследования в Redis pub/sub (канал uzi:progress:<id>)
+    и хранит последнее состояние, чтобы подписавшийся позже клиент получил его сразу.
+    Ошибки Redis не прерывают обработку.
+    """
+
+    def __init__(self, image_id: int) -> None:
+        self.image_id = image_id
+        self.channel = PROGRESS_CHANNEL.format(image_id=image_id)
+        self.last_key = PROGRESS_LAST_KEY.format(image_id=image_id)
+
+    def __call__(self, stage: str, **data) -> None:
+        """
+        :param stage - этап: decoded, tracking, segmented, classified, persisted, done, failed
+        :param data - данные этапа (число кадров, узлов и т.п.)
+        """
+        payload = json.dumps(
+            {"image_id": self.image_id, "stage": stage, "time": time.time(), **data}
+        )
+        try:
+            pipe = get_client().pipeline()
+            pipe.set(self.last_key, payload, ex=PROGRESS_TTL)
+            pipe.publish(self.channel, payload)
+            pipe.execute()
+        except redis.RedisError as er:
+            print(f"progress publish failed: {er}")
@@ -1,9 +1,17 @@
-import uuid
+import io
 
 import dramatiq
-from nnmodel import models
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from nnmodel import contours, models
 
 from nnmodel.nn.datasets.ThyroidUltrasoundDataset import ThyroidUltrasoundDataset
+from nnmodel.nn.loaders.frame_reader import open_frame_reader
+from nnmodel.nn.masks import SparseMask
+from nnmodel.nn.cache import ResultCache, file_digest
+from nnmodel.nn.models.DetectionTrackingModel import DetectionTrackingModel
+from nnmodel.pipeline import Stage, StagedPipeline
+from nnmodel.progress import ProgressReporter
 from nnmodel.apps import NNmodelConfig
 import cv2
 
@@ -115,60 +123,118 @@ def createSegmentationDataObj(ind, nodule, details, image_id, result_masks):
         details=pre_details
     )
     segmentation_data_obj.save()
-    createSegmentationPointObj(result_masks, segmentation_data_obj)
+    return createSegmentationPointObj(result_masks, segmentation_data_obj)
 
     #calculate_and_save_nodule_dimensions(segmentation_data_obj, result_masks)
 
+def deleteAiSegmentGroups(image_id):
+    """
+    Удаление результатов нейросети для снимка (с сегментами и точками).
+    Узлы сохраняются по одному, поэтому повторная попытка задачи после сбоя
+    сначала удаляет то, что успела записать предыдущая
+    :param image_id - id OriginalImage
+    """
+    with transaction.atomic():
+        deleted, _ = models.UZISegmentGroupInfo.objects.filter(
+            original_image_id=image_id, is_ai=True
+        ).delete()
+    return deleted
+
+def contours_to_points(result_mask, z):
+    """
+    Контуры маски в виде одного int32 массива точек (x, y, z)
+    :param result_mask - маска узла на слайде (SparseMask или маска размера слайда)
+    :param z - номер слайда
+    """
+    mode = cv2.RETR_TREE
+    method = cv2.CHAIN_APPROX_SIMPLE | cv2.CHAIN_APPROX_TC89_L1
+    if isinstance(result_mask, SparseMask):
+        contours = result_mask.find_contours(mode, method)
+    else:
+        binary_mask = (result_mask * 255).astype(np.uint8)
+        contours, hierarchy = cv2.findContours(binary_mask, mode, method)
+    if not contours:
+        return np.empty(shape=(0, 3), dtype=np.int32)
+
+    xy = np.concatenate(contours).reshape(-1, 2)
+    points = np.empty(shape=(len(xy), 3), dtype=np.int32)
+    points[:, :2] = xy
+    points[:, 2] = z
+    return points
+
+
+# Формат бинарного COPY PostgreSQL для строк (uid bigint, segment_id bigint, x int, y int, z int)
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + np.array([0, 0], dtype=">i4").tobytes()
+PGCOPY_TRAILER = np.array([-1], dtype=">i2").tobytes()
+PGCOPY_POINT_DTYPE = np.dtype([
+    ("n_fields", ">i2"),
+    ("uid_len", ">i4"), ("uid", ">i8"),
+    ("segment_len", ">i4"), ("segment_id", ">i8"),
+    ("x_len", ">i4"), ("x", ">i4"),
+    ("y_len", ">i4"), ("y", ">i4"),
+    ("z_len", ">i4"), ("z", ">i4"),
+])
+
+
+def bulk_insert_segmentation_points(segment_id, points):
+    """
+    Запись точек сегмента одним запросом: бинарный COPY для PostgreSQL, bulk_create иначе.
+    uid точки - её порядковый номер в сегменте
+    :param segment_id - id SegmentationData
+    :param points - int32 массив (K, 3) точек (x, y, z)
+    """
+    table = models.SegmentationPoint._meta.db_table
+    if connection.vendor != "postgresql":
+        models.SegmentationPoint.objects.bulk_create(
+            [
+                models.SegmentationPoint(uid=uid, segment_id=segment_id, x=x, y=y, z=z)
+                for uid, (x, y, z) in enumerate(points.tolist())
+            ],
+            batch_size=1000,
+        )
+        return
+
+    rows = np.empty(len(points), dtype=PGCOPY_POINT_DTYPE)
+    rows["n_fields"] = 5
+    rows["uid_len"] = rows["segment_len"] = 8
+    rows["x_len"] = rows["y_len"] = rows["z_len"] = 4
+    rows["uid"] = np.arange(len(points))
+    rows["segment_id"] = segment_id
+    rows["x"] = points[:, 0]
+    rows["y"] = points[:, 1]
+    rows["z"] = points[:, 2]
+
+    buf = io.BytesIO(PGCOPY_HEADER + rows.tobytes() + PGCOPY_TRAILER)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table} (uid, segment_id, x, y, z) FROM STDIN WITH (FORMAT binary)", buf
+        )
+
+
 def createSegmentationPointObj(result_masks, segmentation_data_obj):
     segments_points = []
     for result_mask_dict in result_masks:
         for mask_idx, result_mask in result_mask_dict.items():
-            if result_mask is None or np.sum(result_mask) == 0:
-                print(f"Mask {mask_idx} is empty, skipping...")
+            if result_mask is None or not result_mask.any():
                 continue
+            segments_points.append(contours_to_points(result_mask, mask_idx))
 
-            print(f"Processing mask {mask_idx} with shape {result_mask.shape}")
-
-            binary_mask = (result_mask * 255).astype(np.uint8)
-
-            contours, hierarchy = cv2.findContours(
-                binary_mask,
-                cv2.RETR_TREE,
-                cv2.CHAIN_APPROX_SIMPLE | cv2.CHAIN_APPROX_TC89_L1,
-            )
-
-            print(f"Found {len(contours)} contours in mask {mask_idx}")
-
-            # Обрабатываем найденные контуры
-            for contour_idx, contour in enumerate(contours):
-                print(f"Contour {contour_idx} has {len(contour)} points")
-
-                # Создаем точки для каждого контура
-                for point_idx, point in enumerate(contour):
-                    x = point[0][0]
-                    y = point[0][1]
-
-                    segments_points.append(
-                        models.SegmentationPoint(
-                            uid=hash(uuid.uuid4()),
-                            segment=segmentation_data_obj,
-                            x=x,
-                            y=y,
-                            z=mask_idx,
-                        )
-                    )
-
-    print(f"Total points to create: {len(segments_points)}")
-
-    # Сохраняем точки сегментации батчами
-    if segments_points:
-        batch_size = 1000
-        for i in range(0, len(segments_points), batch_size):
-            batch = segments_points[i:i + batch_size]
-            models.SegmentationPoint.objects.bulk_create(batch)
-        print(f"Successfully created {len(segments_points)} segmentation points")
-    else:
+    if not segments_points:
         print("No segmentation points to create")
+        return 0
+
+    points = np.concatenate(segments_points)
+    if settings.NN_SETTINGS["CONTOUR_STORAGE"] == "blob":
+        segmentation_data_obj.points_blob = contours.pack_points(points)
+        segmentation_data_obj.save(update_fields=["points_blob"])
+        print(f"Packed {len(points)} segmentation points")
+        return len(points)
+
+    print(f"Total points to create: {len(points)}")
+    with transaction.atomic():
+        bulk_insert_segmentation_points(segmentation_data_obj.id, points)
+    print(f"Successfully created {len(points)} segmentation points")
+    return len(points)
 
 def get_result_masks_for_nodule(rois_in_frames, nodule_ind):
     """
@@ -183,53 +249,235 @@ def get_result_masks_for_nodule(rois_in_frames, nodule_ind):
                 res.append({mask_ind : nodule[2]})
     return res
 
-@dramatiq.actor(queue_name='predict_all', store_results=True)
-def predict_all(file_path: str, projection_type: str, id: int):
-    print(f"predictions, {projection_type=} {file_path=}")
-    roi_classification_model = NNmodelConfig.DefalutModels["C"]["all"]
-    roi_segmentation_model = NNmodelConfig.DefalutModels["S"]["all"]
-    detector_tracker = NNmodelConfig.DefalutModels["D"]["all"]
+# Параметры инференса, входят в ключ кэша результатов
+INFERENCE_PARAMS = {
+    "detection": {"image_size": 640, "batch_size": 8, "conf_det": 0.5, "iou": 0.3, "roi_margin_percent": 10},
+    "segmentation": {"batch_size": 8, "image_size": 256, "threshold": 0.5},
+    "classification": {"image_size": 224},
+}
+
+
+def cache_params():
+    """
+    Все, от чего зависит результат, кроме кадров и весов: параметры инференса,
+    шаг обрезки и содержимое конфигурации трекера
+    """
+    return {
+        **INFERENCE_PARAMS,
+        "crop_step": settings.NN_SETTINGS["CROP_STEP"],
+        "tracker": file_digest(DetectionTrackingModel.tracker_config),
+    }
+
+
+_result_cache = None
+
+
+def get_result_cache():
+    """
+    Кэш результатов инференса или None, если он отключен
+    """
+    global _result_cache
+    if _result_cache is None and settings.NN_SETTINGS["RESULT_CACHE_MB"] > 0:
+        _result_cache = ResultCache(
+            directory=settings.NN_SETTINGS["RESULT_CACHE_DIR"],
+            max_bytes=settings.NN_SETTINGS["RESULT_CACHE_MB"] * 1024 * 1024,
+        )
+    return _result_cache
+
+
+class Study:
+    """
+    Состояние обработки одного исследования, общее для стадий конвейера
+    """
+
+    def __init__(self, file_path, image_id):
+        self.file_path = file_path
+        self.image_id = image_id
+        self.progress = ProgressReporter(image_id)
+        self.dataset = None
+        self.cache_key = None
+        self.cached = False
+        self.details = {}
+        self.classes = {}
+        self.masks = {}
+
+
+def decode_stage(study, emit):
+    """
+    Поиск результата в кэше и декодирование исследования.
+    Ключ кэша считается по хранимым байтам кадров, поэтому при попадании в кэш датасет
+    не строится (ни проход для окна обрезки, ни декодирование кадров), а узлы сразу
+    передаются на сохранение. Прежние результаты нейросети для снимка удаляются
+    до сохранения новых в обоих случаях
+    """
+    close_old_connections()
+    reader = open_frame_reader(study.file_path)
+
+    result_cache = get_result_cache()
+    if result_cache is not None:
+        study.cache_key = result_cache.key(reader.content_digest(), cache_params())
+        result = result_cache.get(study.cache_key)
+        if result is not None:
+            print(f"result cache hit {study.cache_key}")
+            deleteAiSegmentGroups(study.image_id)
+            study.cached = True
+            study.classes = result["classes"]
+            study.progress("cached", frames=len(reader), classes=result["classes"])
+            for ind, masks in result["masks"].items():
+                nodule_class = result["classes"][ind] if isinstance(result["classes"], dict) else result["classes"]
+                emit((study, ind, nodule_class, masks), to="persist")
+            return
+
+    deleted = deleteAiSegmentGroups(study.image_id)
+    if deleted:
+        print(f"removed {deleted} previous AI segmentation rows of image {study.image_id}")
+    study.dataset = ThyroidUltrasoundDataset(
+        path=study.file_path,
+        lazy=settings.NN_SETTINGS["LAZY_DATASET"],
+        crop_step=settings.NN_SETTINGS["CROP_STEP"],
+        reader=reader,
+    )
+    study.progress("decoded", frames=len(study.dataset))
+    emit(study)
+
+
+def detect_stage(study, emit):
+    """
+    Детекция и трекинг узлов. При NN_SETTINGS["STREAM_NODULES"] узел передается
+    на сегментацию сразу после завершения его трека, иначе - все узлы после трекинга
+    """
+    detector_tracker = NNmodelConfig.models.get("D", "all")
+    stream = settings.NN_SETTINGS["STREAM_NODULES"]
+    progress = study.progress
 
-    dataset = ThyroidUltrasoundDataset(path=file_path)
     detection_results, detected_nodules, rois_in_frames = detector_tracker.predict(
-        dataset=dataset,
-        image_size=640,
-        batch_size=1,
-        conf_det=0.5,
-        iou=0.3,
-        roi_margin_percent=10,
+        dataset=study.dataset,
         save=False,
+        on_frame=lambda done, total: progress("tracking", frames_done=done, frames=total),
+        on_nodule_final=(
+            lambda ind, nodule, rois: emit((study, {ind: nodule}, rois))
+        ) if stream else None,
+        **INFERENCE_PARAMS["detection"],
     )
+    progress("tracked", frames=len(study.dataset), nodules=len(detected_nodules))
+
+    if not detected_nodules:
+        # узлов нет - исследование целиком получает класс по умолчанию
+        roi_classification_model = NNmodelConfig.models.get("C", "all")
+        study.classes = roi_classification_model.predict(nodules={}, **INFERENCE_PARAMS["classification"])
+        emit((study, 0, study.classes, get_result_masks_for_nodule(rois_in_frames, 0)), to="persist")
+    elif not stream:
+        emit((study, detected_nodules, rois_in_frames))
 
-    rois_in_frames, result_masks = roi_segmentation_model.predict(
-        nodules=detected_nodules,
+
+def segment_stage(item, emit):
+    """
+    Сегментация ROI узлов, маски записываются в rois_in_frames
+    """
+    study, nodules, rois_in_frames = item
+    roi_segmentation_model = NNmodelConfig.models.get("S", "all")
+    roi_segmentation_model.predict(
+        nodules=nodules,
         rois_in_frames=rois_in_frames,
-        batch_size=8,
-        image_size=256,
-        threshold=0.5,
-        initial_image_height=dataset.initial_height,
-        initial_image_width=dataset.initial_width,
-        crop_coordinates=dataset.crop_coordinates,
-        save=False
+        initial_image_height=study.dataset.initial_height,
+        initial_image_width=study.dataset.initial_width,
+        crop_coordinates=study.dataset.crop_coordinates,
+        save=False,
+        **INFERENCE_PARAMS["segmentation"],
     )
+    study.progress("segmented", nodules=list(nodules))
+    emit(item)
 
-    nodule_class_dict = roi_classification_model.predict(
-        nodules=detected_nodules,
-        image_size=224
+
+def classify_stage(item, emit):
+    """
+    Классификация узлов, каждый узел с его масками передается на сохранение
+    """
+    study, nodules, rois_in_frames = item
+    roi_classification_model = NNmodelConfig.models.get("C", "all")
+    classes = roi_classification_model.predict(
+        nodules=nodules,
+        **INFERENCE_PARAMS["classification"],
     )
+    study.progress("classified", classes=classes)
+    for ind in nodules:
+        emit((study, ind, classes[ind], get_result_masks_for_nodule(rois_in_frames, ind)))
 
-    details = {}
 
-    if isinstance(nodule_class_dict, dict):
-        for ind, nodule in nodule_class_dict.items():
-            result_masks_with_cur_nodule = get_result_masks_for_nodule(rois_in_frames, ind)
-            createSegmentationDataObj(ind, nodule, details, id, result_masks_with_cur_nodule)
-    elif isinstance(nodule_class_dict, str):
-        result_masks_with_cur_nodule = get_result_masks_for_nodule(rois_in_frames, 0)
-        createSegmentationDataObj(0, nodule_class_dict, details, id, result_masks_with_cur_nodule)
-    else:
-        raise TypeError("Unexpected type in nodule_class_dict")
+def persist_stage(item, emit):
+    """
+    Сохранение узла в БД
+    """
+    study, ind, nodule_class, masks = item
+    # потоки конвейера живут дольше задачи, устаревшие соединения закрываются вручную
+    close_old_connections()
+    with transaction.atomic():
+        points = createSegmentationDataObj(ind, nodule_class, study.details, study.image_id, masks)
+    if isinstance(study.classes, dict):
+        study.classes[ind] = nodule_class
+    study.masks[ind] = masks
+    study.progress("persisted", nodule=ind, segment_group_id=study.details[ind].id, points=points)
+
+
+_pipeline = None
+
+
+def get_pipeline():
+    """
+    Конвейер обработки исследований, общий для потоков воркера.
+    Детекция с трекингом выполняется в одном потоке: состояние трекера принадлежит модели
+    """
+    global _pipeline
+    if _pipeline is None:
+        workers = settings.NN_SETTINGS["PIPELINE_WORKERS"]
+        _pipeline = StagedPipeline(
+            stages=[
+                Stage("decode", decode_stage, workers["decode"]),
+                Stage("detect", detect_stage, 1),
+                Stage("segment", segment_stage, workers["segment"]),
+                Stage("classify", classify_stage, workers["classify"]),
+                Stage("persist", persist_stage, workers["persist"]),
+            ],
+            queue_size=settings.NN_SETTINGS["PIPELINE_QUEUE_SIZE"],
+            name="predict",
+        )
+    return _pipeline
+
 
-    models.OriginalImage.objects.filter(id=id).update(viewed_flag=True)
+@dramatiq.actor(queue_name='predict_all', store_results=True)
+def predict_all(file_path: str, projection_type: str, id: int, cost: float = 0.0):
+    """
+    :param cost - оценка стоимости исследования (мегапиксели всех кадров), задает срок задачи
+        в конвейере: дешевые исследования обгоняют дорогие, поданные незадолго до них
+    """
+    print(f"predictions, {projection_type=} {file_path=} {cost=}")
+    study = Study(file_path, id)
+    try:
+        get_pipeline().run(study, delay=cost * settings.NN_SETTINGS["AGING_SECONDS_PER_MPIX"])
+
+        result_cache = get_result_cache()
+        if result_cache is not None and not study.cached:
+            result_cache.put(study.cache_key, {"classes": study.classes, "masks": study.masks})
+
+        models.OriginalImage.objects.filter(id=id).update(viewed_flag=True)
+    except Exception as er:
+        study.progress("failed", error=str(er))
+        raise
+    study.progress("done")
     print("predicted!")
-    return
\ No newline at end of file
+    return
+
+
+# Очередь больших исследований. Ее обрабатывают отдельные процессы воркера
+# (rundramatiq_shared --large-processes, entrypoint.sh), поэтому многокадровые исследования
+# не занимают потоки и конвейер процессов, обрабатывающих одиночные снимки.
+# Приоритет действует, только если обе очереди обрабатывают одни и те же процессы
+# (--large-processes 0): он упорядочивает лишь уже полученные воркером сообщения,
+# и большие исследования все равно занимают потоки, пока малые ждут в RabbitMQ
+predict_all_large = dramatiq.actor(
+    predict_all.fn,
+    actor_name='predict_all_large',
+    queue_name='predict_all_large',
+    priority=10,
+    store_results=True,
+)
@@ -1,3 +1,644 @@
-from django.test import TestCase
+import gc
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.test import SimpleTestCase
+from PIL import Image
+
+from nnmodel import contours, pipeline
+from nnmodel.nn import cache
+from nnmodel.nn.batching import BatchingMixin, DynamicBatcher
+from nnmodel.nn.nnmodel import ModelABC, settings as nn_settings
+from nnmodel.nn.registry import ModelRegistry, ModelSpec
+from nnmodel.nn.masks import FrameMasks, SparseMask
+from nnmodel.nn.loaders import frame_store
+from nnmodel.nn.loaders.frame_reader import FrameStoreReader, NpyFrameReader, open_frame_reader
+from nnmodel.pipeline import Stage, StagedPipeline
+
+# Общий тестовый вектор формата CNT1: тот же блоб и те же точки проверяются
+# в medweb (medml/tests.py), копии кодека должны декодировать его одинаково.
+# Серии: z=0 с дельтами int16, z=3 с дельтами int32, z=5 из одной точки
+CNT1_VECTOR = bytes.fromhex(
+    "434e543100000000030000000a000000140000000201000200feff0300030000"
+    "00030000000500000005000000043b9c00000000000001000000010000000500"
+    "000001000000070000000800000002"
+)
+CNT1_VECTOR_POINTS = [
+    (10, 20, 0), (11, 22, 0), (9, 25, 0),
+    (5, 5, 3), (40000, 5, 3), (40001, 6, 3),
+    (7, 8, 5),
+]
+
+
+class ContoursCodecTests(SimpleTestCase):
+    def test_shared_vector_decodes(self):
+        self.assertEqual(contours.unpack_points(CNT1_VECTOR).tolist(), [list(p) for p in CNT1_VECTOR_POINTS])
+
+    def test_shared_vector_encodes(self):
+        self.assertEqual(contours.pack_points(CNT1_VECTOR_POINTS), CNT1_VECTOR)
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        points = rng.integers(0, 70000, size=(500, 3))
+        points[:, 2] = np.repeat(np.arange(5), 100)
+        np.testing.assert_array_equal(contours.unpack_points(contours.pack_points(points)), points)
+
+    def test_empty(self):
+        self.assertEqual(contours.pack_points([]), contours.MAGIC)
+        self.assertEqual(contours.unpack_points(contours.MAGIC).shape, (0, 3))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            contours.unpack_points(b"CNT0")
+
+    def test_point_dicts_have_stable_ids(self):
+        points = contours.unpack_point_dicts(CNT1_VECTOR, segment_id=42)
+        self.assertEqual([p["uid"] for p in points], list(range(len(CNT1_VECTOR_POINTS))))
+        self.assertEqual(points, contours.unpack_point_dicts(CNT1_VECTOR, segment_id=42))
+        ids = {p["id"] for p in points} | {p["id"] for p in contours.unpack_point_dicts(CNT1_VECTOR, 43)}
+        self.assertEqual(len(ids), 2 * len(CNT1_VECTOR_POINTS))
+        self.assertTrue(all(i < 0 for i in ids))
+
+    def test_point_id_boundary(self):
+        stride = contours.PACKED_ID_STRIDE
+        self.assertEqual(stride, 2 ** 24)
+        last = contours.packed_point_id(0, stride - 1)
+        self.assertEqual(last, -stride)
+        self.assertEqual(contours.packed_point_id(1, 0), last - 1)
+        for uid in (-1, stride):
+            with self.assertRaises(ValueError):
+                contours.packed_point_id(0, uid)
+
+    def test_pack_points_limit(self):
+        # настоящий предел - 2**24 точек; проверяется та же граница на малом шаге
+        with mock.patch.object(contours, "PACKED_ID_STRIDE", 4):
+            points = [(i, i, 0) for i in range(5)]
+            np.testing.assert_array_equal(contours.unpack_points(contours.pack_points(points[:4])), points[:4])
+            with self.assertRaises(ValueError):
+                contours.pack_points(points)
+
+
+def reference_crop_coords(grey_img: np.ndarray) -> tuple[int, int, int, int]:
+    """
+    Прежний покадровый irrelevant_region_coords (средние яркости и argwhere), эталон для crop_window
+    """
+    value_x = np.mean(grey_img, 1)
+    value_y = np.mean(grey_img, 0)
+    x_hold_range = list((len(value_x) * np.array([0.8 / 3, 2.2 / 3])).astype(np.int_))
+    y_hold_range = list((len(value_y) * np.array([0.8 / 3, 1.8 / 3])).astype(np.int_))
+    x_cut = np.argwhere(value_x <= 5)
+    y_cut = np.argwhere(value_y <= 5)
+    x_cut_min = list(x_cut[x_cut <= x_hold_range[0]])
+    x_cut_max = list(x_cut[x_cut >= x_hold_range[1]])
+    y_cut_min = list(y_cut[y_cut <= y_hold_range[0]])
+    y_cut_max = list(y_cut[y_cut >= y_hold_range[1]])
+    return (
+        max(x_cut_min) if x_cut_min else 0,
+        min(x_cut_max) if x_cut_max else grey_img.shape[0],
+        max(y_cut_min) if y_cut_min else 0,
+        min(y_cut_max) if y_cut_max else grey_img.shape[1],
+    )
+
+
+def reference_crop_window(frames: np.ndarray) -> tuple[int, int, int, int]:
+    coords = [reference_crop_coords(frame) for frame in frames]
+    return (
+        min(c[0] for c in coords), max(c[1] for c in coords),
+        min(c[2] for c in coords), max(c[3] for c in coords),
+    )
+
+
+def random_grey_frames(rng: np.random.Generator, n: int, height: int, width: int) -> np.ndarray:
+    """
+    Кадры с темными полосами случайной ширины у краев; яркость полос - около порога 5
+    """
+    frames = rng.integers(0, 256, size=(n, height, width), dtype=np.uint8)
+    for frame in frames:
+        top, bottom = rng.integers(0, height // 3, size=2)
+        left, right = rng.integers(0, width // 3, size=2)
+        frame[:top] = rng.integers(3, 8, dtype=np.uint8)
+        frame[height - bottom:] = rng.integers(3, 8, dtype=np.uint8)
+        frame[:, :left] = rng.integers(3, 8, dtype=np.uint8)
+        frame[:, width - right:] = rng.integers(3, 8, dtype=np.uint8)
+    return frames
+
+
+class CropWindowTests(SimpleTestCase):
+    def setUp(self):
+        from nnmodel.nn.datasets.ThyroidUltrasoundDataset import ThyroidUltrasoundDataset
+        self.dataset_cls = ThyroidUltrasoundDataset
+
+    def test_matches_per_frame_reference(self):
+        rng = np.random.default_rng(3)
+        for height, width in ((24, 32), (61, 47), (120, 160)):
+            for _ in range(50):
+                frames = random_grey_frames(rng, int(rng.integers(1, 4)), height, width)
+                self.assertEqual(self.dataset_cls.crop_window(frames), reference_crop_window(frames))
+
+    def test_step_uses_every_kth_frame(self):
+        frames = random_grey_frames(np.random.default_rng(4), 9, 40, 50)
+        self.assertEqual(self.dataset_cls.crop_window(frames, step=4), reference_crop_window(frames[::4]))
+
+    def test_single_frame(self):
+        frame = random_grey_frames(np.random.default_rng(5), 1, 40, 50)[0]
+        self.assertEqual(self.dataset_cls.irrelevant_region_coords(frame), reference_crop_coords(frame))
+
+    def test_no_dark_borders(self):
+        frames = np.full((2, 30, 40), 200, dtype=np.uint8)
+        self.assertEqual(self.dataset_cls.crop_window(frames), (0, 30, 0, 40))
+
+
+class DynamicBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+
+    def double(self, items):
+        self.batches.append(list(items))
+        return [item * 2 for item in items]
+
+    def test_merges_concurrent_submits(self):
+        batcher = DynamicBatcher(self.double, max_batch_size=8, max_wait=0.5)
+        results = {}
+        start = threading.Barrier(4)
+
+        def run(n):
+            start.wait()
+            results[n] = batcher.map([n * 10 + i for i in range(2)])
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {n: [n * 20, n * 20 + 2] for n in range(4)})
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(sorted(self.batches[0]), sorted(n * 10 + i for n in range(4) for i in range(2)))
+
+    def test_batch_size_limit(self):
+        batcher = DynamicBatcher(self.double, max_batch_size=3, max_wait=0.5)
+        self.assertEqual(batcher.map(list(range(7))), [i * 2 for i in range(7)])
+        self.assertEqual(self.batches, [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_partial_batch_after_max_wait(self):
+        batcher = DynamicBatcher(self.double, max_batch_size=100, max_wait=0.05)
+        started = time.monotonic()
+        self.assertEqual(batcher.map([1, 2]), [2, 4])
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+        self.assertEqual(self.batches, [[1, 2]])
+
+    def test_errors_reach_every_caller(self):
+        def fail(items):
+            raise RuntimeError("batch failed")
+
+        batcher = DynamicBatcher(fail, max_batch_size=4, max_wait=0.01)
+        for future in batcher.submit([1, 2]):
+            with self.assertRaisesRegex(RuntimeError, "batch failed"):
+                future.result()
+        # рабочий поток продолжает обрабатывать очередь после ошибки
+        batcher.fn = self.double
+        self.assertEqual(batcher.map([3]), [6])
+
+    def test_result_count_mismatch(self):
+        batcher = DynamicBatcher(lambda items: items[:-1], max_batch_size=4, max_wait=0.01)
+        with self.assertRaises(RuntimeError):
+            batcher.map([1, 2])
+
+    def test_close_finishes_queued_items(self):
+        batcher = DynamicBatcher(self.double, max_batch_size=2, max_wait=0.5)
+        futures = batcher.submit([1, 2, 3])
+        batcher.close(timeout=5)
+        self.assertEqual([future.result(timeout=0) for future in futures], [2, 4, 6])
+        self.assertFalse(batcher._thread.is_alive())
+        self.assertIsNone(batcher.fn)
+        with self.assertRaises(RuntimeError):
+            batcher.submit([4])
+        batcher.close()
+
+    def test_close_before_start(self):
+        batcher = DynamicBatcher(self.double, max_batch_size=2, max_wait=0.01)
+        batcher.close()
+        self.assertIsNone(batcher.fn)
+        self.assertIsNone(batcher._thread)
+
+    def test_close_batchers_releases_model(self):
+        class Model(BatchingMixin):
+            def forward(self, items):
+                return [item + 1 for item in items]
+
+        model = Model()
+        with mock.patch.dict(nn_settings["batching"], enabled=True):
+            self.assertEqual(model._batched("forward", model.forward, [1, 2]), [2, 3])
+        threads = [batcher._thread for batcher in model._batchers.values()]
+        model.close_batchers()
+        self.assertNotIn("_batchers", model.__dict__)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        ref = weakref.ref(model)
+        del model
+        self.assertIsNone(ref())
+
+
+class RegistryTestModel(BatchingMixin, ModelABC):
+    """
+    Модель для ModelRegistryTests: predict идет через общий батчер
+    """
+
+    def load(self, path):
+        pass
+
+    def preprocessing(self, path):
+        pass
+
+    def predict(self, items):
+        return self._batched("predict", self._forward, items)
+
+    def _forward(self, items):
+        return [item * 2 for item in items]
+
+
+class ModelRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp)
+        specs = {}
+        for name in ("A", "B"):
+            weights = self.tmp / f"{name}.pt"
+            weights.write_bytes(bytes(100))
+            specs[(name, "all", "base")] = ModelSpec(cls_path="nnmodel.tests.RegistryTestModel", weights=[str(weights)])
+        self.registry = ModelRegistry(specs, memory_budget=150)
+        patcher = mock.patch.dict(nn_settings["batching"], enabled=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_evicted_model_is_collected(self):
+        model = self.registry.get("A")
+        self.assertEqual(model.predict([1, 2]), [2, 4])
+        ref = weakref.ref(model)
+        del model
+
+        self.assertEqual(self.registry.get("B").predict([3]), [6])
+        self.assertEqual(list(self.registry.loaded()), [("B", "all", "base")])
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_explicit_evict(self):
+        ref = weakref.ref(self.registry.get("A"))
+        self.registry.get("A").predict([1])
+        self.registry.evict()
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_model_in_use_keeps_working(self):
+        model = self.registry.get("A")
+        model.predict([1])
+        self.registry.evict(("A", "all", "base"))
+        self.assertEqual(model.predict([5, 6]), [10, 12])
+        self.assertNotIn("_batchers", model.__dict__)
+
+
+class SparseMaskTests(SimpleTestCase):
+    """
+    Маски сравниваются с прежними масками размера кадра: кроп ROI, вписанный в обрезанный
+    кадр, затем обрезанный кадр, вписанный в исходный
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(12)
+        self.rng = rng
+        self.crop = rng.random((9, 13)) < 0.4
+        self.crop[3:6, 4:9] = True
+
+    def dense_reference(self, crop, y, x, height, width):
+        dense = np.zeros((height, width), dtype=np.float32)
+        dense[y:y + crop.shape[0], x:x + crop.shape[1]] = crop.astype(float)
+        return dense
+
+    def test_to_dense(self):
+        mask = SparseMask(self.crop, y=5, x=7, height=30, width=40)
+        dense = mask.to_dense()
+        self.assertEqual(dense.dtype, np.float32)
+        np.testing.assert_array_equal(dense, self.dense_reference(self.crop, 5, 7, 30, 40))
+        np.testing.assert_array_equal(np.asarray(mask), dense)
+        self.assertTrue(mask.any())
+        self.assertFalse(SparseMask(np.zeros((2, 2)), 0, 0, 4, 4).any())
+
+    def test_shifted_to_initial_image(self):
+        cropped = self.dense_reference(self.crop, 5, 7, 30, 40)
+        initial = np.zeros((50, 60), dtype=np.float32)
+        initial[4:34, 11:51] = cropped
+        mask = SparseMask(self.crop, y=5, x=7, height=30, width=40).shifted(4, 11, 50, 60)
+        np.testing.assert_array_equal(mask.to_dense(), initial)
+
+    def test_frame_masks_union(self):
+        height, width = 40, 50
+        rois_in_frames = []
+        for frame in range(3):
+            rois = []
+            for _ in range(frame + 1):
+                crop = self.rng.random((10, 12)) < 0.5
+                y, x = self.rng.integers(0, 30), self.rng.integers(0, 38)
+                rois.append([None, None, SparseMask(crop, int(y), int(x), height, width)])
+            rois.append([None, None, None])
+            rois_in_frames.append(rois)
+
+        masks = FrameMasks(rois_in_frames, height, width)
+        self.assertEqual(len(masks), 3)
+        for frame, rois in enumerate(rois_in_frames):
+            expected = np.zeros((height, width), dtype=np.float32)
+            for element in rois:
+                if element[2] is not None:
+                    expected += element[2].to_dense()
+                    expected = (expected != 0).astype(float)
+            np.testing.assert_array_equal(masks[frame], expected)
+        self.assertEqual(len(list(masks)), 3)
+
+    def test_contours_match_dense(self):
+        mode = cv2.RETR_TREE
+        method = cv2.CHAIN_APPROX_SIMPLE | cv2.CHAIN_APPROX_TC89_L1
+        # маска у края кропа и у края кадра
+        for y, x in ((5, 7), (0, 0), (21, 27)):
+            mask = SparseMask(self.crop, y=y, x=x, height=30, width=40)
+            expected, _ = cv2.findContours((mask.to_dense() * 255).astype(np.uint8), mode, method)
+            actual = mask.find_contours(mode, method)
+            self.assertEqual(sorted(c.tolist() for c in actual), sorted(c.tolist() for c in expected))
+
+
+class MaskResizeTests(SimpleTestCase):
+    """
+    Масштабирование масок сегментации должно совпадать с прежним Image.resize(..., Image.NEAREST)
+    """
+
+    def setUp(self):
+        from nnmodel.nn.models.ROISegmentationModel import ROISegmentationModel
+        self.model_cls = ROISegmentationModel
+
+    @staticmethod
+    def pil_indices(src_size, dst_size):
+        row = Image.fromarray(np.arange(src_size, dtype=np.int32)[None])
+        return np.array(row.resize((dst_size, 1), resample=Image.NEAREST))[0]
+
+    def test_nearest_indices_match_pil(self):
+        sizes = [(src, dst) for src in range(1, 65) for dst in range(1, 65)]
+        sizes += [(256, dst) for dst in range(1, 1200, 7)]
+        for src, dst in sizes:
+            np.testing.assert_array_equal(self.model_cls._nearest_indices(src, dst), self.pil_indices(src, dst),
+                                          err_msg=f'{src} -> {dst}')
+
+    def test_resize_masks_match_pil(self):
+        import torch
+
+        rng = np.random.default_rng(13)
+        masks = rng.random((5, 32, 32)) < 0.5
+        heights = [32, 7, 90, 1, 45]
+        widths = [32, 50, 13, 64, 45]
+        model = self.model_cls.__new__(self.model_cls)
+        resized = model._resize_masks(torch.from_numpy(masks), heights, widths)
+        for mask, result, height, width in zip(masks, resized, heights, widths):
+            expected = Image.fromarray(mask.astype(np.uint8)).resize((width, height), resample=Image.NEAREST)
+            self.assertEqual(result.dtype, bool)
+            np.testing.assert_array_equal(result, np.array(expected).astype(bool))
+
+
+class ResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.weights = self.tmp / "weights.pt"
+        self.weights.write_bytes(b"weights v1")
+        model_settings = {"detection": {"all": str(self.weights)}, "segmentation": {}, "classification": {}}
+        patcher = mock.patch.object(cache, "settings", model_settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = cache.ResultCache(self.tmp / "cache", max_bytes=1 << 20)
+
+    def test_key(self):
+        params = {"crop_step": 1, "tracker": "abc"}
+        key = self.cache.key("frames", params)
+        self.assertEqual(key, self.cache.key("frames", {"tracker": "abc", "crop_step": 1}))
+        self.assertNotEqual(key, self.cache.key("other frames", params))
+        self.assertNotEqual(key, self.cache.key("frames", {**params, "crop_step": 2}))
+        self.assertNotEqual(key, self.cache.key("frames", {**params, "tracker": "def"}))
+
+    def test_key_follows_weights(self):
+        key = self.cache.key("frames", {})
+        self.weights.write_bytes(b"weights v2")
+        os.utime(self.weights, ns=(0, 1))
+        self.assertNotEqual(key, self.cache.key("frames", {}))
+
+    def test_put_get(self):
+        key = self.cache.key("frames", {})
+        self.assertIsNone(self.cache.get(key))
+        value = {"nodules": [1, 2], "masks": np.arange(6).reshape(2, 3)}
+        self.cache.put(key, value)
+        cached = self.cache.get(key)
+        self.assertEqual(cached["nodules"], [1, 2])
+        np.testing.assert_array_equal(cached["masks"], value["masks"])
+
+    def test_broken_entry_is_dropped(self):
+        key = self.cache.key("frames", {})
+        self.cache.put(key, [1])
+        self.cache._path(key).write_bytes(b"not a pickle")
+        self.assertIsNone(self.cache.get(key))
+        self.assertFalse(self.cache._path(key).exists())
+
+    def test_shrink_drops_least_recently_read(self):
+        keys = [self.cache.key(f"frames {i}", {}) for i in range(4)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, bytes(1000))
+            os.utime(self.cache._path(key), (i, i))
+        entry_size = self.cache._path(keys[0]).stat().st_size
+        # чтение обновляет время записи: первая запись становится самой свежей
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.cache.max_bytes = 3 * entry_size
+        new_key = self.cache.key("frames 4", {})
+        self.cache.put(new_key, bytes(1000))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNone(self.cache.get(keys[2]))
+        for key in (keys[0], keys[3], new_key):
+            self.assertIsNotNone(self.cache.get(key))
+
+
+class StagedPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def record(self, stage, payload):
+        with self.lock:
+            self.processed.append((stage, payload))
+
+    def test_items_flow_through_stages(self):
+        def split(payload, emit):
+            for i in range(payload):
+                emit(i)
+
+        def square(payload, emit):
+            emit(payload * payload, to="collect" if payload % 2 else None)
+
+        def halve(payload, emit):
+            emit(payload // 2)
+
+        stages = [
+            Stage("split", split),
+            Stage("square", square, workers=3),
+            Stage("halve", halve),
+            Stage("collect", lambda payload, emit: self.record("collect", payload)),
+        ]
+        StagedPipeline(stages, queue_size=2).run(6)
+        self.assertEqual(sorted(p for _, p in self.processed), sorted([0, 1, 2, 9, 8, 25]))
+
+    def test_error_fails_job_and_skips_rest(self):
+        def split(payload, emit):
+            for i in range(payload):
+                emit(i)
+
+        def check(payload, emit):
+            if payload == 0:
+                raise RuntimeError("bad item")
+            emit(payload)
+
+        stages = [Stage("split", split), Stage("check", check), Stage("collect", lambda p, e: self.record("c", p))]
+        with self.assertRaisesRegex(RuntimeError, "bad item"):
+            StagedPipeline(stages).run(5)
+        self.assertEqual(self.processed, [])
+
+    def test_cannot_emit_backwards(self):
+        stages = [Stage("first", lambda p, emit: emit(p)), Stage("second", lambda p, emit: emit(p, to="first"))]
+        with self.assertRaises(ValueError):
+            StagedPipeline(stages).run(1)
+
+    def run_blocked(self, submissions):
+        """
+        Подает задачи (время подачи, delay, payload), пока единственный поток первой стадии
+        занят первой задачей, и возвращает порядок обработки остальных
+        """
+        gate = threading.Event()
+
+        def first(payload, emit):
+            if payload == "blocker":
+                gate.wait()
+            self.record("first", payload)
+
+        runner = StagedPipeline([Stage("first", first)])
+        clock = mock.Mock()
+        with mock.patch.object(pipeline, "time", clock):
+            clock.monotonic.return_value = 0.0
+            futures = [runner.submit("blocker")]
+            # ждем, пока поток стадии заберет задачу-блокер из очереди
+            while runner._queues[0].qsize():
+                time.sleep(0.001)
+            for submitted, delay, payload in submissions:
+                clock.monotonic.return_value = submitted
+                futures.append(runner.submit(payload, delay=delay))
+        gate.set()
+        for future in futures:
+            future.result(timeout=5)
+        return [payload for _, payload in self.processed[1:]]
+
+    def test_cheap_jobs_overtake_expensive(self):
+        order = self.run_blocked([(1.0, 30.0, "expensive"), (2.0, 0.0, "cheap"), (3.0, 0.0, "cheap 2")])
+        self.assertEqual(order, ["cheap", "cheap 2", "expensive"])
+
+    def test_expensive_job_ages(self):
+        # срок дорогой задачи 31 наступает раньше срока задач, поданных после него
+        order = self.run_blocked([(1.0, 30.0, "expensive"), (40.0, 0.0, "late cheap"), (5.0, 0.0, "early cheap")])
+        self.assertEqual(order, ["early cheap", "expensive", "late cheap"])
+
+    def test_equal_deadlines_keep_submission_order(self):
+        order = self.run_blocked([(1.0, 0.0, "a"), (1.0, 0.0, "b"), (1.0, 0.0, "c")])
+        self.assertEqual(order, ["a", "b", "c"])
+
+
+# Хранилище кадров, записанное medweb (medml.frame_store), - копия medml/testdata;
+# medweb проверяет его по тому же дайджесту и по своему writer'у
+TESTDATA_STUDY = Path(__file__).resolve().parent / "testdata" / "study"
+FRAME_STORE_FIXTURE_DIGEST = "813587a984b074e8581b610d849f2fe27c4db548390f7023874559be948813b3"
+DECODED_CACHE_FIXTURE_DIGEST = "701906813bc551f20a22bd36c072dc04d73e0686c155c38f48ab266a278b0209"
+
+
+def fixture_frames():
+    """
+    Кадры хранилища из testdata, та же формула - в medml/tests.py
+    """
+    frames = (np.arange(3 * 24 * 32 * 3) * 37 % 200 + 40).astype(np.uint8).reshape(3, 24, 32, 3)
+    frames[:, :3] = 0
+    frames[:, -2:] = 0
+    frames[:, :, :4] = 0
+    frames[:, :, -3:] = 0
+    return frames
+
+
+class FrameStoreReaderTests(SimpleTestCase):
+    def test_fixture_digest(self):
+        directory = frame_store.frame_store_path(TESTDATA_STUDY / "main.tiff")
+        digest = hashlib.sha256()
+        for name in (frame_store.INDEX_NAME, frame_store.DATA_NAME):
+            digest.update((directory / name).read_bytes())
+        self.assertEqual(digest.hexdigest(), FRAME_STORE_FIXTURE_DIGEST)
+
+    def test_reads_medweb_store(self):
+        with frame_store.open_frame_store(TESTDATA_STUDY / "main.tiff") as store:
+            self.assertEqual(len(store), 3)
+            np.testing.assert_array_equal(np.stack(list(store)), fixture_frames())
+            np.testing.assert_array_equal(store[-1], fixture_frames()[-1])
+
+    def test_unknown_format_is_ignored(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tiff_path = Path(tmp) / "main.tiff"
+            directory = frame_store.frame_store_path(tiff_path)
+            shutil.copytree(frame_store.frame_store_path(TESTDATA_STUDY / "main.tiff"), directory)
+            index = json.loads((directory / frame_store.INDEX_NAME).read_text())
+            without_format = {key: value for key, value in index.items() if key != "format"}
+            for broken in (without_format, {**index, "version": frame_store.VERSION + 1}):
+                (directory / frame_store.INDEX_NAME).write_text(json.dumps(broken))
+                with self.assertRaises(ValueError):
+                    frame_store.FrameStore(directory)
+                self.assertIsNone(frame_store.open_frame_store(tiff_path))
+
+
+class NpyFrameReaderTests(SimpleTestCase):
+    """
+    main.npy и main.crop.json из testdata записаны medweb (medml.decoded_cache)
+    """
+
+    def test_fixture_digest(self):
+        digest = hashlib.sha256()
+        for path in NpyFrameReader.paths(TESTDATA_STUDY / "main.tiff"):
+            digest.update(path.read_bytes())
+        self.assertEqual(digest.hexdigest(), DECODED_CACHE_FIXTURE_DIGEST)
+
+    def test_reads_medweb_frames(self):
+        reader = open_frame_reader(str(TESTDATA_STUDY / "main.tiff"))
+        self.assertIsInstance(reader, NpyFrameReader)
+        self.assertEqual(reader.size, (32, 24))
+        np.testing.assert_array_equal(np.stack([reader.read(i) for i in range(len(reader))]), fixture_frames())
+
+    def test_precomputed_crop_matches_dataset(self):
+        from nnmodel.nn.datasets.ThyroidUltrasoundDataset import ThyroidUltrasoundDataset
+
+        reader = open_frame_reader(str(TESTDATA_STUDY / "main.tiff"))
+        grey = np.stack([reader.read_grey(i) for i in range(len(reader))])
+        self.assertEqual(reader.crop_window(1), ThyroidUltrasoundDataset.crop_window(grey))
+        self.assertIsNone(reader.crop_window(2))
+
+    def test_unknown_format_falls_back(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tiff_path = Path(tmp) / "main.tiff"
+            frames_path, meta_path = NpyFrameReader.paths(tiff_path)
+            shutil.copy(TESTDATA_STUDY / "main.npy", frames_path)
+            shutil.copytree(frame_store.frame_store_path(TESTDATA_STUDY / "main.tiff"),
+                            frame_store.frame_store_path(tiff_path))
+            meta = json.loads(NpyFrameReader.paths(TESTDATA_STUDY / "main.tiff")[1].read_text())
+            meta_path.write_text(json.dumps({**meta, "version": NpyFrameReader.VERSION + 1}))
+            with self.assertRaises(ValueError):
+                NpyFrameReader(frames_path, meta_path)
+            self.assertIsInstance(open_frame_reader(str(tiff_path)), FrameStoreReader)
@@ -12,7 +12,13 @@ python ./dj_nnapi/manage.py makemigrations nnmodel
 python ./dj_nnapi/manage.py migrate nnmodel
 #export wsgi_start=1
 cd ./dj_nnapi
-python manage.py rundramatiq --processes 4 --threads 4 -v 2 --queues predict_all
+# Модели загружаются один раз в родительском процессе и разделяются воркерами.
+# Большие исследования (predict_all_large) обрабатывают свои LARGE_WORKERS процессов
+# по LARGE_THREADS потоков, остальные процессы - только predict_all
+python manage.py rundramatiq_shared --processes ${WORKERS:-3} --threads ${THREADS:-4} -v 2 \
+  --queues predict_all predict_all_large \
+  --large-processes ${LARGE_WORKERS:-1} --large-threads ${LARGE_THREADS:-1}
+#python manage.py rundramatiq --processes 4 --threads 4 -v 2 --queues predict_all
 #python3 -m celery -A dj_nnapi worker -P solo -l info --without-heartbeat --concurrency=1
 # gunicorn -w 1 -b 0.0.0.0:8000 -t 120 --log-level debug dj_nnapi.wsgi:application
 
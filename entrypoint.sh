@@ -27,7 +27,15 @@ else
   python manage.py base_configuration
   #python manage.py collectstatic --noinput
 
-  python manage.py runserver
+  # ход обработки снимка (SSE, /api/v3/uzi/<id>/progress/) - ASGI сервер на SSE_PORT:
+  # открытый поток не занимает поток воркера
+  python -m uvicorn medweb.asgi:application --host 0.0.0.0 --port ${SSE_PORT:-8001} --workers ${SSE_WORKERS:-1} &
+
+  # остальной API - синхронный DRF: под ASGI Django выполняет синхронные представления
+  # в одном потоке на процесс, поэтому API обслуживает WSGI сервер с потоками.
+  # WEB_WORKERS процессов по WEB_THREADS потоков, по умолчанию процесс на ядро
+  python -m gunicorn medweb.wsgi:application --bind 0.0.0.0:8000 \
+    --worker-class gthread --workers ${WEB_WORKERS:-$(nproc)} --threads ${WEB_THREADS:-8}
 
 fi
 
@@ -0,0 +1,99 @@
+"""
+Компактное хранение контуров сегмента.
+
+Точки сегмента (x, y, z) хранятся одним бинарным блобом вместо строки
+SegmentationPoint на каждую вершину. Точки разбиваются на серии подряд идущих
+точек с одинаковым z (обычно - контур одного слайда), каждая серия хранится как
+первая точка и дельты соседних вершин в int16 (int32, если дельта не помещается).
+Порядок точек сохраняется, uid точки - её индекс в сегменте.
+
+Формат (little-endian):
+    b"CNT1"
+    серия: z:i4, n:i4, x0:i4, y0:i4, itemsize:u1, дельты (n - 1, 2) размера itemsize
+"""
+import struct
+
+import numpy as np
+
+MAGIC = b"CNT1"
+_RUN_HEADER = struct.Struct("<iiiiB")
+# точек в сегменте не больше, чем PACKED_ID_STRIDE: id точек разных сегментов не пересекаются
+PACKED_ID_STRIDE = 1 << 24
+
+
+def pack_points(points) -> bytes:
+    """
+    Упаковка точек сегмента в блоб
+    :param points - массив (K, 3) или последовательность точек (x, y, z), K <= PACKED_ID_STRIDE
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 3)
+    if len(points) > PACKED_ID_STRIDE:
+        # uid таких точек не помещается в packed_point_id и совпал бы с id точек следующего сегмента
+        raise ValueError(f"Segment has {len(points)} points, at most {PACKED_ID_STRIDE} can be packed")
+    parts = [MAGIC]
+    if not len(points):
+        return b"".join(parts)
+
+    z = points[:, 2]
+    bounds = np.flatnonzero(np.diff(z)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(points)]))
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        xy = points[start:end, :2]
+        deltas = np.diff(xy, axis=0)
+        fits_i2 = not len(deltas) or (deltas.min() >= -(2 ** 15) and deltas.max() < 2 ** 15)
+        dtype = np.dtype("<i2") if fits_i2 else np.dtype("<i4")
+        parts.append(_RUN_HEADER.pack(int(z[start]), end - start, int(xy[0, 0]), int(xy[0, 1]), dtype.itemsize))
+        parts.append(deltas.astype(dtype).tobytes())
+    return b"".join(parts)
+
+
+def unpack_points(blob) -> np.ndarray:
+    """
+    Распаковка блоба в int64 массив (K, 3) точек (x, y, z)
+    :param blob - результат pack_points
+    """
+    blob = bytes(blob)
+    if blob[:len(MAGIC)] != MAGIC:
+        raise ValueError("Unknown contour blob format")
+
+    runs = []
+    offset = len(MAGIC)
+    while offset < len(blob):
+        z, n, x0, y0, itemsize = _RUN_HEADER.unpack_from(blob, offset)
+        offset += _RUN_HEADER.size
+        deltas = np.frombuffer(blob, dtype=f"<i{itemsize}", count=(n - 1) * 2, offset=offset)
+        offset += deltas.nbytes
+
+        run = np.empty(shape=(n, 3), dtype=np.int64)
+        run[0, :2] = (x0, y0)
+        run[1:, :2] = deltas.reshape(-1, 2)
+        np.cumsum(run[:, :2], axis=0, out=run[:, :2])
+        run[:, 2] = z
+        runs.append(run)
+
+    if not runs:
+        return np.empty(shape=(0, 3), dtype=np.int64)
+    return np.concatenate(runs)
+
+
+def packed_point_id(segment_id: int, uid: int) -> int:
+    """
+    id упакованной точки: у неё нет строки SegmentationPoint, id выводится из id сегмента
+    и uid, поэтому не меняется между запросами. Отрицательный, чтобы не совпасть с id
+    строк SegmentationPoint
+    """
+    if not 0 <= uid < PACKED_ID_STRIDE:
+        raise ValueError(f"Point uid {uid} is out of range [0, {PACKED_ID_STRIDE})")
+    return -(segment_id * PACKED_ID_STRIDE + uid) - 1
+
+
+def unpack_point_dicts(blob, segment_id: int) -> list:
+    """
+    Распаковка блоба в список точек в формате SegmentationPoint (id, uid, x, y, z)
+    :param segment_id - id SegmentationData, из него выводятся id точек (packed_point_id)
+    """
+    return [
+        {"id": packed_point_id(segment_id, uid), "uid": uid, "x": x, "y": y, "z": z}
+        for uid, (x, y, z) in enumerate(unpack_points(blob).tolist())
+    ]
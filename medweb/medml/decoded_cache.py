@@ -0,0 +1,95 @@
+"""
+Декодированные кадры исследования для dj_nnapi.
+
+При загрузке рядом с main.tiff пишутся main.npy - RGB uint8 кадры (N, H, W, 3),
+в точности те, что воркер получил бы, декодируя main.tiff через PIL, - и main.crop.json
+с окном обрезки нерелевантных областей. Воркер отображает main.npy в память
+(nnmodel.nn.loaders.frame_reader.NpyFrameReader) и не декодирует файл повторно.
+Окно обрезки считается тем же алгоритмом, что ThyroidUltrasoundDataset.crop_window_from_sums
+(копия ниже), формат метаданных должен совпадать с читателем в dj_nnapi.
+
+main.crop.json:
+    {"format": "uzi-decoded-frames", "version": 1, "crop_step": 1, "crop": [x_cut_min, x_cut_max, y_cut_min, y_cut_max]}
+"""
+import json
+import os
+from concurrent.futures import Executor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+FORMAT = "uzi-decoded-frames"
+VERSION = 1
+FRAMES_SUFFIX = ".npy"
+META_SUFFIX = ".crop.json"
+
+
+def decoded_cache_paths(tiff_path) -> tuple[Path, Path]:
+    """
+    Файлы кадров и метаданных для канонического TIFF (main.tiff -> main.npy, main.crop.json)
+    """
+    tiff_path = Path(tiff_path)
+    return tiff_path.with_suffix(FRAMES_SUFFIX), tiff_path.with_suffix(META_SUFFIX)
+
+
+def crop_window_from_sums(row_sums: np.ndarray, col_sums: np.ndarray) -> tuple[int, int, int, int]:
+    """
+    Копия ThyroidUltrasoundDataset.crop_window_from_sums из dj_nnapi
+    :param row_sums - суммы яркости по строкам кадров (N, H)
+    :param col_sums - суммы яркости по столбцам кадров (N, W)
+    :return - (min_row, max_row, min_col, max_col)
+    """
+    value_thresold = 5
+    height = row_sums.shape[1]
+    width = col_sums.shape[1]
+    x_hold_range = list((height * np.array([0.8 / 3, 2.2 / 3])).astype(np.int_))
+    y_hold_range = list((width * np.array([0.8 / 3, 1.8 / 3])).astype(np.int_))
+
+    x_dark = row_sums <= value_thresold * width
+    y_dark = col_sums <= value_thresold * height
+    x_idx = np.arange(height)
+    y_idx = np.arange(width)
+
+    x_cut_min = np.where(x_dark & (x_idx <= x_hold_range[0]), x_idx, 0).max(axis=1).min()
+    x_cut_max = np.where(x_dark & (x_idx >= x_hold_range[1]), x_idx, height).min(axis=1).max()
+    y_cut_min = np.where(y_dark & (y_idx <= y_hold_range[0]), y_idx, 0).max(axis=1).min()
+    y_cut_max = np.where(y_dark & (y_idx >= y_hold_range[1]), y_idx, width).min(axis=1).max()
+
+    return int(x_cut_min), int(x_cut_max), int(y_cut_min), int(y_cut_max)
+
+
+def _convert_frame(out: np.ndarray, idx: int, frame: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    with Image.fromarray(frame) as img:
+        out[idx] = np.asarray(img.convert("RGB"))
+        grey = np.asarray(img.convert("L"))
+    return grey.sum(axis=1, dtype=np.uint32), grey.sum(axis=0, dtype=np.uint32)
+
+
+def write_decoded_cache(tiff_path, frames: np.ndarray, pool: Executor) -> None:
+    """
+    Пишет main.npy и main.crop.json; кадры преобразуются в RGB параллельно в pool
+    :param tiff_path - путь к main.tiff
+    :param frames - кадры (N, H, W[, C]), из которых записан main.tiff
+    """
+    frames_path, meta_path = decoded_cache_paths(tiff_path)
+    meta_path.unlink(missing_ok=True)
+    tmp_path = frames_path.with_name(f"{frames_path.stem}.{os.getpid()}.tmp.npy")
+    out = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.uint8, shape=(len(frames), *frames.shape[1:3], 3)
+    )
+    try:
+        futures = [pool.submit(_convert_frame, out, idx, frame) for idx, frame in enumerate(frames)]
+        sums = [future.result() for future in futures]
+        out.flush()
+    finally:
+        del out
+    os.replace(tmp_path, frames_path)
+
+    crop = None
+    if sums:
+        crop = crop_window_from_sums(np.stack([s[0] for s in sums]), np.stack([s[1] for s in sums]))
+    tmp_meta = meta_path.with_name(f"{meta_path.name}.{os.getpid()}.tmp")
+    with open(tmp_meta, "w") as f:
+        json.dump({"format": FORMAT, "version": VERSION, "crop_step": 1, "crop": crop}, f)
+    os.replace(tmp_meta, meta_path)
@@ -1,12 +1,17 @@
 import os
+from concurrent.futures import Executor, ThreadPoolExecutor
 from typing import IO, TYPE_CHECKING
 from PIL import Image
+from django.conf import settings
 from django.db.models import FileField
 from django.db.models.fields.files import FieldFile, FileDescriptor
 import numpy
 import tifffile
 import pydicom
 
+from medml.decoded_cache import write_decoded_cache
+from medml.frame_store import frame_store_path, open_frame_store, write_frame_store
+
 
 class DicomAndTiffFileDescriptor(FileDescriptor):
 
@@ -47,6 +52,18 @@ class DicomAndTiffFile(FieldFile):
     def pngs_len(self):
         return len(os.listdir(self.storage.path(self.png_files)))
 
+    @property
+    def frames_count(self):
+        """
+        Число кадров по покадровому хранилищу или страницам main.tiff, без декодирования кадров
+        """
+        store = open_frame_store(self.tiff_file_path)
+        if store is not None:
+            with store:
+                return len(store)
+        with tifffile.TiffFile(self.tiff_file_path) as tif:
+            return len(tif.pages)
+
     @property
     def slide_template(self):
         return (
@@ -68,32 +85,63 @@ class DicomAndTiffFile(FieldFile):
         os.makedirs(slides_dir, 0o777, exist_ok=True)
         return fbase, filee.lower(), slides_dir
 
-    def save_jpeg(self, name: str, content: IO):
+    def _write_slide(self, slides_dir: str, idx: int, slide: numpy.ndarray):
+        slide_name = slides_dir + '/' + self.field.slide_name.format(idx + 1)
+        with open(slide_name, "wb") as out:
+            with Image.fromarray(slide) as img:
+                img.save(out)
+
+    def save_jpeg(self, name: str, content: IO, frames: numpy.ndarray = None, pool: Executor = None):
+        """
+        Сохраняет кадры в PNG. Кодирование PNG (zlib) отпускает GIL,
+        поэтому кадры кодируются параллельно в пуле потоков
+        :param frames - уже декодированные кадры (_decode), иначе content декодируется заново
+        :param pool - пул потоков, иначе создается свой на INGEST_WORKERS потоков
+        """
         fbase, filee, slides_dir = self._prepare_file(name, content)
         try:
-            tiff_desc, get_tiff = self._get_tiff(filee, content)
-            for idx, slide in enumerate(get_tiff):
-                slide_name = slides_dir + '/' + self.field.slide_name.format(idx + 1)
-                with open(slide_name, "wb") as out:
-                    with Image.fromarray(slide) as img:
-                        img.save(out)
+            if frames is None:
+                frames = self._decode(filee, content)
+            if pool is None:
+                with ThreadPoolExecutor(max_workers=settings.INGEST_WORKERS) as own_pool:
+                    return self.save_jpeg(name, content, frames, own_pool)
+            futures = [
+                pool.submit(self._write_slide, slides_dir, idx, slide)
+                for idx, slide in enumerate(frames)
+            ]
+            for future in futures:
+                future.result()
         except Exception as e:
             raise Exception(str(e)) from e
         return 1
 
     def _get_tiff(self, filee: str, content: IO):
+        """
+        :return - описание файла и его кадры вида (N, H, W[, C]). Число кадров берется
+            из метаданных: страницы TIFF, NumberOfFrames DICOM, один кадр у остальных
+        """
         content.seek(0)
         match filee := filee.lower():
             case ".tif" | ".tiff":
                 try:
-                    t = tifffile.imread(content)
-                    return t, t
+                    with tifffile.TiffFile(content) as tif:
+                        series = tif.series[0]
+                        t = series.asarray()
+                        keyframe = series.keyframe
+                    frames = t.reshape(-1, *keyframe.shape)
+                    # отдельные плоскости каналов (S, H, W) -> (H, W, S)
+                    if keyframe.planarconfig == tifffile.PLANARCONFIG.SEPARATE and keyframe.samplesperpixel > 1:
+                        frames = numpy.moveaxis(frames, 1, -1)
+                    return t, frames
                 except tifffile.TiffFileError as e:
                     raise AttributeError(f"Битый .tif файл. {e}")
             case ".dcm":
                 try:
                     t = pydicom.dcmread(content)
-                    return t, t.pixel_array
+                    frames = t.pixel_array
+                    if int(t.get("NumberOfFrames", 1) or 1) == 1:
+                        frames = frames[numpy.newaxis]
+                    return t, frames
                 except Exception as e:
                     raise AttributeError(f"Битый .dcm файл.")
             case _:
@@ -103,22 +151,34 @@ class DicomAndTiffFile(FieldFile):
                 except Exception as e:
                     raise AttributeError(f"Битый файл.")
 
-    def save_tiff(self, name: str, content: IO):
+    def _decode(self, filee: str, content: IO) -> numpy.ndarray:
+        """
+        Кадры загруженного файла одним массивом вида (N, H, W[, C])
+        """
+        tiff_descr, tiff_get = self._get_tiff(filee, content)
+        return tiff_get
+
+    def save_tiff(self, name: str, content: IO, frames: numpy.ndarray = None):
+        """
+        :param frames - уже декодированные кадры (_decode), иначе content декодируется заново
+        :return - число кадров, высота и ширина кадра
+        """
         fbase, filee, slides_dir = self._prepare_file(name, content)
         try:
-            tiff_descr, tiff_get = self._get_tiff(filee, content)
+            if frames is None:
+                frames = self._decode(filee, content)
 
             with open(fbase + '/' + self.field.tiff_name, "wb") as out:
                 tifffile.imwrite(
                     out,
-                    tiff_get,
+                    frames,
 
 #                    photometric="rgb",
 #                    compression="zlib",
 #                    compression=tifffile.COMPRESSION.PNG,
                     compressionargs={"level": 9},
                 )
-            return len(tiff_get)
+            return frames.shape[:3]
         except Exception as e:
             raise Exception(str(e)) from e
 
@@ -129,10 +189,30 @@ class DicomAndTiffFile(FieldFile):
         )
         setattr(self.instance, self.field.attname, self.name)
         full_path = self.storage.path(self.name)
-        n_slides = self.save_tiff(full_path, content)
-        self.save_jpeg(full_path, content)
+        # файл декодируется один раз; TIFF пишется параллельно с кодированием PNG.
+        # Без EAGER_SLIDE_EXPORT PNG не пишутся: слайды рендерятся по запросу (SlideView)
+        fbase, filee, slides_dir = self._prepare_file(full_path, content)
+        try:
+            frames = self._decode(filee, content)
+        except Exception as e:
+            raise Exception(str(e)) from e
+        with ThreadPoolExecutor(max_workers=settings.INGEST_WORKERS) as pool:
+            tiff_future = pool.submit(self.save_tiff, full_path, content, frames)
+            if settings.FRAME_STORE:
+                write_frame_store(
+                    frame_store_path(fbase + '/' + self.field.tiff_name),
+                    frames,
+                    level=settings.FRAME_STORE_LEVEL,
+                    pool=pool,
+                )
+            if settings.DECODED_CACHE:
+                write_decoded_cache(fbase + '/' + self.field.tiff_name, frames, pool)
+            if settings.EAGER_SLIDE_EXPORT:
+                self.save_jpeg(full_path, content, frames, pool)
+            n_slides, slide_height, slide_width = tiff_future.result()
         self._committed = True
         setattr(self.instance, "image_count", n_slides)
+        setattr(self.instance, "slide_size", (slide_height, slide_width))
         if save:
             self.instance.save()
 
@@ -0,0 +1,145 @@
+"""
+Покадровое хранилище исследования.
+
+Каталог main.frames рядом с main.tiff: кадры сжаты zlib каждый отдельно
+и записаны подряд в frames.bin, index.json хранит форму и тип кадра и смещение
+сжатого кадра в frames.bin. Любой кадр читается без чтения остальных:
+frames.bin отображается в память, распаковывается только нужный срез.
+Кадры сжимаются параллельно (zlib отпускает GIL). index.json пишется последним,
+поэтому читатель видит хранилище только целиком. Копия читателя - в dj_nnapi
+(nnmodel.nn.loaders.frame_store), формат должен совпадать.
+
+index.json:
+    {"format": "uzi-frame-store", "version": 1, "codec": "zlib", "count": N, "shape": [H, W(, C)],
+     "dtype": "uint8", "offsets": [0, ..., размер frames.bin]}
+"""
+import json
+import mmap
+import os
+import zlib
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+FORMAT = "uzi-frame-store"
+VERSION = 1
+INDEX_NAME = "index.json"
+DATA_NAME = "frames.bin"
+STORE_SUFFIX = ".frames"
+
+
+def frame_store_path(tiff_path) -> Path:
+    """
+    Каталог хранилища для канонического TIFF (main.tiff -> main.frames)
+    """
+    return Path(tiff_path).with_suffix(STORE_SUFFIX)
+
+
+def has_frame_store(tiff_path) -> bool:
+    return (frame_store_path(tiff_path) / INDEX_NAME).exists()
+
+
+def open_frame_store(tiff_path) -> Optional["FrameStore"]:
+    """
+    Хранилище канонического TIFF или None, если его нет или его формат (format/version
+    в index.json) не поддерживается - тогда кадры читаются из самого TIFF
+    """
+    if not has_frame_store(tiff_path):
+        return None
+    try:
+        return FrameStore(frame_store_path(tiff_path))
+    except ValueError as e:
+        print(e)
+        return None
+
+
+def _compress(frame: np.ndarray, level: int) -> bytes:
+    return zlib.compress(np.ascontiguousarray(frame).data, level)
+
+
+def write_frame_store(directory, frames: np.ndarray, level: int = 3, pool: Executor = None) -> None:
+    """
+    Записывает кадры в хранилище
+    :param directory - каталог хранилища
+    :param frames - кадры (N, H, W[, C])
+    :param level - уровень сжатия zlib
+    :param pool - пул потоков для сжатия, иначе создается свой
+    """
+    if pool is None:
+        with ThreadPoolExecutor() as own_pool:
+            return write_frame_store(directory, frames, level, own_pool)
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / INDEX_NAME).unlink(missing_ok=True)
+
+    futures = [pool.submit(_compress, frame, level) for frame in frames]
+    offsets = [0]
+    with open(directory / DATA_NAME, "wb") as out:
+        for future in futures:
+            chunk = future.result()
+            out.write(chunk)
+            offsets.append(offsets[-1] + len(chunk))
+
+    index = {
+        "format": FORMAT,
+        "version": VERSION,
+        "codec": "zlib",
+        "count": len(frames),
+        "shape": list(frames.shape[1:]),
+        "dtype": frames.dtype.str,
+        "offsets": offsets,
+    }
+    tmp_path = directory / f"{INDEX_NAME}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as out:
+        json.dump(index, out)
+    os.replace(tmp_path, directory / INDEX_NAME)
+
+
+class FrameStore:
+    """
+    Чтение кадров хранилища по номеру
+    """
+
+    def __init__(self, directory) -> None:
+        directory = Path(directory)
+        with open(directory / INDEX_NAME) as f:
+            index = json.load(f)
+        header = (index.get("format"), index.get("version"), index.get("codec"))
+        if header != (FORMAT, VERSION, "zlib"):
+            raise ValueError(f"Unsupported frame store {directory}: {'/'.join(map(str, header))}")
+        self.directory = directory
+        self.shape = tuple(index["shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self._offsets = index["offsets"]
+        self._count = index["count"]
+        with open(directory / DATA_NAME, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._offsets[-1] else b""
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError(idx)
+        with memoryview(self._data) as data:
+            raw = zlib.decompress(data[self._offsets[idx]:self._offsets[idx + 1]])
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.shape)
+
+    def __iter__(self):
+        for idx in range(self._count):
+            yield self[idx]
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self) -> "FrameStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,58 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from medml import contours
+from medml.models import SegmentationData, SegmentationPoint
+
+
+class Command(BaseCommand):
+    help = "pack SegmentationPoint rows into SegmentationData.points_blob"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=100, help="segments per transaction"
+        )
+        parser.add_argument(
+            "--keep-rows",
+            action="store_true",
+            help="do not delete SegmentationPoint rows after packing",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options["batch_size"])
+        segment_ids = list(
+            SegmentationData.objects.filter(
+                points_blob__isnull=True, points__isnull=False
+            )
+            .distinct()
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        self.stdout.write(f"segments to pack: {len(segment_ids)}")
+
+        packed_points = 0
+        for start in range(0, len(segment_ids), batch_size):
+            batch_ids = segment_ids[start:start + batch_size]
+            with transaction.atomic():
+                for segment_id in batch_ids:
+                    # порядок вставки точек - порядок вершин контура
+                    points = np.array(
+                        SegmentationPoint.objects.filter(segment_id=segment_id)
+                        .order_by("id")
+                        .values_list("x", "y", "z"),
+                        dtype=np.int64,
+                    )
+                    SegmentationData.objects.filter(id=segment_id).update(
+                        points_blob=contours.pack_points(points)
+                    )
+                    packed_points += len(points)
+                if not options["keep_rows"]:
+                    SegmentationPoint.objects.filter(segment_id__in=batch_ids).delete()
+            self.stdout.write(f"packed {start + len(batch_ids)}/{len(segment_ids)}")
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"packed {packed_points} points of {len(segment_ids)} segments"
+            )
+        )
@@ -0,0 +1,90 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dramatiq
+import pika
+import redis
+from django.conf import settings
+from dramatiq.brokers.rabbitmq import RabbitmqBroker
+from dramatiq.results.backends.redis import RedisBackend
+
+_redis_pool = None
+_redis_pool_lock = threading.Lock()
+
+
+def get_redis() -> redis.Redis:
+    """
+    Клиент Redis на общем для процесса пуле соединений.
+    Соединения, простаивавшие дольше HEALTH_CHECK_INTERVAL, проверяются PING перед использованием
+    """
+    global _redis_pool
+    if _redis_pool is None:
+        with _redis_pool_lock:
+            if _redis_pool is None:
+                _redis_pool = redis.BlockingConnectionPool.from_url(
+                    settings.RESULT_REDIS_URL,
+                    max_connections=settings.MESSAGING["REDIS_MAX_CONNECTIONS"],
+                    timeout=settings.MESSAGING["REDIS_POOL_TIMEOUT"],
+                    health_check_interval=settings.MESSAGING["HEALTH_CHECK_INTERVAL"],
+                    socket_keepalive=True,
+                    retry_on_timeout=True,
+                )
+    return redis.Redis(connection_pool=_redis_pool)
+
+
+class Publisher:
+    """
+    Постановка сообщений dramatiq в RabbitMQ через постоянные соединения.
+
+    RabbitmqBroker держит соединение и канал на поток, а запросы обрабатываются
+    в разных (у runserver - новых) потоках, поэтому каждая загрузка открывала
+    бы свое соединение AMQP. Publisher публикует из небольшого пула постоянных
+    потоков: каждый поток переиспользует свой канал с подтверждениями публикации.
+    Простаивавшее соединение проверяется перед публикацией и при обрыве
+    переоткрывается; обрыв во время публикации обрабатывает сам брокер.
+    """
+
+    def __init__(self, broker: RabbitmqBroker, workers: int, health_check_interval: float) -> None:
+        self.broker = broker
+        self.health_check_interval = health_check_interval
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="amqp-publisher")
+        self._local = threading.local()
+
+    def enqueue(self, message: dramatiq.Message) -> dramatiq.Message:
+        return self._executor.submit(self._enqueue, message).result()
+
+    def _enqueue(self, message: dramatiq.Message) -> dramatiq.Message:
+        last_used = getattr(self._local, "last_used", None)
+        if last_used is not None and time.monotonic() - last_used > self.health_check_interval:
+            self._check_connection()
+        try:
+            return self.broker.enqueue(message)
+        finally:
+            self._local.last_used = time.monotonic()
+
+    def _check_connection(self) -> None:
+        try:
+            # обрабатывает heartbeat и входящие кадры, на закрытом соединении - исключение
+            self.broker.connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError as e:
+            print(f"AMQP connection is broken, reconnecting: {e!r}")
+            del self.broker.connection
+
+
+broker = RabbitmqBroker(
+    host=settings.RABBITMQ_HOST,
+    port=settings.RABBITMQ_PORT,
+    confirm_delivery=True,
+    heartbeat=settings.MESSAGING["AMQP_HEARTBEAT"],
+    blocked_connection_timeout=settings.MESSAGING["AMQP_BLOCKED_TIMEOUT"],
+)
+dramatiq.set_broker(broker)
+
+publisher = Publisher(
+    broker,
+    workers=settings.MESSAGING["PUBLISHER_THREADS"],
+    health_check_interval=settings.MESSAGING["HEALTH_CHECK_INTERVAL"],
+)
+
+result_backend = RedisBackend(client=get_redis())
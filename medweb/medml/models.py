@@ -160,6 +160,11 @@ class OriginalImage(models.Model):
         "Cнимок", upload_to=utils.originalUZIPath, validators=[dcm_validator]
     )
 
+    # заполняется DicomAndTiffFile.save при загрузке
+    image_count = models.IntegerField(
+        "Количество кадров", validators=[MinValueValidator(0)], default=0
+    )
+
     class Meta:
         verbose_name = "Снимок оригинала"
         verbose_name_plural = "Снимки оригиналов"
@@ -172,6 +177,9 @@ class SegmentationData(models.Model):
         "UZISegmentGroupInfo", models.CASCADE, related_name="data"
     )
 
+    # Упакованный контур сегмента (см. contours.py), None - точки хранятся в SegmentationPoint
+    points_blob = models.BinaryField(null=True, blank=True, editable=False)
+
     class Meta:
         managed = True
         verbose_name = "Сегмент"
@@ -259,6 +267,11 @@ class UZIImage(models.Model):
 
     details = models.JSONField("Детали диагностики")
 
+    # id сообщения predict_all, записывается при постановке в очередь (tasks.send_prediction_task)
+    prediction_job_id = models.CharField(
+        "Задача обработки", max_length=36, null=True, blank=True, editable=False, db_index=True
+    )
+
     image = models.OneToOneField(
         OriginalImage,
         verbose_name="Снимок",
@@ -14,7 +14,7 @@ from medml.models import (
     MLModel,
     dcm_validator,
 )
-from medml import utils
+from medml import contours, utils
 from medml.json_base.forms.UZIGroupForm import (
     UZIFormUpdate,
     UZIForm,
@@ -27,6 +27,7 @@ from django.db.models import F, Value, JSONField
 from django.db.models.expressions import CombinedExpression
 from django.forms.models import model_to_dict
 from django.db import transaction
+from django.conf import settings
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 
@@ -39,7 +40,9 @@ class RelativeURLMixin:
         if instance.image:
             response["image"] = instance.image.tiff_file_url
             response["image_original"] = instance.image.url
-            response["image_count"] = instance.image.pngs_len
+            response["image_count"] = (
+                instance.image_count or instance.image.frames_count
+            )
             response["slide_template"] = instance.image.slide_template
         return response
 
@@ -420,27 +423,81 @@ class UZIImageSupprotSerializer(ser.Serializer):
         return sz
 
 
+def save_segment_points(segment, points):
+    """
+    Сохранение точек сегмента в виде, заданном CONTOUR_STORAGE.
+    uid точки - её индекс в сегменте
+    :param segment - SegmentationData
+    :param points - список словарей с ключами x, y, z
+    """
+    if settings.NN_SETTINGS["CONTOUR_STORAGE"] == "blob":
+        try:
+            segment.points_blob = contours.pack_points(
+                [(pi["x"], pi["y"], pi.get("z", 0)) for pi in points]
+            )
+        except ValueError as er:
+            raise ser.ValidationError({"points": str(er)})
+        segment.save(update_fields=["points_blob"])
+        return
+
+    if segment.points_blob is not None:
+        segment.points_blob = None
+        segment.save(update_fields=["points_blob"])
+    inst_points = []
+    for i, pi in enumerate(points):
+        pi["segment"] = segment
+        pi["uid"] = i
+        inst_points.append(SegmentationPoint(**pi))
+    SegmentationPoint.objects.bulk_create(inst_points)
+
+
 class UZISegmentationPointSerializer(ser.ModelSerializer):
     class Meta:
         model = SegmentationPoint
         exclude = ["segment"]
 
 
+class UZISegmentationPackedPointSerializer(ser.Serializer):
+    """
+    Точки упакованного контура в формате UZISegmentationPointSerializer,
+    id точек выводятся из id сегмента (contours.packed_point_id)
+    """
+
+    id = ser.IntegerField(read_only=True)
+    uid = ser.IntegerField(read_only=True)
+    x = ser.IntegerField(read_only=True)
+    y = ser.IntegerField(read_only=True)
+    z = ser.IntegerField(read_only=True)
+
+
+def segment_points_representation(instance):
+    """
+    Точки сегмента из упакованного контура, если он есть, иначе None
+    """
+    if instance.points_blob is None:
+        return None
+    return UZISegmentationPackedPointSerializer(
+        contours.unpack_point_dicts(instance.points_blob, instance.id), many=True
+    ).data
+
+
 class UZISegmentationDataPointsSerializer(ser.ModelSerializer):
     points = UZISegmentationPointSerializer(many=True)
     details = UZISegmentationDataForm()
 
     def to_representation(self, instance):
-        points = instance.points.all()
+        packed_points = segment_points_representation(instance)
         tmp = model_to_dict(instance)
-        tmp["points"] = points
+        tmp["points"] = instance.points.all() if packed_points is None else []
         ret = super().to_representation(tmp)
+        if packed_points is not None:
+            ret["points"] = packed_points
         return ret
 
     class Meta:
         model = SegmentationData
         # fields = '__all__'
-        exclude = ["segment_group"]
+        exclude = ["segment_group", "points_blob"]
 
 
 class UZISegmentationDataSerializer(ser.ModelSerializer):
@@ -591,12 +648,7 @@ class UZISegmentationGroupCreateSerializer(ser.ModelSerializer):
             segment_group=segment_group, details=validated_data["details"]
         )
         # creating new points
-        inst_points = []
-        for i, pi in enumerate(points):
-            pi["segment"] = seg_object
-            pi["uid"] = i
-            inst_points.append(SegmentationPoint(**pi))
-        SegmentationPoint.objects.bulk_create(inst_points)
+        save_segment_points(seg_object, points)
         ret = model_to_dict(segment_group)
         ret["data"] = data
         return ret
@@ -647,12 +699,7 @@ class UZISegmentationAddSerializer(ser.ModelSerializer):
         points = validated_data.pop("points") or []
         seg_object = super().create(validated_data)
         # creating new points
-        inst_points = []
-        for i, pi in enumerate(points):
-            pi["segment"] = seg_object
-            pi["uid"] = i
-            inst_points.append(SegmentationPoint(**pi))
-        SegmentationPoint.objects.bulk_create(inst_points)
+        save_segment_points(seg_object, points)
         return seg_object
 
 
@@ -673,15 +720,17 @@ class UZISegmentationUpdateDeleteSerializer(ser.ModelSerializer):
         with transaction.atomic():
             if points:
                 SegmentationPoint.objects.filter(segment=instance).delete()
-                inst_points = []
-                for i, pi in enumerate(points):
-                    pi["segment"] = instance
-                    pi["uid"] = i
-                    inst_points.append(SegmentationPoint(**pi))
-                SegmentationPoint.objects.bulk_create(inst_points)
+                save_segment_points(instance, points)
 
         return super().update(instance, validated_data)
 
+    def to_representation(self, instance):
+        packed_points = segment_points_representation(instance)
+        ret = super().to_representation(instance)
+        if packed_points is not None:
+            ret["points"] = packed_points
+        return ret
+
 
 """ML"""
 
@@ -0,0 +1,132 @@
+"""
+Слайды исследования по запросу.
+
+Слайд n (с единицы) рендерится в PNG из канонического main.tiff при первом
+обращении: tifffile читает только страницу кадра. PNG хранятся в дисковом кэше
+ограниченного размера, при переполнении удаляются слайды, которые дольше всего
+не запрашивались (время изменения файла обновляется при чтении). Размер кэша
+считается один раз при первом рендере и дальше ведется счетчиком: каталог кэша
+просматривается только когда счетчик превышает лимит.
+"""
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+
+import tifffile
+from django.conf import settings
+from PIL import Image
+
+from medml.frame_store import open_frame_store
+
+
+def render_slide(tiff_path: str, index: int) -> bytes:
+    """
+    PNG кадра index (с нуля) многостраничного TIFF; если рядом есть
+    покадровое хранилище, кадр читается из него
+    """
+    if index < 0:
+        raise IndexError(f"Slide {index + 1} is out of range")
+    store = open_frame_store(tiff_path)
+    if store is not None:
+        with store:
+            frame = store[index]
+    else:
+        with tifffile.TiffFile(tiff_path) as tif:
+            if index >= len(tif.pages):
+                raise IndexError(f"Slide {index + 1} is out of range")
+            frame = tif.pages[index].asarray()
+    buffer = io.BytesIO()
+    with Image.fromarray(frame) as img:
+        img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class SlideCache:
+    """
+    Дисковый LRU кэш отрендеренных слайдов
+    """
+
+    SHRINK_MARGIN = 0.1
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # None - размер еще не посчитан; слайды других процессов счетчик не видит,
+        # они учитываются при следующем просмотре каталога
+        self._size = None
+
+    def path(self, tiff_path: str, index: int) -> Path:
+        """
+        Файл слайда в кэше; ключ включает время изменения TIFF,
+        поэтому перезаписанное исследование рендерится заново
+        """
+        stat = os.stat(tiff_path)
+        key = hashlib.sha256(f"{tiff_path}:{stat.st_mtime_ns}:{index}".encode()).hexdigest()
+        return self.directory / key[:2] / f"{key}.png"
+
+    def get_or_render(self, tiff_path: str, index: int) -> Path:
+        path = self.path(tiff_path, index)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        data = render_slide(tiff_path, index)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as out:
+            out.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._shrink(keep=path)
+        return path
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        entries = []
+        for path in self.directory.glob("*/*.png"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _shrink(self, keep: Path) -> None:
+        """
+        Удаляет давно не запрошенные слайды, пока кэш не станет меньше лимита на
+        SHRINK_MARGIN - следующий просмотр каталога будет не раньше, чем через
+        столько новых слайдов; вызывается под self._lock
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * (1 - self.SHRINK_MARGIN)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+        self._size = total
+
+
+_slide_cache = None
+
+
+def get_slide_cache() -> SlideCache:
+    global _slide_cache
+    if _slide_cache is None:
+        _slide_cache = SlideCache(
+            directory=settings.SLIDE_CACHE_DIR,
+            max_bytes=settings.SLIDE_CACHE_MB * 1024 * 1024,
+        )
+    return _slide_cache
@@ -1,18 +1,77 @@
 import dramatiq
-from dramatiq.brokers.rabbitmq import RabbitmqBroker
+from django.conf import settings
+from dramatiq.results import ResultFailure, ResultMissing
 
-broker = RabbitmqBroker(host="localhost", port=5672)
-dramatiq.set_broker(broker)
+from medml import models
+from medml.messaging import publisher, result_backend
 
 
-def send_prediction_task(file_path: str, projection_type: str, image_id: int):
+# Очереди задач predict_all: малые исследования и большие многокадровые
+PREDICTION_QUEUES = ("predict_all", "predict_all_large")
+
+
+def prediction_cost(image_count: int, height: int, width: int) -> float:
+    """
+    Оценка стоимости обработки исследования - мегапиксели всех кадров
+    """
+    return image_count * height * width / 1e6
+
+
+def send_prediction_task(file_path: str, projection_type: str, image_id: int, cost: float = 0.0):
+    """
+    Ставит исследование в очередь на обработку: исследования дороже LARGE_JOB_MPIX
+    уходят в очередь predict_all_large, которую dj_nnapi обрабатывает отдельными
+    процессами (rundramatiq_shared --large-processes), поэтому малые их не ждут
+    :param cost - оценка стоимости (prediction_cost)
+    """
+    if cost >= settings.NN_SETTINGS["LARGE_JOB_MPIX"]:
+        queue_name = "predict_all_large"
+    else:
+        queue_name = "predict_all"
     message = dramatiq.Message(
-        queue_name="predict_all",
-        actor_name="predict_all",
+        queue_name=queue_name,
+        actor_name=queue_name,
         args=(file_path, projection_type, image_id),
+        kwargs={"cost": cost},
+        options={},
+    )
+
+    # id задачи записывается до постановки в очередь: по нему get_prediction_status
+    # отличает задачи в очереди от никогда не поставленных
+    models.UZIImage.objects.filter(id=image_id).update(prediction_job_id=message.message_id)
+    publisher.enqueue(message)
+    return message
+
+
+def prediction_message(job_id: str, queue_name: str = "predict_all") -> dramatiq.Message:
+    """
+    Сообщение задачи predict_all по его id: ключ результата в Redis зависит
+    только от очереди, актора и id сообщения
+    """
+    return dramatiq.Message(
+        queue_name=queue_name,
+        actor_name=queue_name,
+        args=(),
         kwargs={},
         options={},
+        message_id=job_id,
     )
 
-    broker.enqueue(message)
-    return message
\ No newline at end of file
+
+def get_prediction_status(job_id: str) -> dict | None:
+    """
+    Состояние задачи predict_all: pending - в очереди или выполняется,
+    done - результаты сохранены, failed - задача завершилась ошибкой
+    :return - None, если задача с таким id не ставилась в очередь
+    """
+    if not models.UZIImage.objects.filter(prediction_job_id=job_id).exists():
+        return None
+    for queue_name in PREDICTION_QUEUES:
+        try:
+            result_backend.get_result(prediction_message(job_id, queue_name), block=False)
+        except ResultMissing:
+            continue
+        except ResultFailure as er:
+            return {"job_id": job_id, "status": "failed", "error": str(er)}
+        return {"job_id": job_id, "status": "done"}
+    return {"job_id": job_id, "status": "pending"}
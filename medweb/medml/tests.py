@@ -1,8 +1,22 @@
+import hashlib
+import json
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
 from django.urls import reverse
+from django.test import SimpleTestCase
 from rest_framework.test import APITestCase
 from rest_framework import status
+from rest_framework_simplejwt.tokens import AccessToken
 from django.test.testcases import SerializeMixin
-from medml import models
+from concurrent.futures import ThreadPoolExecutor
+
+from medml import contours, decoded_cache, frame_store, models, tasks
+from medml.serializers import segment_points_representation
 
 
 class MedWorkerTestCaseMixin(SerializeMixin):
@@ -152,3 +166,281 @@ class PatientTests(MedWorkerTestCaseMixin, APITestCase):
     def test_sequal(self):
         self.TestCreatePatient()
         self.TestUpdatePatient()
+
+
+class UZIPredictionProgressTests(MedWorkerTestCaseMixin, APITestCase):
+    """
+    Проверки доступа выполняются до подписки на Redis, поэтому Redis не нужен
+    """
+
+    def setUp(self):
+        self.user = models.MedWorker.objects.create_user(
+            email=self.USER1_DATA["email"], password=self.USER1_DATA["password1"]
+        )
+        self.token = str(AccessToken.for_user(self.user))
+        self.image = models.UZIImage.objects.create(details={})
+
+    def url(self, image_id):
+        return reverse("uzi_prediction_progress", kwargs={"id": image_id})
+
+    def test_requires_token(self):
+        response = self.client.get(self.url(self.image.id))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_rejects_invalid_token(self):
+        response = self.client.get(self.url(self.image.id), {"token": "not a token"})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get(
+            self.url(self.image.id), HTTP_AUTHORIZATION="Bearer not-a-token"
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_unknown_image(self):
+        missing = self.image.id + 1
+        response = self.client.get(self.url(missing), {"token": self.token})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(
+            self.url(missing), HTTP_AUTHORIZATION=f"Bearer {self.token}"
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class UZIPredictionStatusTests(MedWorkerTestCaseMixin, APITestCase):
+    def setUp(self):
+        self.user = models.MedWorker.objects.create_user(
+            email=self.USER1_DATA["email"], password=self.USER1_DATA["password1"]
+        )
+        self.client.force_authenticate(self.user)
+        self.image = models.UZIImage.objects.create(details={}, prediction_job_id="known-job")
+
+    def url(self, job_id):
+        return reverse("uzi_prediction_status", kwargs={"job_id": job_id})
+
+    def test_unknown_job(self):
+        response = self.client.get(self.url("never-enqueued"))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_known_job_pending(self):
+        with mock.patch.object(
+            tasks.result_backend, "get_result", side_effect=tasks.ResultMissing("missing")
+        ):
+            response = self.client.get(self.url("known-job"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"job_id": "known-job", "status": "pending"})
+
+    def test_known_job_done(self):
+        with mock.patch.object(tasks.result_backend, "get_result", return_value=None):
+            response = self.client.get(self.url("known-job"))
+        self.assertEqual(response.data, {"job_id": "known-job", "status": "done"})
+
+    def test_enqueue_records_job_id(self):
+        image = models.UZIImage.objects.create(details={})
+        with mock.patch.object(tasks.publisher, "enqueue") as enqueue:
+            message = tasks.send_prediction_task("main.tiff", "cross", image.id)
+        enqueue.assert_called_once_with(message)
+        image.refresh_from_db()
+        self.assertEqual(image.prediction_job_id, message.message_id)
+
+
+# Общий тестовый вектор формата CNT1, тот же, что в dj_nnapi (nnmodel/tests.py):
+# копии кодека должны декодировать его одинаково
+CNT1_VECTOR = bytes.fromhex(
+    "434e543100000000030000000a000000140000000201000200feff0300030000"
+    "00030000000500000005000000043b9c00000000000001000000010000000500"
+    "000001000000070000000800000002"
+)
+CNT1_VECTOR_POINTS = [
+    (10, 20, 0), (11, 22, 0), (9, 25, 0),
+    (5, 5, 3), (40000, 5, 3), (40001, 6, 3),
+    (7, 8, 5),
+]
+
+
+class ContoursCodecTests(SimpleTestCase):
+    def test_shared_vector_decodes(self):
+        self.assertEqual(
+            contours.unpack_points(CNT1_VECTOR).tolist(),
+            [list(p) for p in CNT1_VECTOR_POINTS],
+        )
+
+    def test_shared_vector_encodes(self):
+        self.assertEqual(contours.pack_points(CNT1_VECTOR_POINTS), CNT1_VECTOR)
+
+    def test_point_id_boundary(self):
+        stride = contours.PACKED_ID_STRIDE
+        self.assertEqual(stride, 2 ** 24)
+        last = contours.packed_point_id(0, stride - 1)
+        self.assertEqual(last, -stride)
+        self.assertEqual(contours.packed_point_id(1, 0), last - 1)
+        for uid in (-1, stride):
+            with self.assertRaises(ValueError):
+                contours.packed_point_id(0, uid)
+
+    def test_pack_points_limit(self):
+        # настоящий предел - 2**24 точек; проверяется та же граница на малом шаге
+        with mock.patch.object(contours, "PACKED_ID_STRIDE", 4):
+            points = [(i, i, 0) for i in range(5)]
+            self.assertEqual(
+                contours.unpack_points(contours.pack_points(points[:4])).tolist(),
+                [list(p) for p in points[:4]],
+            )
+            with self.assertRaises(ValueError):
+                contours.pack_points(points)
+
+    def test_packed_points_representation(self):
+        segment = SimpleNamespace(id=7, points_blob=CNT1_VECTOR)
+        points = segment_points_representation(segment)
+        self.assertEqual(
+            [(p["x"], p["y"], p["z"]) for p in points], CNT1_VECTOR_POINTS
+        )
+        self.assertEqual([p["uid"] for p in points], list(range(len(points))))
+        self.assertEqual(
+            [p["id"] for p in points],
+            [contours.packed_point_id(7, uid) for uid in range(len(points))],
+        )
+        self.assertEqual(points, segment_points_representation(segment))
+
+    def test_rows_representation(self):
+        segment = SimpleNamespace(id=7, points_blob=None)
+        self.assertIsNone(segment_points_representation(segment))
+
+
+# Хранилище кадров, записанное этим writer'ом, лежит в medml/testdata и в dj_nnapi
+# (nnmodel/testdata); обе копии и читатель dj_nnapi проверяются по одному дайджесту
+TESTDATA_STUDY = Path(__file__).resolve().parent / "testdata" / "study"
+FRAME_STORE_FIXTURE_DIGEST = "813587a984b074e8581b610d849f2fe27c4db548390f7023874559be948813b3"
+DECODED_CACHE_FIXTURE_DIGEST = "701906813bc551f20a22bd36c072dc04d73e0686c155c38f48ab266a278b0209"
+
+
+def fixture_frames():
+    """
+    Кадры хранилища из testdata, та же формула - в nnmodel/tests.py
+    """
+    frames = (np.arange(3 * 24 * 32 * 3) * 37 % 200 + 40).astype(np.uint8).reshape(3, 24, 32, 3)
+    frames[:, :3] = 0
+    frames[:, -2:] = 0
+    frames[:, :, :4] = 0
+    frames[:, :, -3:] = 0
+    return frames
+
+
+class FrameStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tiff_path = Path(self.tmp.name) / "main.tiff"
+
+    def write(self, frames, **kwargs):
+        frame_store.write_frame_store(frame_store.frame_store_path(self.tiff_path), frames, **kwargs)
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        for frames in (
+            rng.integers(0, 256, size=(5, 20, 30, 3), dtype=np.uint8),
+            rng.integers(0, 4096, size=(4, 20, 30), dtype=np.uint16),
+            np.empty((0, 20, 30, 3), dtype=np.uint8),
+        ):
+            self.write(frames)
+            with frame_store.open_frame_store(self.tiff_path) as store:
+                self.assertEqual(len(store), len(frames))
+                self.assertEqual(store.dtype, frames.dtype)
+                for idx, frame in enumerate(frames):
+                    np.testing.assert_array_equal(store[idx], frame)
+                if len(frames):
+                    np.testing.assert_array_equal(store[-1], frames[-1])
+                with self.assertRaises(IndexError):
+                    store[len(frames)]
+
+    def test_index_is_written_last(self):
+        directory = frame_store.frame_store_path(self.tiff_path)
+        compress = frame_store._compress
+
+        def check_no_index(frame, level):
+            self.assertFalse((directory / frame_store.INDEX_NAME).exists())
+            return compress(frame, level)
+
+        self.write(fixture_frames())
+        with mock.patch.object(frame_store, "_compress", side_effect=check_no_index):
+            self.write(fixture_frames()[:2])
+        with frame_store.open_frame_store(self.tiff_path) as store:
+            self.assertEqual(len(store), 2)
+
+    def test_interrupted_write_hides_store(self):
+        self.write(fixture_frames())
+        with mock.patch.object(frame_store, "_compress", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.write(fixture_frames())
+        self.assertFalse(frame_store.has_frame_store(self.tiff_path))
+        self.assertIsNone(frame_store.open_frame_store(self.tiff_path))
+
+    def test_unknown_format_is_ignored(self):
+        self.write(fixture_frames())
+        index_path = frame_store.frame_store_path(self.tiff_path) / frame_store.INDEX_NAME
+        index = json.loads(index_path.read_text())
+        without_format = {key: value for key, value in index.items() if key != "format"}
+        for broken in (without_format, {**index, "version": frame_store.VERSION + 1}):
+            index_path.write_text(json.dumps(broken))
+            with self.assertRaises(ValueError):
+                frame_store.FrameStore(index_path.parent)
+            self.assertIsNone(frame_store.open_frame_store(self.tiff_path))
+
+    def test_fixture_matches_writer(self):
+        directory = frame_store.frame_store_path(TESTDATA_STUDY / "main.tiff")
+        digest = hashlib.sha256()
+        for name in (frame_store.INDEX_NAME, frame_store.DATA_NAME):
+            digest.update((directory / name).read_bytes())
+        self.assertEqual(digest.hexdigest(), FRAME_STORE_FIXTURE_DIGEST)
+
+        self.write(fixture_frames())
+        written = json.loads((frame_store.frame_store_path(self.tiff_path) / frame_store.INDEX_NAME).read_text())
+        fixture = json.loads((directory / frame_store.INDEX_NAME).read_text())
+        del written["offsets"]
+        del fixture["offsets"]
+        self.assertEqual(written, fixture)
+        with frame_store.FrameStore(directory) as store:
+            np.testing.assert_array_equal(np.stack(list(store)), fixture_frames())
+
+
+class DecodedCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tiff_path = Path(self.tmp.name) / "main.tiff"
+
+    def write(self, frames):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            decoded_cache.write_decoded_cache(self.tiff_path, frames, pool)
+        frames_path, meta_path = decoded_cache.decoded_cache_paths(self.tiff_path)
+        return np.load(frames_path), json.loads(meta_path.read_text())
+
+    def test_fixture_matches_writer(self):
+        fixture_paths = decoded_cache.decoded_cache_paths(TESTDATA_STUDY / "main.tiff")
+        digest = hashlib.sha256()
+        for path in fixture_paths:
+            digest.update(path.read_bytes())
+        self.assertEqual(digest.hexdigest(), DECODED_CACHE_FIXTURE_DIGEST)
+
+        frames, meta = self.write(fixture_frames())
+        np.testing.assert_array_equal(frames, np.load(fixture_paths[0]))
+        self.assertEqual(meta, json.loads(fixture_paths[1].read_text()))
+        self.assertEqual(meta["format"], decoded_cache.FORMAT)
+
+    def test_grey_frames_are_stored_as_rgb(self):
+        grey = fixture_frames()[..., 0]
+        frames, meta = self.write(grey)
+        self.assertEqual(frames.shape, (*grey.shape, 3))
+        for channel in range(3):
+            np.testing.assert_array_equal(frames[..., channel], grey)
+
+    def test_meta_is_written_last(self):
+        self.write(fixture_frames())
+        meta_path = decoded_cache.decoded_cache_paths(self.tiff_path)[1]
+        convert = decoded_cache._convert_frame
+
+        def check_no_meta(*args):
+            self.assertFalse(meta_path.exists())
+            return convert(*args)
+
+        with mock.patch.object(decoded_cache, "_convert_frame", side_effect=check_no_meta):
+            frames, meta = self.write(fixture_frames()[:1])
+        self.assertEqual(len(frames), 1)
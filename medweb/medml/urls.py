@@ -116,6 +116,18 @@ urlpatterns = [
                     views.UZIImageCreateView.as_view(),
                     name="uzi_group_create",
                 ),
+                # Ход обработки снимка нейросетью (Server-Sent Events)
+                path(
+                    "<int:id>/progress/",
+                    views.UZIPredictionProgressView.as_view(),
+                    name="uzi_prediction_progress",
+                ),
+                # Состояние обработки снимка нейросетью
+                path(
+                    "job/<str:job_id>/",
+                    views.UZIPredictionStatusView.as_view(),
+                    name="uzi_prediction_status",
+                ),
                 path(
                     "segment/",
                     include(
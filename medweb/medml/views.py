@@ -1,7 +1,7 @@
 import json
 
-import concurrent.futures
-from dramatiq.results.backends.redis import RedisBackend
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
 from rest_framework.response import Response
 from rest_framework.request import Request
 from rest_framework.permissions import AllowAny
@@ -16,14 +16,24 @@ from rest_framework.generics import (
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import mixins
 from rest_framework.viewsets import ModelViewSet
-
+from rest_framework.views import APIView
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
 from django.db.models import Max, Prefetch
-from django.http import Http404
+from django.http import FileResponse, Http404, JsonResponse, StreamingHttpResponse
+from django.views import View
 
 from medml import filters
 from medml import serializers as ser
 from medml import models
 from medml import tasks
+from medml.fields import DicomAndTiffFileField
+from medml.slides import get_slide_cache
 
 """MedWorkers' VIEWS"""
 
@@ -216,7 +226,8 @@ class PatientListView(ListAPIView):
 class UZIImageCreateView(CreateAPIView):
     """
     Форма для сохранния УЗИ изображения и отправки в очередь на обарботку
-    УЗИ снимка
+    УЗИ снимка. Ответ возвращается сразу после постановки в очередь,
+    состояние обработки - по job_id (UZIPredictionStatusView)
     """
 
     serializer_class = ser.UZIImageCreateSerializer
@@ -225,9 +236,7 @@ class UZIImageCreateView(CreateAPIView):
         print(request.data["original_image"])
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(self.perform_create, serializer)
-            data = future.result(timeout=300)
+        data = self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
         return Response(data, status=status.HTTP_201_CREATED, headers=headers)
 
@@ -236,14 +245,129 @@ class UZIImageCreateView(CreateAPIView):
 
         uzi_image: models.UZIImage = d["uzi_image"]
         original: models.OriginalImage = d["image"]
+        file_path = original.image.tiff_file_path
+        if settings.NN_SETTINGS["SEND_DICOM"] and original.image.name.lower().endswith(".dcm"):
+            file_path = original.image.path
         task = tasks.send_prediction_task(
-            original.image.tiff_file_path,
+            file_path,
             uzi_image.details.get("projection_type", "cross"),
             uzi_image.id,
+            cost=tasks.prediction_cost(original.image_count, *original.slide_size),
+        )
+        return {"image_id": uzi_image.id, "job_id": task.message_id}
+
+
+class UZIPredictionStatusView(APIView):
+    """
+    Состояние обработки УЗИ снимка нейросетью по job_id; 404, если задача не ставилась в очередь
+    """
+
+    def get(self, request, job_id, *args, **kwargs):
+        job_status = tasks.get_prediction_status(job_id)
+        if job_status is None:
+            raise Http404
+        return Response(job_status)
+
+
+class UZIPredictionProgressView(View):
+    """
+    Ход обработки УЗИ снимка нейросетью (Server-Sent Events).
+    События публикует dj_nnapi в Redis канал uzi:progress:<id>; сначала отдается
+    последнее известное состояние, поток закрывается после этапа done или failed.
+
+    Представление асинхронное и не проходит через DRF, поэтому JWT проверяется здесь:
+    из заголовка Authorization или, для EventSource, который не передает заголовки,
+    из параметра token. Без действительного токена - 401, для несуществующего снимка - 404
+    """
+
+    PROGRESS_CHANNEL = "uzi:progress:{image_id}"
+    PROGRESS_LAST_KEY = "uzi:progress:{image_id}:last"
+    FINAL_STAGES = ("done", "failed")
+    KEEPALIVE_SECONDS = 15
+
+    async def get(self, request, id, *args, **kwargs):
+        user = await sync_to_async(self._authenticate)(request)
+        if user is None or not user.is_authenticated:
+            return JsonResponse(
+                {"detail": "Authentication credentials were not provided or are invalid."},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+        if not await models.UZIImage.objects.filter(id=id).aexists():
+            raise Http404
+        response = StreamingHttpResponse(
+            self.events(id), content_type="text/event-stream"
         )
-        result_backend = RedisBackend(host='localhost', port=6380)
-        result = result_backend.get_result(message=task, block=True, timeout=1000000)
-        return {"image_id": uzi_image.id}
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @staticmethod
+    def _authenticate(request):
+        """
+        Пользователь по JWT из заголовка или параметра token, None - если токена нет или он недействителен
+        """
+        authentication = JWTAuthentication()
+        try:
+            token = request.GET.get("token")
+            if token:
+                return authentication.get_user(authentication.get_validated_token(token))
+            result = authentication.authenticate(request)
+        except (InvalidToken, TokenError, AuthenticationFailed):
+            return None
+        return result[0] if result is not None else None
+
+    async def events(self, image_id):
+        client = aioredis.Redis.from_url(settings.PROGRESS_REDIS_URL)
+        pubsub = client.pubsub()
+        try:
+            # подписка до чтения последнего состояния, чтобы не пропустить события между ними
+            await pubsub.subscribe(self.PROGRESS_CHANNEL.format(image_id=image_id))
+            last = await client.get(self.PROGRESS_LAST_KEY.format(image_id=image_id))
+            if last is not None:
+                yield self._event(last)
+                if json.loads(last)["stage"] in self.FINAL_STAGES:
+                    return
+
+            while True:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=self.KEEPALIVE_SECONDS
+                )
+                if message is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield self._event(message["data"])
+                if json.loads(message["data"])["stage"] in self.FINAL_STAGES:
+                    return
+        finally:
+            await pubsub.close()
+            await client.close()
+
+    @staticmethod
+    def _event(data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        return f"data: {data}\n\n"
+
+
+class SlideView(View):
+    """
+    Слайд исследования по адресу из slide_template (<base>/pngs/slide_<n>.png).
+    PNG, записанные при загрузке, отдаются как есть, иначе слайд рендерится
+    из main.tiff и кэшируется (medml.slides)
+    """
+
+    def get(self, request, base, number, *args, **kwargs):
+        field = DicomAndTiffFileField
+        slide_name = f"{base}/{field.slides_dir}/{field.slide_name_prefix}{number}{field.slide_name_postfix}"
+        try:
+            if default_storage.exists(slide_name):
+                path = default_storage.path(slide_name)
+            else:
+                tiff_path = default_storage.path(f"{base}/{field.tiff_name}")
+                path = get_slide_cache().get_or_render(tiff_path, int(number) - 1)
+        except (SuspiciousFileOperation, FileNotFoundError, IndexError):
+            raise Http404
+        return FileResponse(open(path, "rb"), content_type="image/png")
 
 
 class UziImageShowView(RetrieveAPIView):
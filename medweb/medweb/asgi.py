@@ -0,0 +1,16 @@
+"""
+ASGI config for medweb project.
+
+uvicorn (entrypoint.sh) обслуживает только потоковый ход обработки снимка
+(UZIPredictionProgressView): открытый поток не занимает поток воркера.
+Остальной API - синхронные представления DRF, под ASGI Django выполняет их
+в одном потоке на процесс, поэтому их обслуживает gunicorn (medweb.wsgi).
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "medweb.settings")
+
+application = get_asgi_application()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
 from pathlib import Path
+import os
 from os import getenv
 from datetime import timedelta
 import django_prometheus
@@ -174,6 +175,20 @@ MEDIA_ROOT = getenv("MEDIA_ROOT", "./media")
 MEDIA_ROOT_PATH = Path(MEDIA_ROOT)
 STATIC_ROOT = "/usr/src/web/static_files"
 IMAGE_NAME_MAX_CHARS = 10
+# PNG всех слайдов пишутся при загрузке; иначе слайд рендерится из main.tiff
+# при первом запросе и хранится в кэше SLIDE_CACHE_DIR размером до SLIDE_CACHE_MB
+EAGER_SLIDE_EXPORT = getenv("EAGER_SLIDE_EXPORT", "0") == "1"
+SLIDE_CACHE_DIR = getenv("SLIDE_CACHE_DIR", str(MEDIA_ROOT_PATH / "slide_cache"))
+SLIDE_CACHE_MB = int(getenv("SLIDE_CACHE_MB", "512"))
+# Покадровое хранилище main.frames рядом с main.tiff (medml.frame_store) и уровень сжатия zlib.
+# Хранит кадры второй раз, примерно удваивая место на диске; без него кадры читаются из main.tiff
+FRAME_STORE = getenv("FRAME_STORE", "0") == "1"
+FRAME_STORE_LEVEL = int(getenv("FRAME_STORE_LEVEL", "3"))
+# Декодированные RGB кадры main.npy и окно обрезки для dj_nnapi (medml.decoded_cache):
+# воркер отображает их в память вместо повторного декодирования. Занимает N*H*W*3 байт
+DECODED_CACHE = getenv("DECODED_CACHE", "0") == "1"
+# Потоки кодирования кадров загруженного исследования в PNG и TIFF
+INGEST_WORKERS = int(getenv("INGEST_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
 BASE_MODEL_PATH = MEDIA_ROOT_PATH / "nnModel"
 
 
@@ -194,10 +209,37 @@ SIMPLE_JWT = {
 #CELERY_BROKER_URL = "redis://localhost:6380"
 #CELERY_RESULT_BACKEND = "redis://localhost:6380"
 
+"""Брокер задач dramatiq (RabbitMQ) и бэкенд результатов (Redis)"""
+RABBITMQ_HOST = getenv("RABBITMQ_HOST", "localhost")
+RABBITMQ_PORT = int(getenv("RABBITMQ_PORT", "5672"))
+RESULT_REDIS_URL = getenv("RESULT_REDIS_URL", "redis://localhost:6380")
+MESSAGING = {
+    "REDIS_MAX_CONNECTIONS": int(getenv("REDIS_MAX_CONNECTIONS", "32")),
+    # Сколько секунд запрос ждет свободное соединение пула Redis
+    "REDIS_POOL_TIMEOUT": float(getenv("REDIS_POOL_TIMEOUT", "5")),
+    # Потоки (и постоянные соединения AMQP) для постановки задач в очередь
+    "PUBLISHER_THREADS": int(getenv("AMQP_PUBLISHER_THREADS", "2")),
+    # Простаивавшие соединения Redis и AMQP проверяются перед использованием, секунды
+    "HEALTH_CHECK_INTERVAL": int(getenv("MESSAGING_HEALTH_CHECK_INTERVAL", "30")),
+    "AMQP_HEARTBEAT": int(getenv("AMQP_HEARTBEAT", "60")),
+    "AMQP_BLOCKED_TIMEOUT": int(getenv("AMQP_BLOCKED_TIMEOUT", "30")),
+}
+
+"""Redis: ход обработки снимков нейросетью (публикует dj_nnapi)"""
+PROGRESS_REDIS_URL = getenv("PROGRESS_REDIS_URL", "redis://localhost:6380")
+
 """NNModel"""
 NN_SETTINGS = {
     "IMAGE_NAME_MAX_CHARS": 10,
     "MAX_IMAGE_BYTES": 1024,
+    # Хранение контуров сегментов: "points" - строка SegmentationPoint на вершину,
+    # "blob" - упакованный контур в SegmentationData.points_blob
+    "CONTOUR_STORAGE": getenv("NN_CONTOUR_STORAGE", "points"),
+    # Исследования дороже LARGE_JOB_MPIX мегапикселей (все кадры) уходят в очередь predict_all_large
+    "LARGE_JOB_MPIX": float(getenv("NN_LARGE_JOB_MPIX", "50")),
+    # Отправлять в dj_nnapi загруженный .dcm вместо main.tiff: воркер читает DICOM
+    # покадрово (DicomFrameReader) без промежуточного TIFF
+    "SEND_DICOM": getenv("NN_SEND_DICOM", "0") == "1",
     "classification": {
         "cross": BASE_MODEL_PATH / "base/classUZI/cross/resnet.zip",
         "long": BASE_MODEL_PATH / "base/classUZI/long/resnet.zip",
@@ -1,8 +1,13 @@
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from medml.fields import DicomAndTiffFileField
+from medml.views import SlideView
+
 # import django_prometheus
 
 
@@ -15,6 +20,21 @@ urlpatterns = [
     # path('', include('medweb_front.urls')),
 ]
 
+# Слайды рендерятся по запросу, маршрут должен идти до раздачи MEDIA_URL
+urlpatterns += [
+    re_path(
+        r"^%s/(?P<base>.+)/%s/%s(?P<number>[1-9]\d*)%s$"
+        % (
+            settings.MEDIA_URL.strip("/"),
+            DicomAndTiffFileField.slides_dir,
+            DicomAndTiffFileField.slide_name_prefix,
+            re.escape(DicomAndTiffFileField.slide_name_postfix),
+        ),
+        SlideView.as_view(),
+        name="slide",
+    ),
+]
+
 urlpatterns += static(
     settings.STATIC_URL, document_root=settings.STATIC_ROOT
 )
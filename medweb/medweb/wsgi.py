@@ -0,0 +1,14 @@
+"""
+WSGI config for medweb project.
+
+API medweb обслуживает gunicorn с потоками (entrypoint.sh), потоковый ход
+обработки снимка - uvicorn (medweb.asgi).
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "medweb.settings")
+
+application = get_wsgi_application()